@@ -44,7 +44,7 @@
 
 from PyQt4 import QtGui, QtNetwork
 
-#from instantsoup import *
+from instantsoupcodec import get_codec, CodecError
 
 class Receiver(QtGui.QDialog):
     def __init__(self, parent=None):
@@ -77,7 +77,10 @@ class Receiver(QtGui.QDialog):
     def processPendingDatagrams(self):
         while self.udpSocket.hasPendingDatagrams():
             datagram, host, port = self.udpSocket.readDatagram(self.udpSocket.pendingDatagramSize())
-            datagram = str(peerPDU.parse(datagram))
+            try:
+                datagram = str(get_codec().parse_pdu(datagram))
+            except CodecError as error:
+                datagram = "invalid pdu (%s)" % error
             self.statusLabel.setText("Received datagram: \"%s\"" % datagram)
 
 if __name__ == '__main__':
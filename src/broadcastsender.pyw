@@ -45,7 +45,7 @@
 
 from PyQt4 import QtCore, QtGui, QtNetwork
 
-from instantsoupdata import *
+from instantsoupcodec import get_codec
 
 class Sender(QtGui.QDialog):
     def __init__(self, parent=None):
@@ -82,11 +82,9 @@ class Sender(QtGui.QDialog):
 
     def broadcastDatagramm(self):
         self.statusLabel.setText("Now broadcasting datagram %d" % self.messageNo)
-        data = peerPDU.build(Container(ClientID="Bob", Option=[
-                                                            Container(OptionID="SERVER_INVITE_OPTION", OptionData=Container(ChannelID="TM2011", ClientID=["Alice", "Billy"])),
-                                                            Container(OptionID="CLIENT_NICK_OPTION", OptionData="Susan")]
-                                          )
-        )
+        data = get_codec().build_pdu("Bob", [
+            ("CLIENT_NICK_OPTION", "Susan"),
+            ("SERVER_INVITE_OPTION", ("TM2011", ["Alice", "Billy"]))])
         self.udpSocket.writeDatagram(data, QtNetwork.QHostAddress("239.255.99.63"), 55555)
         self.messageNo += 1
 
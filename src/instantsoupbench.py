@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator and benchmark for the headless InstantSOUP server.
+
+Simulated clients speak the real protocol: CLIENT_NICK_OPTION datagrams to
+the discovery port of the server, JOIN, SAY and INVITE commands over tcp.
+Start it with::
+
+    python instantsoupbench.py --clients 200 --channels 10 --duration 10
+
+The server runs in this process, or in a child process with
+``--server-process`` (and ``--workers`` for a sharded one). The clients run
+in this process too, or spread over ``--client-processes`` child processes.
+
+A run has two phases. During discovery every client announces itself,
+connects and joins its channel, and repeats its JOIN and a probe message
+until the probe comes back. The time until the last probe came back is the
+discovery convergence time. Then the workload runs for ``--duration``
+seconds: per client and second, ``--say-rate`` messages, ``--invite-rate``
+invites and ``--nick-rate`` nickname changes. Messages carry their send
+time, so every delivery counts towards messages/sec and the p50/p99
+latency. CPU time and maximum RSS are those of the server process (which
+includes the clients, if they share it).
+
+Each client binds to its own loopback address (127.0.0.2, 127.0.0.3, ...),
+because the server tells users apart by their address. Linux routes all of
+127.0.0.0/8 to the loopback device, other systems need aliases.
+
+The results are appended to ``--results`` as JSON lines, together with the
+git revision, and compared with the last run of the same workload.
+"""
+
+import argparse
+import asyncore
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+from instantsoupcodec import CodecError, CommandFramer, get_codec
+from instantsoupserver import HeadlessServer, broadcast_port
+from instantsoupserver import server_start_port
+from instantsouputil import OutboundQueue
+
+log = logging.getLogger("instantsoup")
+
+# first word of every message of the load generator
+MESSAGE_PREFIX = "bench"
+
+# metrics compared between runs, with their labels
+METRICS = [
+    ("discovery_seconds", "discovery convergence (s)"),
+    ("messages_per_second", "messages/s"),
+    ("latency_p50_ms", "latency p50 (ms)"),
+    ("latency_p99_ms", "latency p99 (ms)"),
+    ("cpu_seconds", "server cpu (s)"),
+    ("maximum_rss_kb", "server maximum rss (kB)"),
+]
+
+
+def loopback_address(number):
+    """return the loopback address of client number"""
+    number += 2
+    return "127.%i.%i.%i" % ((number >> 16) & 0xff, (number >> 8) & 0xff,
+                             number & 0xff)
+
+
+def percentile(values, fraction):
+    """return the fraction-percentile of the sorted values, or None"""
+    if not values:
+        return None
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class Workload(object):
+    """what the simulated clients do, rates are per client and second"""
+
+    def __init__(self, clients=50, channels=5, duration=10.0, say_rate=1.0,
+                 invite_rate=0.0, nick_rate=0.0, message_size=64, codec=None,
+                 host="127.0.0.1", port=server_start_port):
+        self.clients = clients
+        self.channels = channels
+        self.duration = duration
+        self.say_rate = say_rate
+        self.invite_rate = invite_rate
+        self.nick_rate = nick_rate
+        self.message_size = message_size
+        self.codec = codec
+        self.host = host
+        self.port = port
+
+    def channel_of(self, number):
+        return u"bench%i" % (number % self.channels)
+
+    def members_of(self, number):
+        """return the number of clients in the channel of client number"""
+        channel = number % self.channels
+        return len(range(channel, self.clients, self.channels))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in
+                    ("clients", "channels", "duration", "say_rate",
+                     "invite_rate", "nick_rate", "message_size", "codec"))
+
+
+class SimulatedClient(asyncore.dispatcher):
+    """one client of the load generator, on its own loopback address"""
+
+    def __init__(self, generator, number):
+        asyncore.dispatcher.__init__(self, map=generator.map)
+        self.generator = generator
+        self.number = number
+        self.address = loopback_address(number)
+        self.id = str(uuid.uuid1())
+        self.nickname = "bench%i" % number
+        self.channel_id = generator.workload.channel_of(number)
+        self.sequence = 0
+
+        # time our probe came back, from then on the client is joined
+        self.joined = None
+        self.next_attempt = 0
+
+        self.framer = CommandFramer()
+        self.outbound = OutboundQueue(1 << 24)
+        self.pending = ""
+
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((self.address, 0))
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bind((self.address, 0))
+        self.connect((generator.workload.host, generator.workload.port))
+
+    def announce(self):
+        pdu = self.generator.codec.build_pdu(
+            self.id, [("CLIENT_NICK_OPTION", self.nickname)])
+        self.udp_socket.sendto(pdu, (self.generator.workload.host,
+                                     broadcast_port))
+
+    def send_command(self, command):
+        self.outbound.put(self.generator.codec.build_command(command))
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        data = self.recv(1 << 16)
+        if not data:
+            return
+        try:
+            commands = self.framer.feed(data)
+        except CodecError as error:
+            log.error("broken command stream: %s" % error)
+            self.handle_close()
+            return
+        for command in commands:
+            if command.startswith("SAY"):
+                self.generator.handle_say(self, command)
+
+    def writable(self):
+        return not self.connected or bool(self.pending) or \
+               bool(self.outbound)
+
+    def handle_write(self):
+        if not self.pending:
+            self.pending = self.outbound.take(1 << 16)
+        sent = self.send(self.pending)
+        self.pending = self.pending[sent:]
+
+    def handle_close(self):
+        log.error("client %i lost its connection" % self.number)
+        self.close()
+        self.udp_socket.close()
+
+
+class LoadGenerator(object):
+    """drives the simulated clients numbers through one run of workload"""
+
+    # repeat the discovery of a client after this many seconds
+    DISCOVERY_RETRY_TIME = 0.2
+    DISCOVERY_TIMEOUT = 30.0
+
+    # clients announce themselves like the Client does, so they stay alive
+    ANNOUNCE_TIME = HeadlessServer.REGULAR_PDU_WAITING_TIME / 1000.0
+
+    # after the workload, wait this long for messages still on their way
+    DRAIN_TIME = 0.5
+    MAXIMUM_DRAIN_TIME = 5.0
+
+    # seconds waited for events per pass of the event loop
+    STEP_TIME = 0.001
+
+    def __init__(self, workload, numbers, server=None):
+        self.workload = workload
+        self.codec = get_codec(workload.codec)
+
+        # a server in this process shares the event loop with the clients
+        self.server = server
+        self.map = server.map if server is not None else {}
+
+        self.clients = [SimulatedClient(self, number) for number in numbers]
+        self.waiting = len(self.clients)
+
+        self.said = 0
+        self.delivered = 0
+        self.latencies = []
+        self.last_delivery = None
+
+    def step(self):
+        if self.server is not None:
+            self.server.run_once(self.STEP_TIME)
+        else:
+            asyncore.loop(self.STEP_TIME, map=self.map, count=1,
+                          use_poll=True)
+
+    def handle_say(self, client, command):
+        parts = command.split("\x00")
+        if len(parts) < 3:
+            return
+        fields = parts[2].split(" ", 4)
+        if len(fields) < 4 or fields[0] != MESSAGE_PREFIX:
+            return
+        now = time.time()
+        _, number, sequence, sent = fields[:4]
+
+        # our own probe is back, we are in the channel
+        if sequence == "probe":
+            if int(number) == client.number and client.joined is None:
+                client.joined = now
+                self.waiting -= 1
+            return
+
+        self.delivered += 1
+        self.latencies.append(now - float(sent))
+        self.last_delivery = now
+
+    def _message(self, client, sequence):
+        text = "%s %i %s %.6f" % (MESSAGE_PREFIX, client.number, sequence,
+                                  time.time())
+        padding = self.workload.message_size - len(text) - 1
+        if padding > 0:
+            text += " " + "x" * padding
+        return "SAY\x00" + text
+
+    def say(self, client):
+        client.sequence += 1
+        client.send_command(self._message(client, client.sequence))
+        self.said += 1
+
+    def invite(self, client):
+        invited = random.choice(self.clients)
+        client.send_command("INVITE\x00%s" % invited.id)
+
+    def change_nick(self, client):
+        client.nickname = "bench%i-%i" % (client.number,
+                                          random.randint(0, 1 << 16))
+        client.announce()
+
+    def discover(self):
+        """join all clients, return the convergence time or None"""
+        started = time.time()
+        while self.waiting:
+            now = time.time()
+            if now - started > self.DISCOVERY_TIMEOUT:
+                log.error("%i clients did not join in time" % self.waiting)
+                return None
+            for client in self.clients:
+                if client.joined is None and now >= client.next_attempt:
+                    client.announce()
+                    client.send_command("JOIN\x00%s" % client.channel_id)
+                    client.send_command(self._message(client, "probe"))
+                    client.next_attempt = now + self.DISCOVERY_RETRY_TIME
+            self.step()
+        return time.time() - started
+
+    def run(self):
+        """run discovery and workload, return the statistics"""
+        discovery = self.discover()
+
+        actions = [(self.workload.say_rate, self.say),
+                   (self.workload.invite_rate, self.invite),
+                   (self.workload.nick_rate, self.change_nick)]
+        credits = [0.0] * len(actions)
+        started = last = last_announce = time.time()
+        while last - started < self.workload.duration:
+            now = time.time()
+
+            # spread the actions evenly, whatever the speed of the loop
+            for index, (rate, action) in enumerate(actions):
+                credits[index] += rate * len(self.clients) * (now - last)
+                while credits[index] >= 1:
+                    action(random.choice(self.clients))
+                    credits[index] -= 1
+            if now - last_announce >= self.ANNOUNCE_TIME:
+                for client in self.clients:
+                    client.announce()
+                last_announce = now
+            last = now
+            self.step()
+
+        # wait for the messages that are still on their way
+        finished = time.time()
+        while time.time() - finished < self.MAXIMUM_DRAIN_TIME and \
+              time.time() - (self.last_delivery or finished) < self.DRAIN_TIME:
+            self.step()
+
+        for client in self.clients:
+            client.close()
+            client.udp_socket.close()
+
+        return {"discovery": discovery, "said": self.said,
+                "delivered": self.delivered, "latencies": self.latencies,
+                "started": started,
+                "finished": max(self.last_delivery or finished, finished)}
+
+
+def run_load_generator(queue, workload, numbers):
+    """target of a client process, puts its statistics into queue"""
+    queue.put(LoadGenerator(workload, numbers).run())
+
+
+def run_server(pipe, port, codec, workers):
+    """target of the server process, sends its resource usage on exit"""
+
+    # stop cleanly when terminated, so sharded workers are waited for
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if workers > 0:
+        from instantsoupsharded import ShardedServer
+        server = ShardedServer(port, codec, workers=workers)
+    else:
+        server = HeadlessServer(port, codec)
+    try:
+        server.run()
+    finally:
+        server.close()
+        pipe.send(resource_usage(resource.RUSAGE_SELF,
+                                 resource.RUSAGE_CHILDREN))
+
+
+def resource_usage(*who):
+    """return (cpu seconds, maximum rss in kB) of who"""
+    cpu = 0.0
+    rss = 0
+    for usage in [resource.getrusage(each) for each in who]:
+        cpu += usage.ru_utime + usage.ru_stime
+        rss = max(rss, usage.ru_maxrss)
+    return cpu, rss
+
+
+def current_revision():
+    """return the git revision of this tree, None if unknown"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], cwd=directory,
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark(object):
+    """one run of a workload against a server"""
+
+    def __init__(self, workload, server_process=False, workers=0,
+                 client_processes=0):
+        self.workload = workload
+        self.server_process = server_process or workers > 0
+        self.workers = workers
+        self.client_processes = client_processes
+
+    def _wait_for_server(self, timeout=10.0):
+        started = time.time()
+        while True:
+            try:
+                socket.create_connection((self.workload.host,
+                                          self.workload.port), 1.0).close()
+                return
+            except socket.error:
+                if time.time() - started > timeout:
+                    raise
+                time.sleep(0.05)
+
+    def run(self):
+        server = None
+        if self.server_process:
+            pipe, server_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_server,
+                args=(server_pipe, self.workload.port, self.workload.codec,
+                      self.workers))
+            process.start()
+            self._wait_for_server()
+        else:
+            server = HeadlessServer(self.workload.port, self.workload.codec)
+        started = time.time()
+        usage = resource_usage(resource.RUSAGE_SELF)
+
+        try:
+            numbers = range(self.workload.clients)
+            if self.client_processes > 0:
+                statistics = self._run_client_processes(numbers, server)
+            else:
+                statistics = [LoadGenerator(self.workload, numbers,
+                                            server).run()]
+        finally:
+            if server is not None:
+                server.close()
+                cpu, rss = resource_usage(resource.RUSAGE_SELF)
+                usage = (cpu - usage[0], rss)
+            else:
+                process.terminate()
+                usage = pipe.recv() if pipe.poll(10.0) else (None, None)
+                process.join()
+
+        return self._result(statistics, usage, time.time() - started)
+
+    def _run_client_processes(self, numbers, server):
+        queue = multiprocessing.Queue()
+        processes = []
+        for index in range(self.client_processes):
+            process = multiprocessing.Process(target=run_load_generator,
+                args=(queue, self.workload,
+                      numbers[index::self.client_processes]))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        # serve until every client process reported
+        statistics = []
+        while len(statistics) < len(processes):
+            if server is not None:
+                server.run_once(LoadGenerator.STEP_TIME)
+            while not queue.empty():
+                statistics.append(queue.get())
+            if server is None and len(statistics) < len(processes):
+                time.sleep(0.05)
+        for process in processes:
+            process.join()
+        return statistics
+
+    def _result(self, statistics, usage, wall):
+        discoveries = [each["discovery"] for each in statistics]
+        latencies = sorted(latency for each in statistics
+                           for latency in each["latencies"])
+        delivered = sum(each["delivered"] for each in statistics)
+        said = sum(each["said"] for each in statistics)
+        expected = sum(self.workload.members_of(number) for number in
+                       range(self.workload.clients)) * \
+            self.workload.say_rate * self.workload.duration
+        elapsed = max(each["finished"] for each in statistics) - \
+            min(each["started"] for each in statistics)
+        cpu, rss = usage
+
+        def milliseconds(value):
+            return None if value is None else round(value * 1000, 3)
+
+        return {
+            "revision": current_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "workload": dict(self.workload.as_dict(),
+                             server_process=self.server_process,
+                             workers=self.workers,
+                             client_processes=self.client_processes),
+            "discovery_seconds": None if None in discoveries
+                                 else round(max(discoveries), 3),
+            "said": said,
+            "delivered": delivered,
+            "expected_deliveries": int(expected),
+            "messages_per_second": round(delivered / elapsed, 1)
+                                   if elapsed > 0 else None,
+            "latency_p50_ms": milliseconds(percentile(latencies, 0.5)),
+            "latency_p99_ms": milliseconds(percentile(latencies, 0.99)),
+            "cpu_seconds": None if cpu is None else round(cpu, 3),
+            "cpu_percent": None if cpu is None else
+                           round(100 * cpu / wall, 1),
+            "maximum_rss_kb": rss,
+        }
+
+
+def load_results(path):
+    """return the stored results of path, oldest first"""
+    results = []
+    if os.path.exists(path):
+        with open(path) as results_file:
+            for line in results_file:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    log.error("skipping a broken line of %s" % path)
+    return results
+
+
+def store_result(path, result):
+    with open(path, "a") as results_file:
+        results_file.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+def report(result, previous=None):
+    """return the lines describing result, compared with previous"""
+    lines = ["revision %s, %s delivered of %s expected" % (
+        result["revision"], result["delivered"],
+        result["expected_deliveries"])]
+    if previous is not None:
+        lines.append("compared with revision %s of %s" % (
+            previous["revision"], previous["time"]))
+    for name, label in METRICS:
+        value = result.get(name)
+        line = "%-28s %12s" % (label, value)
+        old = previous.get(name) if previous is not None else None
+        if old and value is not None:
+            line += "  (%+.1f%% to %s)" % (100.0 * (value - old) / old, old)
+        lines.append(line)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="InstantSOUP benchmark")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds of workload (default: %(default)s)")
+    parser.add_argument("--say-rate", type=float, default=1.0,
+                        help="messages per client and second")
+    parser.add_argument("--invite-rate", type=float, default=0.0,
+                        help="invites per client and second")
+    parser.add_argument("--nick-rate", type=float, default=0.0,
+                        help="nickname changes per client and second")
+    parser.add_argument("--message-size", type=int, default=64,
+                        help="bytes per message (default: %(default)s)")
+    parser.add_argument("--codec", default=None,
+                        help="wire codec, 'fast' or 'construct'")
+    parser.add_argument("--port", type=int, default=server_start_port)
+    parser.add_argument("--server-process", action="store_true",
+                        help="run the server in a child process")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run a sharded server with this many workers")
+    parser.add_argument("--client-processes", type=int, default=0,
+                        help="spread the clients over this many processes, "
+                             "0 runs them in this process")
+    parser.add_argument("--results", default="benchmark-results.jsonl",
+                        help="file the results are appended to "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.INFO)
+
+    workload = Workload(args.clients, args.channels, args.duration,
+                        args.say_rate, args.invite_rate, args.nick_rate,
+                        args.message_size, args.codec, port=args.port)
+    benchmark = Benchmark(workload, args.server_process, args.workers,
+                          args.client_processes)
+    result = benchmark.run()
+
+    # the last run of the same workload, to spot regressions
+    previous = None
+    for stored in load_results(args.results):
+        if stored.get("workload") == result["workload"]:
+            previous = stored
+    store_result(args.results, result)
+
+    for line in report(result, previous):
+        print line
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,933 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Wire format of InstantSOUP.
+
+The ``construct`` structures in :class:`InstantSoupData` are the reference
+description of the protocol. Parsing them is slow, so the hot paths use
+:class:`FastCodec`, a hand-written encoder/decoder producing the same bytes.
+Both codecs share one interface and one data model:
+
+* a peer pdu is a tuple ``(peer_id, options)``
+* ``options`` is a list of ``(option_id, option_data)`` tuples
+* ``option_data`` depends on the option:
+
+  - CLIENT_NICK_OPTION: the nickname
+  - CLIENT_MEMBERSHIP_OPTION: a list of ``(server_id, channels)``
+  - SERVER_OPTION: the port
+  - SERVER_CHANNELS_OPTION: a list of channels
+  - SERVER_INVITE_OPTION: a tuple ``(channel_id, client_ids)``
+  - SERVER_FEATURES_OPTION: a list of protocol extensions of the server
+  - CLIENT_MEMBERSHIP_DELTA_OPTION: a tuple ``(version, added, removed)``,
+    both lists like the data of CLIENT_MEMBERSHIP_OPTION
+  - SERVER_CHANNELS_DELTA_OPTION: a tuple ``(version, added, removed)``,
+    both lists of channels
+  - SERVER_CHANNEL_GROUPS_OPTION: a list of ``(channel_id, address, port)``,
+    the multicast groups the messages of these channels are sent to
+  - SERVER_CHANNELS_PART_OPTION: a tuple ``(version, part, parts,
+    channels)``, part (from 0) of the parts of a channel list too long for
+    SERVER_CHANNELS_OPTION, all parts of a version make the full list
+
+* a delta option carries the changes of the full option since the last
+  version. Sent in the same pdu as the full option, with nothing added or
+  removed, it tells the version of that snapshot.
+
+* a command is the decoded command text, :class:`CommandFramer` cuts
+  commands out of a tcp stream
+* :class:`PduAssembler` packs the options a peer announces regularly into
+  as few datagrams as possible
+
+The codec is selected with :func:`get_codec`, either by name or through the
+``INSTANTSOUP_CODEC`` environment variable. Run this module to check the fast
+codec byte-for-byte against the ``construct`` structures.
+"""
+
+import os
+import struct
+
+from construct import Container, Enum, PrefixedArray, Struct, UBInt32
+from construct import UBInt16, UBInt8, OptionalGreedyRange, PascalString
+from construct import CString, Switch, Rename, core
+
+
+class InstantSoupData(object):
+
+    # common
+    server = Struct("server",
+                 CString("server_id"),
+                 PrefixedArray(CString('channels'),
+                     UBInt8("num_channels")
+                 )
+             )
+
+    # structures from rfc
+    opt_client_nick = CString('nickname')
+
+    opt_client_membership = PrefixedArray(server,
+                                 UBInt8("num_servers")
+                             )
+
+    opt_server = Struct("opt_server",
+                     UBInt16("port")
+                 )
+
+    opt_server_channels = Struct("opt_server_channels",
+                             PrefixedArray(CString("channels"),
+                                 UBInt8("num_channels"))
+                          )
+
+    opt_server_invite = Struct("opt_server_invite",
+                             CString("channel_id"),
+                             PrefixedArray(CString("client_id"),
+                                 UBInt8("num_clients")
+                             )
+                         )
+
+    # extension: sent after SERVER_OPTION, peers without it stop parsing here
+    opt_server_features = Struct("opt_server_features",
+                              PrefixedArray(CString("features"),
+                                  UBInt8("num_features"))
+                          )
+
+    # extension: changes of CLIENT_MEMBERSHIP_OPTION since the last version
+    opt_client_membership_delta = Struct("opt_client_membership_delta",
+                                      UBInt32("version"),
+                                      Rename("added", opt_client_membership),
+                                      Rename("removed", opt_client_membership)
+                                  )
+
+    # extension: changes of SERVER_CHANNELS_OPTION since the last version
+    opt_server_channels_delta = Struct("opt_server_channels_delta",
+                                    UBInt32("version"),
+                                    PrefixedArray(CString("added"),
+                                        UBInt8("num_added")),
+                                    PrefixedArray(CString("removed"),
+                                        UBInt8("num_removed"))
+                                )
+
+    # extension: the messages of these channels go to a multicast group too,
+    # as commands "SEQ\x00<server_id>\x00<channel_id>\x00<number>\x00<SAY>"
+    opt_server_channel_groups = Struct("opt_server_channel_groups",
+                                    PrefixedArray(Struct("groups",
+                                            CString("channel_id"),
+                                            CString("address"),
+                                            UBInt16("port")
+                                        ),
+                                        UBInt8("num_groups"))
+                                )
+
+    # extension: the parts of a SERVER_CHANNELS_OPTION with too many channels
+    opt_server_channels_part = Struct("opt_server_channels_part",
+                                   UBInt32("version"),
+                                   UBInt8("part"),
+                                   UBInt8("parts"),
+                                   PrefixedArray(CString("channels"),
+                                       UBInt8("num_channels"))
+                               )
+
+    # option fields
+    option = Struct("option",
+                 Enum(UBInt8("option_id"),
+                     CLIENT_NICK_OPTION=0x01,
+                     CLIENT_MEMBERSHIP_OPTION=0x02,
+                     CLIENT_MEMBERSHIP_DELTA_OPTION=0x03,
+                     SERVER_OPTION=0x10,
+                     SERVER_CHANNELS_OPTION=0x11,
+                     SERVER_INVITE_OPTION=0x12,
+                     SERVER_FEATURES_OPTION=0x13,
+                     SERVER_CHANNELS_DELTA_OPTION=0x14,
+                     SERVER_CHANNEL_GROUPS_OPTION=0x15,
+                     SERVER_CHANNELS_PART_OPTION=0x16
+                 ),
+                 Switch("option_data",
+                     lambda ctx: ctx["option_id"],
+                     {
+                     "CLIENT_NICK_OPTION": opt_client_nick,
+                     "CLIENT_MEMBERSHIP_OPTION": opt_client_membership,
+                     "SERVER_OPTION": opt_server,
+                     "SERVER_CHANNELS_OPTION": opt_server_channels,
+                     "SERVER_INVITE_OPTION": opt_server_invite,
+                     "SERVER_FEATURES_OPTION": opt_server_features,
+                     "CLIENT_MEMBERSHIP_DELTA_OPTION":
+                         opt_client_membership_delta,
+                     "SERVER_CHANNELS_DELTA_OPTION": opt_server_channels_delta,
+                     "SERVER_CHANNEL_GROUPS_OPTION": opt_server_channel_groups,
+                     "SERVER_CHANNELS_PART_OPTION": opt_server_channels_part
+                     }
+                 )
+             )
+
+    # the peer pdu itself
+    peer_pdu = Struct("peer_pdu",
+                   CString('id'),
+                   OptionalGreedyRange(option)
+               )
+
+    command = PascalString("command", length_field=UBInt32("length"),
+                           encoding='utf8')
+
+
+# mapping from option name to the option id on the wire (and back)
+OPTION_IDS = {
+    "CLIENT_NICK_OPTION": 0x01,
+    "CLIENT_MEMBERSHIP_OPTION": 0x02,
+    "CLIENT_MEMBERSHIP_DELTA_OPTION": 0x03,
+    "SERVER_OPTION": 0x10,
+    "SERVER_CHANNELS_OPTION": 0x11,
+    "SERVER_INVITE_OPTION": 0x12,
+    "SERVER_FEATURES_OPTION": 0x13,
+    "SERVER_CHANNELS_DELTA_OPTION": 0x14,
+    "SERVER_CHANNEL_GROUPS_OPTION": 0x15,
+    "SERVER_CHANNELS_PART_OPTION": 0x16,
+}
+
+OPTION_NAMES = dict((value, key) for key, value in OPTION_IDS.items())
+
+# lists in options are counted by an UBInt8, longer ones can't be built
+MAXIMUM_ENTRIES = 0xff
+
+# SERVER_FEATURES_OPTION: the server accepts commands of several channels on
+# one connection, tagged as "CHANNEL\x00<channel_id>\x00<command>"
+FEATURE_MULTIPLEX = "MUX"
+
+
+class CodecError(ValueError):
+    """raised if data cannot be parsed or built by a codec"""
+
+
+#
+# FAST CODEC
+#
+_ubint8 = struct.Struct(">B")
+_ubint16 = struct.Struct(">H")
+_ubint32 = struct.Struct(">I")
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return str(value)
+
+
+def _read_cstring(data, offset):
+    end = data.find("\x00", offset)
+    if end < 0:
+        raise CodecError("unterminated string at %i" % offset)
+    return data[offset:end], end + 1
+
+
+def _read_cstring_array(data, offset):
+    if offset >= len(data):
+        raise CodecError("missing array length at %i" % offset)
+    count = ord(data[offset])
+    offset += 1
+    items = []
+    for _ in xrange(count):
+        item, offset = _read_cstring(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _write_cstring_array(parts, items):
+    if len(items) > MAXIMUM_ENTRIES:
+        raise CodecError("too many entries: %i" % len(items))
+    parts.append(_ubint8.pack(len(items)))
+    for item in items:
+        parts.append(_bytes(item))
+        parts.append("\x00")
+
+
+def _parse_client_nick(data, offset):
+    return _read_cstring(data, offset)
+
+
+def _parse_client_membership(data, offset):
+    if offset >= len(data):
+        raise CodecError("missing array length at %i" % offset)
+    count = ord(data[offset])
+    offset += 1
+    servers = []
+    for _ in xrange(count):
+        server_id, offset = _read_cstring(data, offset)
+        channels, offset = _read_cstring_array(data, offset)
+        servers.append((server_id, channels))
+    return servers, offset
+
+
+def _parse_server(data, offset):
+    if offset + 2 > len(data):
+        raise CodecError("missing port at %i" % offset)
+    return _ubint16.unpack_from(data, offset)[0], offset + 2
+
+
+def _parse_server_invite(data, offset):
+    channel_id, offset = _read_cstring(data, offset)
+    client_ids, offset = _read_cstring_array(data, offset)
+    return (channel_id, client_ids), offset
+
+
+def _parse_version(data, offset):
+    if offset + 4 > len(data):
+        raise CodecError("missing version at %i" % offset)
+    return _ubint32.unpack_from(data, offset)[0], offset + 4
+
+
+def _parse_client_membership_delta(data, offset):
+    version, offset = _parse_version(data, offset)
+    added, offset = _parse_client_membership(data, offset)
+    removed, offset = _parse_client_membership(data, offset)
+    return (version, added, removed), offset
+
+
+def _parse_server_channels_delta(data, offset):
+    version, offset = _parse_version(data, offset)
+    added, offset = _read_cstring_array(data, offset)
+    removed, offset = _read_cstring_array(data, offset)
+    return (version, added, removed), offset
+
+
+def _parse_server_channel_groups(data, offset):
+    if offset >= len(data):
+        raise CodecError("missing array length at %i" % offset)
+    count = ord(data[offset])
+    offset += 1
+    groups = []
+    for _ in xrange(count):
+        channel_id, offset = _read_cstring(data, offset)
+        address, offset = _read_cstring(data, offset)
+        port, offset = _parse_server(data, offset)
+        groups.append((channel_id, address, port))
+    return groups, offset
+
+
+def _parse_server_channels_part(data, offset):
+    version, offset = _parse_version(data, offset)
+    if offset + 2 > len(data):
+        raise CodecError("missing part at %i" % offset)
+    part, parts = ord(data[offset]), ord(data[offset + 1])
+    channels, offset = _read_cstring_array(data, offset + 2)
+    return (version, part, parts, channels), offset
+
+
+def _build_client_nick(parts, nickname):
+    parts.append(_bytes(nickname))
+    parts.append("\x00")
+
+
+def _build_client_membership(parts, servers):
+    if len(servers) > MAXIMUM_ENTRIES:
+        raise CodecError("too many servers: %i" % len(servers))
+    parts.append(_ubint8.pack(len(servers)))
+    for server_id, channels in servers:
+        parts.append(_bytes(server_id))
+        parts.append("\x00")
+        _write_cstring_array(parts, channels)
+
+
+def _build_server(parts, port):
+    parts.append(_ubint16.pack(port))
+
+
+def _build_client_membership_delta(parts, delta):
+    version, added, removed = delta
+    parts.append(_ubint32.pack(version))
+    _build_client_membership(parts, added)
+    _build_client_membership(parts, removed)
+
+
+def _build_server_channels_delta(parts, delta):
+    version, added, removed = delta
+    parts.append(_ubint32.pack(version))
+    _write_cstring_array(parts, added)
+    _write_cstring_array(parts, removed)
+
+
+def _build_server_channel_groups(parts, groups):
+    if len(groups) > MAXIMUM_ENTRIES:
+        raise CodecError("too many groups: %i" % len(groups))
+    parts.append(_ubint8.pack(len(groups)))
+    for channel_id, address, port in groups:
+        parts.append(_bytes(channel_id))
+        parts.append("\x00")
+        parts.append(_bytes(address))
+        parts.append("\x00")
+        parts.append(_ubint16.pack(port))
+
+
+def _build_server_channels_part(parts, option_data):
+    version, part, count, channels = option_data
+    if not 0 <= part < count <= 0xff:
+        raise CodecError("invalid part %i of %i" % (part, count))
+    parts.append(_ubint32.pack(version))
+    parts.append(_ubint8.pack(part))
+    parts.append(_ubint8.pack(count))
+    _write_cstring_array(parts, channels)
+
+
+def _build_server_invite(parts, invite):
+    channel_id, client_ids = invite
+    parts.append(_bytes(channel_id))
+    parts.append("\x00")
+    _write_cstring_array(parts, client_ids)
+
+
+class FastCodec(object):
+    """
+    hand-written codec, produces the same bytes as :class:`ConstructCodec`
+    """
+
+    name = "fast"
+
+    # mapping from option id on the wire to (option name, parse function)
+    parsers = {
+        0x01: ("CLIENT_NICK_OPTION", _parse_client_nick),
+        0x02: ("CLIENT_MEMBERSHIP_OPTION", _parse_client_membership),
+        0x03: ("CLIENT_MEMBERSHIP_DELTA_OPTION",
+               _parse_client_membership_delta),
+        0x10: ("SERVER_OPTION", _parse_server),
+        0x11: ("SERVER_CHANNELS_OPTION", _read_cstring_array),
+        0x12: ("SERVER_INVITE_OPTION", _parse_server_invite),
+        0x13: ("SERVER_FEATURES_OPTION", _read_cstring_array),
+        0x14: ("SERVER_CHANNELS_DELTA_OPTION", _parse_server_channels_delta),
+        0x15: ("SERVER_CHANNEL_GROUPS_OPTION", _parse_server_channel_groups),
+        0x16: ("SERVER_CHANNELS_PART_OPTION", _parse_server_channels_part),
+    }
+
+    # mapping from option name to (option id byte, build function)
+    builders = {
+        "CLIENT_NICK_OPTION": ("\x01", _build_client_nick),
+        "CLIENT_MEMBERSHIP_OPTION": ("\x02", _build_client_membership),
+        "CLIENT_MEMBERSHIP_DELTA_OPTION": ("\x03",
+                                           _build_client_membership_delta),
+        "SERVER_OPTION": ("\x10", _build_server),
+        "SERVER_CHANNELS_OPTION": ("\x11", _write_cstring_array),
+        "SERVER_INVITE_OPTION": ("\x12", _build_server_invite),
+        "SERVER_FEATURES_OPTION": ("\x13", _write_cstring_array),
+        "SERVER_CHANNELS_DELTA_OPTION": ("\x14",
+                                         _build_server_channels_delta),
+        "SERVER_CHANNEL_GROUPS_OPTION": ("\x15",
+                                         _build_server_channel_groups),
+        "SERVER_CHANNELS_PART_OPTION": ("\x16", _build_server_channels_part),
+    }
+
+    def parse_pdu(self, data):
+        data = str(data)
+        peer_id, offset = _read_cstring(data, 0)
+        options = []
+        length = len(data)
+
+        # like OptionalGreedyRange: stop at the first option we can't parse
+        while offset < length:
+            try:
+                option_id, parse = self.parsers[ord(data[offset])]
+                option_data, offset = parse(data, offset + 1)
+            except (KeyError, CodecError):
+                break
+            options.append((option_id, option_data))
+        return peer_id, options
+
+    def build_pdu(self, peer_id, options):
+        parts = [_bytes(peer_id), "\x00"]
+        for option_id, option_data in options:
+            try:
+                option_byte, build = self.builders[option_id]
+            except KeyError:
+                raise CodecError("unknown option %r" % (option_id,))
+            parts.append(option_byte)
+            build(parts, option_data)
+        return "".join(parts)
+
+    def parse_command(self, data):
+        data = str(data)
+        if len(data) < 4:
+            raise CodecError("missing command length")
+        length = _ubint32.unpack_from(data, 0)[0]
+        if len(data) < 4 + length:
+            raise CodecError("expected %i bytes, found %i" %
+                             (length, len(data) - 4))
+        return data[4:4 + length].decode("utf8")
+
+    def build_command(self, text):
+        data = _bytes(text)
+        return _ubint32.pack(len(data)) + data
+
+
+#
+# CONSTRUCT CODEC (REFERENCE)
+#
+class ConstructCodec(object):
+    """
+    codec using the ``construct`` structures of :class:`InstantSoupData`
+    """
+
+    name = "construct"
+
+    def parse_pdu(self, data):
+        try:
+            packet = InstantSoupData.peer_pdu.parse(data)
+        except core.ConstructError as error:
+            raise CodecError(str(error))
+        options = []
+        for option in packet["option"]:
+            option_id = option["option_id"]
+            option_data = option["option_data"]
+            if option_id == "CLIENT_MEMBERSHIP_OPTION":
+                option_data = [(server["server_id"], list(server["channels"]))
+                               for server in option_data]
+            elif option_id == "SERVER_OPTION":
+                option_data = option_data["port"]
+            elif option_id == "SERVER_CHANNELS_OPTION":
+                option_data = list(option_data["channels"])
+            elif option_id == "SERVER_INVITE_OPTION":
+                option_data = (option_data["channel_id"],
+                               list(option_data["client_id"]))
+            elif option_id == "SERVER_FEATURES_OPTION":
+                option_data = list(option_data["features"])
+            elif option_id == "CLIENT_MEMBERSHIP_DELTA_OPTION":
+                option_data = (option_data["version"],
+                               [(server["server_id"], list(server["channels"]))
+                                for server in option_data["added"]],
+                               [(server["server_id"], list(server["channels"]))
+                                for server in option_data["removed"]])
+            elif option_id == "SERVER_CHANNELS_DELTA_OPTION":
+                option_data = (option_data["version"],
+                               list(option_data["added"]),
+                               list(option_data["removed"]))
+            elif option_id == "SERVER_CHANNEL_GROUPS_OPTION":
+                option_data = [(group["channel_id"], group["address"],
+                                group["port"])
+                               for group in option_data["groups"]]
+            elif option_id == "SERVER_CHANNELS_PART_OPTION":
+                option_data = (option_data["version"], option_data["part"],
+                               option_data["parts"],
+                               list(option_data["channels"]))
+            options.append((option_id, option_data))
+        return packet["id"], options
+
+    def build_pdu(self, peer_id, options):
+        containers = []
+        for option_id, option_data in options:
+            if option_id == "CLIENT_MEMBERSHIP_OPTION":
+                option_data = [Container(server_id=server_id,
+                                         channels=channels)
+                               for server_id, channels in option_data]
+            elif option_id == "SERVER_OPTION":
+                option_data = Container(port=option_data)
+            elif option_id == "SERVER_CHANNELS_OPTION":
+                option_data = Container(channels=option_data)
+            elif option_id == "SERVER_INVITE_OPTION":
+                channel_id, client_ids = option_data
+                option_data = Container(channel_id=channel_id,
+                                        client_id=client_ids)
+            elif option_id == "SERVER_FEATURES_OPTION":
+                option_data = Container(features=option_data)
+            elif option_id == "CLIENT_MEMBERSHIP_DELTA_OPTION":
+                version, added, removed = option_data
+                option_data = Container(
+                    version=version,
+                    added=[Container(server_id=server_id, channels=channels)
+                           for server_id, channels in added],
+                    removed=[Container(server_id=server_id, channels=channels)
+                             for server_id, channels in removed])
+            elif option_id == "SERVER_CHANNELS_DELTA_OPTION":
+                version, added, removed = option_data
+                option_data = Container(version=version, added=added,
+                                        removed=removed)
+            elif option_id == "SERVER_CHANNEL_GROUPS_OPTION":
+                option_data = Container(groups=[
+                    Container(channel_id=channel_id, address=address,
+                              port=port)
+                    for channel_id, address, port in option_data])
+            elif option_id == "SERVER_CHANNELS_PART_OPTION":
+                version, part, parts, channels = option_data
+                option_data = Container(version=version, part=part,
+                                        parts=parts, channels=channels)
+            containers.append(Container(option_id=option_id,
+                                        option_data=option_data))
+        try:
+            return InstantSoupData.peer_pdu.build(Container(id=peer_id,
+                                                            option=containers))
+        except (core.ConstructError, struct.error) as error:
+            raise CodecError(str(error))
+
+    def parse_command(self, data):
+        try:
+            return InstantSoupData.command.parse(data)
+        except core.ConstructError as error:
+            raise CodecError(str(error))
+
+    def build_command(self, text):
+        try:
+            return InstantSoupData.command.build(text)
+        except core.ConstructError as error:
+            raise CodecError(str(error))
+
+
+CODECS = {
+    FastCodec.name: FastCodec(),
+    ConstructCodec.name: ConstructCodec(),
+}
+
+DEFAULT_CODEC = os.environ.get("INSTANTSOUP_CODEC", FastCodec.name)
+
+
+def get_codec(name=None):
+    """return the codec called name, or the default codec"""
+    if name is None:
+        name = DEFAULT_CODEC
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("unknown codec %r, expected one of %s" %
+                         (name, ", ".join(sorted(CODECS))))
+
+
+#
+# STREAM FRAMING
+#
+def command_name(command):
+    """return the name of command, the part before its first NUL"""
+    end = command.find("\x00")
+    if end < 0:
+        return command
+    return command[:end]
+
+
+class CommandFramer(object):
+    """
+    reassembles length-prefixed commands from a tcp byte stream
+
+    Every :meth:`feed` returns all commands completed by the new data, a
+    partial command stays buffered until the next call. Frames are located
+    in place, the consumed prefix of the buffer is dropped once per call.
+    """
+
+    # commands longer than this are treated as a broken stream
+    MAXIMUM_COMMAND_LENGTH = 1 << 24
+
+    def __init__(self, maximum_length=MAXIMUM_COMMAND_LENGTH):
+        self.maximum_length = maximum_length
+        self.buffer = bytearray()
+
+        # number of frames that were dropped, because they were no utf8
+        self.errors = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer.extend(data)
+
+        commands = []
+        offset = 0
+        available = len(buffer)
+        while available - offset >= 4:
+            length = _ubint32.unpack_from(buffer, offset)[0]
+            if length > self.maximum_length:
+                raise CodecError("command length %i exceeds %i" %
+                                 (length, self.maximum_length))
+            end = offset + 4 + length
+            if end > available:
+                break
+            try:
+                commands.append(buffer[offset + 4:end].decode("utf8"))
+            except UnicodeDecodeError:
+                self.errors += 1
+            offset = end
+
+        if offset:
+            del buffer[:offset]
+        return commands
+
+    def __len__(self):
+        """number of buffered bytes"""
+        return len(self.buffer)
+
+
+#
+# PDU ASSEMBLY
+#
+
+# stay below the ethernet mtu, so datagrams are not fragmented
+MAXIMUM_PDU_LENGTH = 1400
+
+
+def split_entries(items, maximum_length=MAXIMUM_PDU_LENGTH // 2):
+    """
+    split a list of strings into lists of at most MAXIMUM_ENTRIES strings,
+    which take at most maximum_length bytes encoded, unless a single string
+    is longer; an empty list gives no lists
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for item in items:
+        length = len(_bytes(item)) + 1
+        if chunk and (len(chunk) == MAXIMUM_ENTRIES or
+                      size + length > maximum_length):
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(item)
+        size += length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def option_name(key):
+    """the option id of a key of PduAssembler, see :meth:`PduAssembler.set`"""
+    return key[0] if isinstance(key, tuple) else key
+
+
+def option_order(key):
+    """sort key for keys of PduAssembler, by option id, then part"""
+    return OPTION_IDS[option_name(key)], key
+
+
+class PduAssembler(object):
+    """
+    packs the options of one peer into as few pdus as possible
+
+    Options are stored with :meth:`set` and encoded only when their data
+    changes. :meth:`datagrams` keeps the options in the requested order and
+    starts a new pdu whenever the next option would exceed ``maximum_length``.
+    An option that is bigger on its own gets a pdu of its own. The result is
+    cached until one of its options changes.
+
+    An option sent several times, like the parts of a long list, is stored
+    once per part with a key ``(option_id, index)`` instead of the option_id.
+    """
+
+    def __init__(self, codec, peer_id, maximum_length=MAXIMUM_PDU_LENGTH):
+        self.codec = codec
+        self.peer_id = peer_id
+        self.maximum_length = maximum_length
+        self.header = codec.build_pdu(peer_id, [])
+
+        # mapping from (option_id) to (option_data, encoded option)
+        self.options = {}
+
+        # mapping from a tuple of (option_id) to the results of datagrams
+        # and pdus
+        self.cache = {}
+
+    def set(self, option_id, option_data):
+        """store option, returns True if it changed"""
+        entry = self.options.get(option_id)
+        if entry is not None and entry[0] == option_data:
+            return False
+
+        # every pdu starts with the same header, the option follows it
+        data = self.codec.build_pdu(self.peer_id,
+                                    [(option_name(option_id), option_data)])
+        self.options[option_id] = (option_data, data[len(self.header):])
+        self._invalidate(option_id)
+        return True
+
+    def discard(self, option_id):
+        """forget option, it won't be sent anymore"""
+        if self.options.pop(option_id, None) is not None:
+            self._invalidate(option_id)
+
+    def _invalidate(self, option_id):
+        for option_ids in list(self.cache):
+            if option_id in option_ids:
+                del self.cache[option_ids]
+
+    def datagrams(self, option_ids):
+        """return the pdus carrying option_ids, unknown ones are skipped"""
+        return self._assemble(option_ids)[0]
+
+    def pdus(self, option_ids):
+        """like :meth:`datagrams`, as (option ids in the pdu, datagram)"""
+        return self._assemble(option_ids)[1]
+
+    def _assemble(self, option_ids):
+        option_ids = tuple(option_id for option_id in option_ids
+                           if option_id in self.options)
+        if option_ids in self.cache:
+            return self.cache[option_ids]
+
+        pdus = []
+        parts = [self.header]
+        names = []
+        size = len(self.header)
+        for option_id in option_ids:
+            encoded = self.options[option_id][1]
+            if len(parts) > 1 and size + len(encoded) > self.maximum_length:
+                pdus.append((names, "".join(parts)))
+                parts = [self.header]
+                names = []
+                size = len(self.header)
+            parts.append(encoded)
+            names.append(option_name(option_id))
+            size += len(encoded)
+        if len(parts) > 1:
+            pdus.append((names, "".join(parts)))
+
+        result = [datagram for _, datagram in pdus], pdus
+        self.cache[option_ids] = result
+        return result
+
+
+#
+# VERIFICATION
+#
+SAMPLE_PDUS = [
+    ("", []),
+    ("5b1c7a3e-0000-11e1-8000-000000000000", []),
+    ("client", [("CLIENT_NICK_OPTION", "Telematik")]),
+    ("client", [("CLIENT_NICK_OPTION", "")]),
+    ("client", [("CLIENT_MEMBERSHIP_OPTION", [])]),
+    ("client", [("CLIENT_MEMBERSHIP_OPTION",
+                 [("server-a", ["lobby", "kit"]), ("server-b", [])])]),
+    ("server", [("SERVER_OPTION", 49190)]),
+    ("server", [("SERVER_OPTION", 0)]),
+    ("server", [("SERVER_OPTION", 0xffff)]),
+    ("server", [("SERVER_CHANNELS_OPTION", [])]),
+    ("server", [("SERVER_CHANNELS_OPTION",
+                 ["channel%i" % i for i in range(0xff)])]),
+    ("server", [("SERVER_INVITE_OPTION", ("@private", ["alice", "bob"]))]),
+    ("server", [("SERVER_OPTION", 49191),
+                ("SERVER_CHANNELS_OPTION", ["lobby"]),
+                ("SERVER_INVITE_OPTION", ("@p", []))]),
+    ("client", [("CLIENT_NICK_OPTION", "Susan"),
+                ("CLIENT_MEMBERSHIP_OPTION", [("s", ["a"])])]),
+    ("server", [("SERVER_OPTION", 49190),
+                ("SERVER_FEATURES_OPTION", [FEATURE_MULTIPLEX])]),
+    ("client", [("CLIENT_MEMBERSHIP_DELTA_OPTION", (0, [], []))]),
+    ("client", [("CLIENT_MEMBERSHIP_OPTION", [("s", ["a", "b"])]),
+                ("CLIENT_MEMBERSHIP_DELTA_OPTION",
+                 (0xffffffff, [("s", ["b"]), ("t", [])], [("u", ["c"])]))]),
+    ("server", [("SERVER_CHANNELS_DELTA_OPTION", (7, ["new"], []))]),
+    ("server", [("SERVER_CHANNELS_OPTION", ["lobby"]),
+                ("SERVER_CHANNELS_DELTA_OPTION", (1, [], ["old", "older"]))]),
+    ("server", [("SERVER_CHANNEL_GROUPS_OPTION", [])]),
+    ("server", [("SERVER_OPTION", 49190),
+                ("SERVER_FEATURES_OPTION", [FEATURE_MULTIPLEX]),
+                ("SERVER_CHANNEL_GROUPS_OPTION",
+                 [("lobby", "239.255.12.34", 55556), ("kit", "", 0)])]),
+    ("server", [("SERVER_CHANNELS_PART_OPTION", (3, 0, 1, []))]),
+    ("server", [("SERVER_OPTION", 49190),
+                ("SERVER_CHANNELS_PART_OPTION",
+                 (0xffffffff, 1, 2, ["channel%i" % i for i in range(0xff)]))]),
+]
+
+SAMPLE_COMMANDS = [
+    u"",
+    u"EXIT",
+    u"JOIN\x00lobby",
+    u"SAY\x00hello world",
+    u"SAY\x00client\x00gr\xfc\xdfe ☺\x00",
+    u"INVITE\x00alice\x00bob",
+    u"CHANNEL\x00lobby\x00SAY\x00client\x00hi\x00",
+    u"SEQ\x00server\x00lobby\x0042\x00SAY\x00client\x00hi\x00",
+    u"SAY\x00" + u"x" * 70000,
+]
+
+SAMPLE_DATAGRAMS = [
+    "client\x00\x01Bob",
+    "client\x00\x99garbage",
+    "client\x00\x01Bob\x00\x10\x01",
+    "client\x00\x02\x02s\x00\x01a\x00",
+    "client\x00\x11\x03a\x00b\x00",
+    "client\x00\x12chan\x00",
+    "client\x00\x01Bob\x00trailing",
+]
+
+
+def verify():
+    """
+    check the fast codec byte-for-byte against the construct structures,
+    raises AssertionError on the first difference
+    """
+    fast = CODECS[FastCodec.name]
+    reference = CODECS[ConstructCodec.name]
+
+    for peer_id, options in SAMPLE_PDUS:
+        data = reference.build_pdu(peer_id, options)
+        assert fast.build_pdu(peer_id, options) == data, (peer_id, options)
+        assert fast.parse_pdu(data) == reference.parse_pdu(data), data
+        assert fast.parse_pdu(data) == (peer_id, options), data
+
+        # every truncation must parse the same way (or fail in both)
+        for end in range(len(data)):
+            assert _outcome(fast.parse_pdu, data[:end]) == \
+                   _outcome(reference.parse_pdu, data[:end]), data[:end]
+
+    for datagram in SAMPLE_DATAGRAMS:
+        assert _outcome(fast.parse_pdu, datagram) == \
+               _outcome(reference.parse_pdu, datagram), datagram
+
+    for text in SAMPLE_COMMANDS:
+        data = reference.build_command(text)
+        assert fast.build_command(text) == data, text
+        assert fast.parse_command(data) == reference.parse_command(data)
+        assert fast.parse_command(data + "tail") == text
+        for end in (0, 3, 4, len(data) - 1):
+            assert _outcome(fast.parse_command, data[:end]) == \
+                   _outcome(reference.parse_command, data[:end])
+
+    # split and merged commands must come out of the framer unchanged
+    stream = "".join(fast.build_command(text) for text in SAMPLE_COMMANDS)
+    for size in (1, 3, 7, 4096, len(stream)):
+        framer = CommandFramer()
+        commands = []
+        for start in range(0, len(stream), size):
+            commands.extend(framer.feed(stream[start:start + size]))
+        assert commands == SAMPLE_COMMANDS, size
+        assert len(framer) == 0, size
+    framer = CommandFramer()
+    assert framer.feed(stream[:-1]) == SAMPLE_COMMANDS[:-1]
+    assert framer.feed(stream[-1:]) == SAMPLE_COMMANDS[-1:]
+    assert framer.feed("\x00\x00\x00\x01\xff") == [] and framer.errors == 1
+    assert _outcome(CommandFramer(16).feed, "\x00\x00\x01\x00") is CodecError
+
+    # assembled pdus carry the options in order, split where they must be
+    options = SAMPLE_PDUS[12][1] + SAMPLE_PDUS[14][1][1:]
+    option_ids = [option_id for option_id, _ in options]
+    for maximum_length in (1, 64, MAXIMUM_PDU_LENGTH):
+        assembler = PduAssembler(fast, "server", maximum_length)
+        for option_id, option_data in options:
+            assert assembler.set(option_id, option_data)
+            assert not assembler.set(option_id, option_data)
+        datagrams = assembler.datagrams(option_ids)
+        assert assembler.datagrams(option_ids) is datagrams
+        assert assembler.pdus(option_ids) == [
+            ([option_id for option_id, _ in reference.parse_pdu(datagram)[1]],
+             datagram) for datagram in datagrams]
+        parsed = [reference.parse_pdu(datagram) for datagram in datagrams]
+        assert sum([pdu_options for _, pdu_options in parsed], []) == options
+        for datagram, (peer_id, pdu_options) in zip(datagrams, parsed):
+            assert peer_id == "server"
+            assert len(datagram) <= maximum_length or len(pdu_options) == 1
+    assert len(datagrams) == 1
+    assembler.set("SERVER_OPTION", 1)
+    assembler.discard("SERVER_INVITE_OPTION")
+    assert fast.parse_pdu(assembler.datagrams(option_ids)[0])[1] == \
+           [("SERVER_OPTION", 1)] + options[1:2] + options[3:]
+    assert assembler.datagrams(["SERVER_INVITE_OPTION"]) == []
+
+    # construct silently truncates options it can't build, we refuse them
+    for options in ([("SERVER_CHANNELS_OPTION", ["c"] * 0x100)],
+                    [("UNKNOWN_OPTION", None)]):
+        assert _outcome(fast.build_pdu, "id", options) is CodecError, options
+
+
+def _outcome(function, *args):
+    try:
+        return function(*args)
+    except CodecError:
+        return CodecError
+
+
+if __name__ == '__main__':
+    import timeit
+
+    verify()
+    print "fast codec and framer match the construct structures"
+
+    data = CODECS[FastCodec.name].build_pdu(*SAMPLE_PDUS[12])
+    for name in sorted(CODECS):
+        timer = timeit.Timer(lambda: CODECS[name].parse_pdu(data))
+        print "%-10s %8.1f us per parse_pdu" % (
+            name, min(timer.repeat(3, 1000)) * 1000)
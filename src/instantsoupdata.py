@@ -2,16 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 import uuid
-import copy
 import traceback
 
 
-from construct import Container, Enum, PrefixedArray, Struct, UBInt32
-from construct import UBInt16, UBInt8, OptionalGreedyRange, PascalString, ULInt16
-from construct import CString, Switch, core
 from PyQt4 import QtCore, QtNetwork
-from collections import defaultdict
+from collections import defaultdict, deque
+from instantsoupcodec import CodecError, CommandFramer
+from instantsoupcodec import get_codec, FEATURE_MULTIPLEX, PduAssembler
+from instantsoupcodec import OPTION_IDS, MAXIMUM_PDU_LENGTH, command_name
+from instantsoupcodec import MAXIMUM_ENTRIES
+from instantsouputil import OutboundQueue, ServerLookup
+from instantsouputil import LivenessTracker, HistoryStore
+from instantsouputil import ChangeSet, AnnouncementSchedule, CommandQueue
+from instantsouputil import SequenceBuffer
+from instantsouplog import get_chat_log
+from instantsoupmetrics import Metrics, measured, http_response
+from instantsoupmetrics import DEFAULT_METRICS_LOG_TIME
+from instantsoupprotocol import ServerProtocol
 
 log = logging.getLogger("instantsoup")
 log.setLevel(logging.DEBUG)
@@ -22,68 +31,141 @@ broadcast_port = 55555
 server_start_port = 49190
 
 
-class InstantSoupData(object):
-
-    # common
-    server = Struct("server",
-                 CString("server_id"),
-                 PrefixedArray(CString('channels'),
-                     UBInt8("num_channels")
-                 )
-             )
-
-    # structures from rfc
-    opt_client_nick = CString('nickname')
-
-    opt_client_membership = PrefixedArray(server,
-                                 UBInt8("num_servers")
-                             )
-
-    opt_server = Struct("opt_server",
-                     UBInt16("port")
-                 )
-
-    opt_server_channels = Struct("opt_server_channels",
-                             PrefixedArray(CString("channels"),
-                                 UBInt8("num_channels"))
-                          )
-
-    opt_server_invite = Struct("opt_server_invite",
-                             CString("channel_id"),
-                             PrefixedArray(CString("client_id"),
-                                 UBInt8("num_clients")
-                             )
-                         )
-
-    # option fields
-    option = Struct("option",
-                 Enum(UBInt8("option_id"),
-                     CLIENT_NICK_OPTION=0x01,
-                     CLIENT_MEMBERSHIP_OPTION=0x02,
-                     SERVER_OPTION=0x10,
-                     SERVER_CHANNELS_OPTION=0x11,
-                     SERVER_INVITE_OPTION=0x12
-                 ),
-                 Switch("option_data",
-                     lambda ctx: ctx["option_id"],
-                     {
-                     "CLIENT_NICK_OPTION": opt_client_nick,
-                     "CLIENT_MEMBERSHIP_OPTION": opt_client_membership,
-                     "SERVER_OPTION": opt_server,
-                     "SERVER_CHANNELS_OPTION": opt_server_channels,
-                     "SERVER_INVITE_OPTION": opt_server_invite
-                     }
-                 )
-             )
-
-    # the peer pdu itself
-    peer_pdu = Struct("peer_pdu",
-                   CString('id'),
-                   OptionalGreedyRange(option)
-               )
-
-    command = PascalString("command", length_field=UBInt32("length"),
-                           encoding='utf8')
+# turn (server_id, channel_id) keys into option data of
+# CLIENT_MEMBERSHIP_OPTION, a list of (server_id, channels), cut to the
+# MAXIMUM_ENTRIES an option can carry
+def _group_by_server(keys):
+    server_channels = defaultdict(list)
+    for server_id, channel_id in keys:
+        server_channels[server_id].append(channel_id)
+    return sorted((server_id, sorted(channels)[:MAXIMUM_ENTRIES])
+                  for server_id, channels in server_channels.items()
+                  )[:MAXIMUM_ENTRIES]
+
+
+class DiscoveryBus(QtCore.QObject):
+    """
+    the multicast socket of a process, shared by its Clients and Servers
+
+    Every datagram is parsed once and handed to the registered peers as
+    ``(peer_id, options, address)``, except to the peer that sent it. The
+    pdus the peers announce wait until the event loop is idle, then
+    consecutive pdus of one peer are merged into one datagram, as long as
+    it fits and keeps the options sorted by id (see Server.send_options).
+    """
+
+    MAXIMUM_DATAGRAM_LENGTH = 10000
+
+    def __init__(self, codec=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+
+        # encoder/decoder for pdus (see instantsoupcodec)
+        self.codec = get_codec(codec)
+
+        # counters and timings (see instantsoupmetrics)
+        self.metrics = Metrics("instantsoup_discovery")
+
+        # mapping from (peer_id) to the function taking the pdus of the others
+        self.consumers = {}
+
+        # pdus waiting for the event loop, as (peer_id, option_ids, datagram)
+        self.outgoing = []
+        self.flush_timer = QtCore.QTimer()
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.timeout.connect(self.flush)
+
+        self.udp_socket = QtNetwork.QUdpSocket()
+        self.udp_socket.bind(broadcast_port,
+                             QtNetwork.QUdpSocket.ReuseAddressHint)
+        self.udp_socket.joinMulticastGroup(group_address_ip4)
+        self.udp_socket.joinMulticastGroup(group_address_ip6)
+
+        # connect the socket input with the processing function
+        self.udp_socket.readyRead.connect(self.process_pending_datagrams)
+
+        self.metrics.gauge("consumers", lambda: len(self.consumers))
+
+    def register(self, peer_id, consumer):
+        """call consumer(peer_id, options, address) for the others' pdus"""
+        self.consumers[peer_id] = consumer
+
+    def unregister(self, peer_id):
+        self.consumers.pop(peer_id, None)
+
+    @measured
+    def process_pending_datagrams(self):
+        while self.udp_socket.hasPendingDatagrams():
+            (data, address, _) = self.udp_socket.readDatagram(
+                self.MAXIMUM_DATAGRAM_LENGTH)
+            self.metrics.count("datagrams_received_total")
+            try:
+                with self.metrics.time("parse_seconds", kind="pdu"):
+                    peer_id, options = self.codec.parse_pdu(data)
+            except CodecError:
+                log.debug("invalid pdu from %s" % address.toString())
+                self.metrics.count("parse_errors_total", kind="pdu")
+                continue
+
+            # the sender knows its own pdu
+            for consumer_id, consumer in self.consumers.items():
+                if consumer_id != peer_id:
+                    consumer(peer_id, options, address)
+
+    def announce(self, datagram, peer_id, option_ids):
+        """
+        send the pdu of peer_id with option_ids to the discovery groups, once
+        the event loop is idle
+        """
+        entry = (peer_id, list(option_ids), datagram)
+        if entry not in self.outgoing:
+            self.outgoing.append(entry)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start(0)
+
+    def flush(self):
+        merged = []
+        for peer_id, option_ids, datagram in self.outgoing:
+            if merged and self._mergeable(merged[-1], peer_id, option_ids,
+                                          datagram):
+                _, merged_ids, merged_datagram = merged[-1]
+                header = datagram.index("\x00") + 1
+                merged[-1] = (peer_id, merged_ids + option_ids,
+                              merged_datagram + datagram[header:])
+            else:
+                merged.append((peer_id, option_ids, datagram))
+        self.metrics.count("pdus_merged_total",
+                           len(self.outgoing) - len(merged))
+        self.outgoing = []
+
+        for _, _, datagram in merged:
+            self.send_datagram(datagram, group_address_ip4, broadcast_port)
+            self.send_datagram(datagram, group_address_ip6, broadcast_port)
+
+    @staticmethod
+    def _mergeable(previous, peer_id, option_ids, datagram):
+        previous_peer_id, previous_ids, previous_datagram = previous
+        header = datagram.index("\x00") + 1
+        return previous_peer_id == peer_id and previous_ids and option_ids \
+            and OPTION_IDS[previous_ids[-1]] <= OPTION_IDS[option_ids[0]] \
+            and len(previous_datagram) + len(datagram) - header <= \
+                MAXIMUM_PDU_LENGTH
+
+    def send_datagram(self, datagram, address, port):
+        """send datagram right away"""
+        self.udp_socket.writeDatagram(datagram, address, port)
+        self.metrics.count("datagrams_sent_total")
+
+
+# the discovery bus of this process, see get_discovery_bus
+_discovery_bus = None
+
+
+def get_discovery_bus():
+    """return the discovery bus of this process, create it on first use"""
+    global _discovery_bus
+    if _discovery_bus is None:
+        _discovery_bus = DiscoveryBus()
+    return _discovery_bus
 
 
 class Client(QtCore.QObject):
@@ -93,8 +175,39 @@ class Client(QtCore.QObject):
 
     DEFAULT_TIMEOUT_TIME = 2 * REGULAR_PDU_WAITING_TIME + DEFAULT_WAITING_TIME
 
+    # beyond this many peers the announcement interval (and the timeout)
+    # grows with the lobby, see AnnouncementSchedule
+    ANNOUNCEMENT_PEERS = 50
+    ANNOUNCEMENT_JITTER = 0.2
+
     MAXIMUM_DATAGRAM_LENGTH = 10000
 
+    # messages kept per channel, older ones are dropped
+    HISTORY_MAXIMUM_ENTRIES = 1000
+    HISTORY_MAXIMUM_BYTES = 1 << 20
+
+    # connects in progress at once, the others wait in line
+    MAXIMUM_PENDING_CONNECTS = 4
+
+    # a failed connect is retried after 0.5s, 1s, 2s, ... up to this many times
+    MAXIMUM_CONNECT_ATTEMPTS = 5
+    CONNECT_RETRY_TIME = 500
+
+    # messages missing in a multicast group are waited for this many ms,
+    # then skipped
+    GAP_WAITING_TIME = 1000
+
+    # log the metrics every this many ms, 0 never
+    METRICS_LOG_TIME = DEFAULT_METRICS_LOG_TIME
+
+    # changes are collected for this long (0: until the event loop is idle)
+    # and announced with one signal
+    CHANGE_COALESCE_TIME = 0
+
+    # emitted with a ChangeSet of everything that changed since the last
+    # time, the signals below follow with one emit each
+    changed = QtCore.pyqtSignal(object)
+
     # emitted when a new client is discovered
     client_new = QtCore.pyqtSignal()
 
@@ -107,7 +220,7 @@ class Client(QtCore.QObject):
     # emitted when a other client joins or leaves a channel
     client_membership_changed = QtCore.pyqtSignal()
 
-    # emitted when a new server is discovered
+    # emitted when a connection to a new server or channel is usable
     server_new = QtCore.pyqtSignal()
 
     # emitted when a server is removed
@@ -116,61 +229,156 @@ class Client(QtCore.QObject):
     #emitted when a message was received from server
     client_message_received = QtCore.pyqtSignal(str, str)
 
-    def __init__(self, nickname="Telematik", parent=None):
+    def __init__(self, nickname="Telematik", parent=None, codec=None,
+                 log_directory=None):
         QtCore.QObject.__init__(self, parent)
 
         self.id = str(uuid.uuid1())
         self.nickname = nickname
         self.pdu_number = 0
 
+        # encoder/decoder for pdus and commands (see instantsoupcodec)
+        self.codec = get_codec(codec)
+
+        # counters and timings (see instantsoupmetrics)
+        self.metrics = Metrics("instantsoup_client")
+
+        # changes not announced yet, see _changed
+        self.changes = ChangeSet()
+        self.change_timer = QtCore.QTimer()
+        self.change_timer.setSingleShot(True)
+        self.change_timer.timeout.connect(self._emit_changes)
+
+        # sockets with queued commands, written once the event loop is idle
+        self.dirty = set()
+        self.flush_timer = QtCore.QTimer()
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.timeout.connect(self.flush_commands)
+
+        # our options, encoded once and packed into few datagrams
+        self.announcement = PduAssembler(self.codec, self.id)
+
         self.create_udp_socket()
 
         # mapping from (client_id) to (nickname)
         self.users = {}
 
-        # mapping from (client_id) to timer (which is a QTimer)
-        self.users_timers = {}
+        # when was a client heard of last, expired by check_liveness
+        self.client_liveness = LivenessTracker(self.DEFAULT_TIMEOUT_TIME)
 
         # mapping from (server_id, channel) to a tuple containing
         # (tcp_socket)
-        self.servers = Lookup()
+        self.servers = ServerLookup()
 
-        # mapping from (server_id, channel) to a tuple containing
-        # (timer) - (which is a QTimer)
-        self.servers_timers = {}
+        # server_ids of servers that take all channels on one connection
+        self.multiplexed = set()
+
+        # when was a server heard of last, expired by check_liveness
+        self.server_liveness = LivenessTracker(self.DEFAULT_TIMEOUT_TIME)
 
-        # mapping from (server_id, channel) to a list of tuple containing
-        # (date, user, message)
-        self.channel_history = {}
+        # mapping from (server_id, channel) to the last messages, as
+        # (time, nickname, message) with the time in seconds since the epoch,
+        # kept on disk too if we have a log directory (see instantsouplog)
+        self.channel_history = HistoryStore(self.HISTORY_MAXIMUM_ENTRIES,
+                                            self.HISTORY_MAXIMUM_BYTES,
+                                            get_chat_log(log_directory))
 
         # mapping from (server_id) to c(hannel_id) to a list of (client_ids)
         # stores the membership of this and OTHER peers
         self.membership = {}
 
+        # mapping from (client_id) to a set of (server_id, channel_id), the
+        # channels the client announced
+        self.client_memberships = {}
+
+        # mapping from (server_id) to a set of the channels it announced
+        self.server_channels = {}
+
+        # mapping from (server_id, channel_id) to the (address, port) of its
+        # multicast group, as the server announced it
+        self.channel_groups = {}
+
+        # mapping from (server_id, channel_id) to (SequenceBuffer), for the
+        # channels we read from their group, and from (port) to the socket
+        self.sequences = {}
+
+        # mapping from (server_id, channel_id) to the server's number of the
+        # last message we got, counted on from the BACKLOG of our join
+        self.message_numbers = {}
+        self.group_sockets = {}
+
+        # mapping from (peer_id) to the last version of its membership or
+        # channels we applied, older deltas are ignored
+        self.membership_versions = {}
+        self.channel_versions = {}
+
+        # mapping from (server_id) to ((version, parts), {part: channels}),
+        # the parts of a channel list we got so far
+        self.channel_parts = {}
+
+        # our public channels as we announced them last, and their version
+        self.announced_membership = set()
+        self.membership_version = 0
+
         self.send_client_nick()
 
+        # the larger the lobby, the longer the interval of the regular pdu
+        self.schedule = AnnouncementSchedule(self.REGULAR_PDU_WAITING_TIME,
+                                             self.ANNOUNCEMENT_PEERS,
+                                             self.DEFAULT_WAITING_TIME,
+                                             self.ANNOUNCEMENT_JITTER)
+
         # setup the regular_pdu_timer for the regular pdu
         self.regular_pdu_timer = QtCore.QTimer()
         self.regular_pdu_timer.timeout.connect(self.send_regular_pdu)
-        self.regular_pdu_timer.start(self.REGULAR_PDU_WAITING_TIME)
+        self.regular_pdu_timer.start(self.schedule.next_interval(1))
+
+        # one timer for the timeouts of all clients and servers
+        self.liveness_timer = QtCore.QTimer()
+        self.liveness_timer.timeout.connect(self.check_liveness)
+        self.liveness_timer.start(self.DEFAULT_WAITING_TIME)
 
         self.tcp_sockets = []
 
+        # sockets that are connecting and sockets waiting for their turn
+        self.connecting = set()
+        self.connect_queue = deque()
+
+        self.metrics.gauge("sockets", lambda: len(self.servers.socket_keys))
+        self.metrics.gauge("connecting", lambda: len(self.connecting))
+        self.metrics.gauge("connect_queue", lambda: len(self.connect_queue))
+        self.metrics.gauge("backlog_frames", lambda: sum(
+            len(tcp_socket.commands)
+            for tcp_socket in self.servers.socket_keys))
+        self.metrics.gauge("users", lambda: len(self.users))
+        self.metrics.gauge("channels", lambda: len(self.membership))
+
+        if self.METRICS_LOG_TIME:
+            self.metrics_timer = QtCore.QTimer()
+            self.metrics_timer.timeout.connect(
+                lambda: log.info(self.metrics.summary()))
+            self.metrics_timer.start(self.METRICS_LOG_TIME)
+
     #
     # SOCKET FUNCTIONS
     #
-    # create a socket for the PDUs
+    # the PDUs of the other peers come through the discovery bus
     def create_udp_socket(self):
-        self.udp_socket = QtNetwork.QUdpSocket()
-        self.udp_socket.bind(broadcast_port,
-                             QtNetwork.QUdpSocket.ReuseAddressHint)
-        self.udp_socket.joinMulticastGroup(group_address_ip4)
-        self.udp_socket.joinMulticastGroup(group_address_ip6)
-
-        # connect the socket input with the processing function
-        self.udp_socket.readyRead.connect(self.process_pending_datagrams)
-
-    # create a socket for a channel
+        self.bus = get_discovery_bus()
+        self.bus.register(self.id, self.handle_pdu)
+
+    # create a socket for the multicast groups of channels on port
+    def _group_socket(self, port):
+        udp_socket = self.group_sockets.get(port)
+        if udp_socket is None:
+            udp_socket = QtNetwork.QUdpSocket()
+            udp_socket.bind(port, QtNetwork.QUdpSocket.ReuseAddressHint)
+            udp_socket.readyRead.connect(lambda:
+                self.process_group_datagrams(udp_socket))
+            self.group_sockets[port] = udp_socket
+        return udp_socket
+
+    # create a socket for a channel, it connects in the background
     def create_tcp_socket(self, address, port):
 
         # create the socket
@@ -178,64 +386,185 @@ class Client(QtCore.QObject):
 
         self.tcp_sockets.append(tcp_socket)
 
-        # we have a destination port and address -> connect!
-        tcp_socket.connectToHost(address, port)
+        # the destination, peerAddress() is unknown until connected
+        tcp_socket.destination = (address, port)
+        tcp_socket.attempts = 0
 
-        try:
-            if not tcp_socket.waitForConnected(self.DEFAULT_WAITING_TIME):
-                log.error('no connection for address %s:%s' %
-                          (address.toString(), port))
-        except RuntimeError:
-            return
+        # commands not written yet, see flush_commands
+        tcp_socket.commands = CommandQueue()
+
+        # a socket reassembles its own commands
+        tcp_socket.framer = CommandFramer()
 
         # connect with processing function
         tcp_socket.readyRead.connect(lambda:
             self.read_from_tcp_socket(tcp_socket))
+        tcp_socket.connected.connect(lambda:
+            self._socket_connected(tcp_socket))
+        tcp_socket.error[QtNetwork.QAbstractSocket.SocketError].connect(
+            lambda error: self._socket_error(tcp_socket))
+        tcp_socket.bytesWritten.connect(tcp_socket.commands.written)
 
         # if socket is disconnected, delete it later
+        tcp_socket.disconnected.connect(tcp_socket.commands.fail)
         tcp_socket.disconnected.connect(tcp_socket.deleteLater)
 
+        self._start_connect(tcp_socket)
         return tcp_socket
 
+    def _start_connect(self, tcp_socket):
+
+        # too many connects in progress, wait for one to finish
+        if len(self.connecting) >= self.MAXIMUM_PENDING_CONNECTS:
+            self.connect_queue.append(tcp_socket)
+            return
+
+        # we have a destination port and address -> connect!
+        self.connecting.add(tcp_socket)
+        tcp_socket.attempts += 1
+        tcp_socket.connectToHost(*tcp_socket.destination)
+
+    def _connect_finished(self, tcp_socket):
+        self.connecting.discard(tcp_socket)
+
+        # start the next connect, unless its server is gone meanwhile
+        while self.connect_queue and \
+              len(self.connecting) < self.MAXIMUM_PENDING_CONNECTS:
+            waiting = self.connect_queue.popleft()
+            if waiting in self.servers.socket_keys:
+                self._start_connect(waiting)
+
+    def _socket_connected(self, tcp_socket):
+        self._connect_finished(tcp_socket)
+
+        # send what was queued while connecting
+        self._schedule_flush(tcp_socket)
+
+        # SIGNAL: we have a new server! (every channel on the connection)
+        server_id, _ = self.servers.find_key(tcp_socket)
+        for key in self.servers.server_keys(server_id):
+            if self.servers[key] is tcp_socket:
+                self.changes.add_server(key)
+        self._changed()
+
+    def _socket_error(self, tcp_socket):
+
+        # errors of established connections end in disconnected
+        if tcp_socket not in self.connecting:
+            return
+        self._connect_finished(tcp_socket)
+        (address, port) = tcp_socket.destination
+        log.error('no connection for address %s:%s (%s)' %
+                  (address.toString(), port, tcp_socket.errorString()))
+        tcp_socket.abort()
+
+        # try again later, with a growing delay
+        if tcp_socket.attempts < self.MAXIMUM_CONNECT_ATTEMPTS:
+            delay = self.CONNECT_RETRY_TIME * 2 ** (tcp_socket.attempts - 1)
+            QtCore.QTimer.singleShot(delay, lambda:
+                self._retry_connect(tcp_socket))
+        else:
+            self._connect_failed(tcp_socket)
+
+    def _retry_connect(self, tcp_socket):
+        if tcp_socket in self.servers.socket_keys:
+            self._start_connect(tcp_socket)
+
+    def _connect_failed(self, tcp_socket):
+        (server_id, channel_id) = self.servers.find_key(tcp_socket)
+        tcp_socket.commands.fail()
+        tcp_socket.deleteLater()
+
+        # without its own connection, we can't use the server at all
+        if channel_id is None and server_id in self.server_liveness:
+            self.remove_server(server_id)
+        elif channel_id is not None:
+            del self.servers[(server_id, channel_id)]
+            self.changes.remove_server((server_id, channel_id))
+            self._changed()
+
+    def _write_frame(self, tcp_socket, frame, callback=None):
+        tcp_socket.commands.put(frame, callback)
+        self._schedule_flush(tcp_socket)
+
+    def _schedule_flush(self, tcp_socket):
+        self.dirty.add(tcp_socket)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start(0)
+
+    def flush_commands(self):
+        """write the queued commands, one write per connected socket"""
+        dirty = self.dirty
+        self.dirty = set()
+        for tcp_socket in dirty:
+            try:
+
+                # the rest is written once connected
+                if tcp_socket.state() != \
+                   QtNetwork.QAbstractSocket.ConnectedState:
+                    continue
+                data = tcp_socket.commands.take()
+                if data:
+                    tcp_socket.write(data)
+                    tcp_socket.flush()
+                    self.metrics.count("command_writes_total")
+            except RuntimeError:
+                log.debug("Socket deleted")
+
     def read_from_tcp_socket(self, tcp_socket):
         data = str(tcp_socket.readAll())
         tcp_socket.flush()
-        self.handle_data(data, tcp_socket)
+        try:
+            with self.metrics.time("parse_seconds", kind="command"):
+                commands = tcp_socket.framer.feed(data)
+        except CodecError as error:
+            log.error("broken command stream: %s" % error)
+            self.metrics.count("parse_errors_total", kind="command")
+            tcp_socket.abort()
+            return
+        for command in commands:
+            self.handle_data(command, tcp_socket)
 
     #
     # PROCESSING FUNCTIONS (INCOMING SERVER COMMANDOS)
     #
-    def handle_data(self, command, tcp_socket):
-        try:
-            data = InstantSoupData.command.parse(command)
-
-            if data.startswith("SAY"):
-                self.handle_say_command(data, tcp_socket)
-        except core.FieldError:
-            peer_pdu = InstantSoupData.peer_pdu.parse(command)
-            # uid = peer_pdu["id"]
-            for option in peer_pdu["option"]:
-                if option["option_id"] == "SERVER_INVITE_OPTION":
-                    log.debug("RECEIVED SERVER_INVITE_OPTION")
-                    server_id = peer_pdu["id"]
-                    channel_id = option["option_data"]["channel_id"]
-                    client_ids = option["option_data"]["client_id"]
-                    key = (server_id, channel_id)
-                    # quick and dirty, probably not rfc conform
-                    self.command_join(channel_id, server_id)
-                    for client_id in client_ids:
-                        if key in self.membership:
-                            self.membership[key].add(client_id)
-                        else:
-                            self.membership[key] = set()
-                            self.membership[key].add(client_id)
-
-    def handle_say_command(self, data, tcp_socket):
-        key = self.servers.find_key(tcp_socket)
+    @measured
+    def handle_data(self, data, tcp_socket):
+        self.metrics.count("commands_received_total",
+                           command=command_name(data))
+        if data.startswith("CHANNEL"):
+            self.handle_channel_command(data, tcp_socket)
+        elif data.startswith("SEQ"):
+            self.handle_sequenced_command(data)
+        else:
+            self._dispatch(data, self.servers.find_key(tcp_socket))
+
+    # a command of a multiplexed connection, tagged with its channel
+    def handle_channel_command(self, data, tcp_socket):
+        parts = data.split("\x00", 2)
+        if len(parts) == 3:
+            _, channel_id, command = parts
+            server_id, _ = self.servers.find_key(tcp_socket)
+            self._dispatch(command, (server_id, channel_id))
+
+    def _dispatch(self, data, key):
+        if data.startswith("SAY"):
+            self.handle_say_command(data, key)
+        elif data.startswith("MEMBERS"):
+            self.handle_members_command(data, key)
+        elif data.startswith("BACKLOG"):
+            self.handle_backlog_command(data, key)
+        elif data.startswith("MULTICAST"):
+            self.handle_multicast_command(data, key)
+
+    def handle_say_command(self, data, key):
         (server_id, channel_id) = key
 
         if channel_id is not None:
 
+            if key in self.message_numbers:
+                self.message_numbers[key] += 1
+
             client_id = data.split("\x00")[1]
             nickname = client_id
 
@@ -243,47 +572,162 @@ class Client(QtCore.QObject):
             if client_id in self.users:
                 nickname = self.users[client_id]
 
-            time = QtCore.QDateTime.currentDateTime()
-            message = QtCore.QString(" ".join(data.split("\x00")[2:]))
+            message = " ".join(data.split("\x00")[2:])
 
-            if message.trimmed().length():
-                entry = (time, nickname, message)
-
-                if key not in self.channel_history:
-                    self.channel_history[key] = list()
-
-                self.channel_history[key].append(entry)
+            if message.strip():
+                self.channel_history.append(key, time.time(), nickname,
+                                            message)
 
                 # SIGNAL: new message
                 self.client_message_received.emit(server_id, channel_id)
 
+    # the members of a channel we joined, sent by the server right away;
+    # who leaves is still learned from the announcements
+    def handle_members_command(self, data, key):
+        if key[1] is None:
+            return
+
+        # the first answer to a JOIN, the messages are counted from here
+        self.message_numbers.setdefault(key, 0)
+        for client_id in data.split("\x00")[1:]:
+            if client_id and client_id != self.id and \
+               client_id not in self.membership.get(key, ()):
+                self._change_membership(client_id, [key], ())
+
+    # a message said before we joined, oldest first, with its number
+    def handle_backlog_command(self, data, key):
+        (server_id, channel_id) = key
+        parts = data.split("\x00")
+        if channel_id is None or len(parts) < 5:
+            return
+        try:
+            number = int(parts[1])
+            timestamp = float(parts[2])
+        except ValueError:
+            return
+
+        # skip what we got live before, e.g. when joining again
+        if number <= self.message_numbers.get(key, 0):
+            return
+        self.message_numbers[key] = number
+
+        # the server's clock may be ahead of ours, keep the history in order
+        timestamp = min(timestamp, time.time())
+
+        client_id = parts[3]
+        nickname = self.users.get(client_id, client_id)
+        message = " ".join(parts[4:])
+        if message.strip():
+            self.channel_history.append(key, timestamp, nickname, message)
+
+            # SIGNAL: new message
+            self.client_message_received.emit(server_id, channel_id)
+
+    # the server sends no more messages of the channel over tcp, from the
+    # given number on they come from the group
+    def handle_multicast_command(self, data, key):
+        buffer = self.sequences.get(key)
+        if buffer is None:
+            return
+        try:
+            number = int(data.split("\x00")[1])
+        except (IndexError, ValueError):
+            return
+        self._deliver(key, buffer.start(number))
+
+    # a numbered message of a group, or one the server sent again
+    def handle_sequenced_command(self, data):
+        parts = data.split("\x00", 4)
+        if len(parts) < 5:
+            return
+        _, server_id, channel_id, number, command = parts
+        key = (server_id, channel_id)
+        buffer = self.sequences.get(key)
+        if buffer is None:
+            return
+        try:
+            number = int(number)
+        except ValueError:
+            return
+        self._deliver(key, buffer.receive(number, command))
+
+    def _deliver(self, key, commands):
+        for command in commands:
+            self._dispatch(command, key)
+
+        # ask the server for what we missed, once per gap
+        (server_id, channel_id) = key
+        buffer = self.sequences[key]
+        gap = buffer.missing()
+        if gap is not None and gap != buffer.requested:
+            buffer.requested = gap
+            self.send_command_to_server("RESEND\x00%i\x00%i" % gap,
+                                        server_id, channel_id)
+            QtCore.QTimer.singleShot(self.GAP_WAITING_TIME, lambda:
+                self._skip_gap(key, gap))
+
+    # the server didn't send the gap again (in time), go on without it
+    def _skip_gap(self, key, gap):
+        buffer = self.sequences.get(key)
+        if buffer is not None and buffer.missing() is not None and \
+           buffer.next <= gap[1]:
+            self._deliver(key, buffer.skip())
+
+    # read the messages of the channel from its group
+    def _subscribe(self, key):
+        (server_id, channel_id) = key
+        address, port = self.channel_groups[key]
+        if not self._group_members(key):
+            self._group_socket(port).joinMulticastGroup(
+                QtNetwork.QHostAddress(address))
+        self.sequences[key] = SequenceBuffer()
+        self.send_command_to_server("MULTICAST", server_id, channel_id)
+
+    def _unsubscribe(self, key):
+        if self.sequences.pop(key, None) is None:
+            return
+        address, port = self.channel_groups[key]
+        if not self._group_members(key):
+            self._group_socket(port).leaveMulticastGroup(
+                QtNetwork.QHostAddress(address))
+
+    # the other channels we read from the group of key
+    def _group_members(self, key):
+        group = self.channel_groups[key]
+        return [other for other in self.sequences
+                if other != key and self.channel_groups.get(other) == group]
+
     #
     # SERVER COMMANDOS
     #
     def command_join(self, channel_id, server_id):
         key = (server_id, channel_id)
 
-        socket = self.servers[(server_id, None)]
-        address = socket.peerAddress()
-        port = socket.peerPort()
-        self.servers[key] = self.create_tcp_socket(address, port)
+        socket = self._connect_channel(server_id, channel_id)
 
-        # signal: we have a new server!
-        self.server_new.emit()
+        # SIGNAL: we have a new server! (else once connected)
+        if socket.state() == QtNetwork.QAbstractSocket.ConnectedState:
+            self.changes.add_server(key)
 
         self.send_command_to_server("JOIN\x00%s" % channel_id,
                                     server_id, channel_id)
 
+        # big channels come from their group
+        if key in self.channel_groups and key not in self.sequences:
+            self._subscribe(key)
+
         # if combination not exist, create and be a member
-        if key not in self.membership:
-            self.membership[key] = set()
-            self.membership[key].add(self.id)
+        members = self.membership.setdefault(key, set())
+        if self.id not in members:
+            members.add(self.id)
+            self.changes.add_membership(key, self.id)
+        self._changed()
 
-        self.send_client_membership_option()
+        self.send_client_membership_delta()
 
-    def command_say(self, text, channel_id, server_id):
+    def command_say(self, text, channel_id, server_id, callback=None):
         self.send_command_to_server("SAY\x00%s" % text,
-                                    server_id, channel_id)
+                                    server_id, channel_id, callback)
 
     def command_standby(self, peer_id, channel_id, server_id):
         self.send_command_to_server("STANDBY\x00%s" % peer_id,
@@ -293,257 +737,560 @@ class Client(QtCore.QObject):
         self.send_command_to_server("INVITE\x00%s" % "\x00".join(client_ids),
                                     server_id, channel_id)
 
-    def command_exit(self, channel_id, server_id):
-        self.send_command_to_server("EXIT", server_id, channel_id)
-
-        # delete combination from memberships
-        key = (server_id, channel_id)
-        if key in self.membership:
-            del self.membership[key]
-
-        self.send_client_membership_option()
-
-    def send_command_to_server(self, command, server_id, channel_id=None):
+    def command_exit(self, channel_id, server_id, callback=None):
+        self.send_command_to_server("EXIT", server_id, channel_id, callback)
+        self._left_channel((server_id, channel_id))
+        self.send_client_membership_delta()
+
+    def _left_channel(self, key):
+        self._unsubscribe(key)
+
+        # delete us from the memberships, the others stay
+        members = self.membership.get(key, set())
+        if self.id in members:
+            members.discard(self.id)
+            self.changes.remove_membership(key, self.id)
+            self._changed()
+        if not members:
+            self.membership.pop(key, None)
+
+    def send_command_to_server(self, command, server_id, channel_id=None,
+                               callback=None):
+        """
+        queue command for the server, callback(success) follows once it is
+        written or the connection failed
+        """
         key = (server_id, channel_id)
         if key not in self.servers:
             log.error("server %s doesn't exist" % server_id)
+            if callback is not None:
+                callback(False)
         else:
             try:
                 # we are already connected!
                 socket = self.servers[key]
-                socket.write(InstantSoupData.command.build(command))
-                socket.waitForBytesWritten(self.DEFAULT_WAITING_TIME)
+
+                # on a shared connection, say which channel we mean
+                self.metrics.count("commands_sent_total",
+                                   command=command_name(command))
+                if channel_id is not None and \
+                   socket is self.servers.get((server_id, None)):
+                    command = "CHANNEL\x00%s\x00%s" % (channel_id, command)
+
+                with self.metrics.time("build_seconds", kind="command"):
+                    frame = self.codec.build_command(command)
+                self._write_frame(socket, frame, callback)
             except RuntimeError:
                 log.debug("Socket deleted")
+                if callback is not None:
+                    callback(False)
+
+    def send_command_to_channels(self, command, keys, callback=None):
+        """
+        queue command for every (server_id, channel_id) in keys,
+        callback(success) follows once all of them are done
+        """
+        keys = list(keys)
+        done = None
+        if callback is not None:
+            if not keys:
+                callback(True)
+                return
+
+            # one result per channel, success only if all succeeded
+            results = []
+
+            def done(success):
+                results.append(success)
+                if len(results) == len(keys):
+                    callback(all(results))
+
+        for (server_id, channel_id) in keys:
+            self.send_command_to_server(command, server_id, channel_id, done)
 
     #
     # DATAGRAMS
     #
     def send_regular_pdu(self):
 
-        # send nickname
-        self.send_client_nick()
-
-        # sent the option with every fourth pdu (see rfc)
+        # send nickname, the membership with every fourth pdu (see rfc)
+        option_ids = ["CLIENT_NICK_OPTION"]
         if self.pdu_number % 4 == 0:
-            self.send_client_membership_option()
+            option_ids.extend(self._membership_snapshot())
+        self.send_options(option_ids)
 
         self.pdu_number += 1
 
-    def send_client_nick(self):
-
-        # define the data to send & send
-        option_data = self.nickname
+        # the more peers, the longer the interval
+        self.regular_pdu_timer.start(self.schedule.next_interval(
+            self._peers()))
 
-        option = Container(option_id="CLIENT_NICK_OPTION",
-                     option_data=option_data
-                 )
+    # the peers we hear, clients and servers, and us
+    def _peers(self):
+        return len(self.client_liveness) + len(self.server_liveness) + 1
 
-        pdu = Container(id=self.id,
-                  option=[option]
-              )
-
-        data = InstantSoupData.peer_pdu.build(pdu)
-        self._send_datagram(data)
-
-        log.debug('PDU: CLIENT_NICK_OPTION - ID: %i - SENT' % self.pdu_number)
+    def send_client_nick(self):
+        self.send_options(["CLIENT_NICK_OPTION"])
 
+    # the full membership, for peers that came late or missed a delta
     def send_client_membership_option(self):
-
-        # mapping from server_id to a list of channel_ids
-        server_channels = defaultdict(list)
-        for (server_id, channel_id), _ in self.membership.items():
-            if channel_id and not channel_id.startswith("@"):
-                server_channels[server_id].append(channel_id)
-
-        # build the channel list for a server
-        option_data = []
-        for server_id, channels in server_channels.items():
-            data = Container(server_id=server_id, channels=channels)
-            option_data.append(data)
-
-        # do we have something to send?
-        if option_data:
-            option = Container(option_id="CLIENT_MEMBERSHIP_OPTION",
-                               option_data=option_data)
-            pdu = Container(id=self.id, option=[option])
-            data = InstantSoupData.peer_pdu.build(pdu)
-            self._send_datagram(data)
-
-        # SIGNAL: membership changed
-        self.client_membership_changed.emit()
-        log.debug('PDU: CLIENT_NICK_MEMBERSHIP - ID: %i - SENT' %
-                  self.pdu_number)
-
-    def _send_datagram(self, datagram):
-        self.udp_socket.writeDatagram(datagram, group_address_ip4,
-                                      broadcast_port)
-        self.udp_socket.writeDatagram(datagram, group_address_ip6,
-                                      broadcast_port)
+        self.send_options(self._membership_snapshot())
+
+    # only what changed since the last announcement
+    def send_client_membership_delta(self):
+        added, removed = self._update_membership_announcement()
+        if added or removed:
+            delta = (self.membership_version, _group_by_server(added),
+                     _group_by_server(removed))
+            if self._announce("CLIENT_MEMBERSHIP_DELTA_OPTION", delta):
+                self.send_options(["CLIENT_MEMBERSHIP_DELTA_OPTION"])
+
+    # send option_ids with as few datagrams as possible
+    @measured
+    def send_options(self, option_ids):
+        self._announce("CLIENT_NICK_OPTION", self.nickname)
+
+        # we don't hear our own pdus, but we are a user too (one that
+        # never times out, see _peers)
+        self._set_user(self.id, self.nickname)
+        with self.metrics.time("build_seconds", kind="pdu"):
+            pdus = self.announcement.pdus(option_ids)
+        for pdu_option_ids, datagram in pdus:
+            self.bus.announce(datagram, self.id, pdu_option_ids)
+        self.metrics.count("datagrams_sent_total", len(pdus))
+        for option_id in option_ids:
+            self.metrics.count("options_sent_total", option=option_id)
+
+        log.debug('PDU: %s - ID: %i - SENT' % (", ".join(option_ids),
+                                                self.pdu_number))
+
+    def _membership_snapshot(self):
+        self._update_membership_announcement()
+
+        # an empty delta next to the full option tells its version
+        marker = (self.membership_version, [], [])
+        self._announce("CLIENT_MEMBERSHIP_DELTA_OPTION", marker)
+        return ["CLIENT_MEMBERSHIP_OPTION", "CLIENT_MEMBERSHIP_DELTA_OPTION"]
+
+    # compare our public channels with the last announcement, a change
+    # makes a new version, returns the (added, removed) keys
+    def _update_membership_announcement(self):
+        keys = set(key for key, members in self.membership.items()
+                   if self.id in members and key[1] and
+                   not key[1].startswith("@"))
+        added = keys - self.announced_membership
+        removed = self.announced_membership - keys
+        if added or removed:
+            self.membership_version += 1
+            self.announced_membership = keys
+        self._announce("CLIENT_MEMBERSHIP_OPTION", _group_by_server(keys))
+        return added, removed
+
+    # store an option for the next pdus, returns False if it can't be built
+    # (it keeps its last data then)
+    def _announce(self, option_id, option_data):
+        try:
+            self.announcement.set(option_id, option_data)
+        except CodecError as error:
+            log.error("unable to build %s: %s" % (option_id, error))
+            self.metrics.count("build_errors_total", option=option_id)
+            return False
+        return True
 
     #
     # PROCESSING FUNCTIONS (INCOMING PDUS)
     #
-    def process_pending_datagrams(self):
-        while self.udp_socket.hasPendingDatagrams():
-            (data, address, _) = self.udp_socket.readDatagram(self.MAXIMUM_DATAGRAM_LENGTH)
-            packet = InstantSoupData.peer_pdu.parse(data)
-            peer_uid = packet["id"]
-            for option in packet["option"]:
-                if option["option_id"] == "CLIENT_NICK_OPTION":
-                    self.handle_client_nick_option(peer_uid, option)
-                elif option["option_id"] == "CLIENT_MEMBERSHIP_OPTION":
-                    self.handle_client_membership_option(peer_uid, option)
-                elif option["option_id"] == "SERVER_OPTION":
-                    self.handle_server_option(peer_uid, option, address)
-                elif option["option_id"] == "SERVER_CHANNELS_OPTION":
-                    self.handle_server_channels_option(peer_uid, option)
-                elif option["option_id"] == "SERVER_INVITE_OPTION":
-                    print "Incomming Invite"
-                    self.handle_server_invite_option(packet)
+    @measured
+    def handle_pdu(self, peer_uid, options, address):
+        self.metrics.count("datagrams_received_total")
+
+        # the features decide how we connect to the channels, but they come
+        # after SERVER_CHANNELS_OPTION in the pdu
+        for option_id, option_data in options:
+            if option_id == "SERVER_FEATURES_OPTION":
+                self.handle_server_features_option(peer_uid, option_data)
+
+        for option_id, option_data in options:
+            self.metrics.count("options_received_total", option=option_id)
+            if option_id == "CLIENT_NICK_OPTION":
+                self.handle_client_nick_option(peer_uid, option_data)
+            elif option_id == "CLIENT_MEMBERSHIP_OPTION":
+                self.handle_client_membership_option(peer_uid, option_data)
+            elif option_id == "SERVER_OPTION":
+                self.handle_server_option(peer_uid, option_data, address)
+            elif option_id == "SERVER_CHANNELS_OPTION":
+                self.handle_server_channels_option(peer_uid, option_data)
+            elif option_id == "SERVER_CHANNELS_PART_OPTION":
+                self.handle_server_channels_part_option(peer_uid, option_data)
+            elif option_id == "SERVER_INVITE_OPTION":
+                print "Incomming Invite"
+                self.handle_server_invite_option(peer_uid, option_data)
+            elif option_id == "CLIENT_MEMBERSHIP_DELTA_OPTION":
+                self.handle_client_membership_delta_option(peer_uid,
+                                                           option_data)
+            elif option_id == "SERVER_CHANNELS_DELTA_OPTION":
+                self.handle_server_channels_delta_option(peer_uid,
+                                                         option_data)
+            elif option_id == "SERVER_CHANNEL_GROUPS_OPTION":
+                self.handle_server_channel_groups_option(peer_uid,
+                                                         option_data)
+
+    @measured
+    def process_group_datagrams(self, udp_socket):
+        while udp_socket.hasPendingDatagrams():
+            (data, address, _) = udp_socket.readDatagram(
+                self.MAXIMUM_DATAGRAM_LENGTH)
+            self.metrics.count("datagrams_received_total")
+            try:
+                with self.metrics.time("parse_seconds", kind="command"):
+                    command = self.codec.parse_command(data)
+            except (CodecError, UnicodeDecodeError):
+                log.debug("invalid group message from %s" % address.toString())
+                self.metrics.count("parse_errors_total", kind="command")
+                continue
+            if command.startswith("SEQ"):
+                self.handle_sequenced_command(command)
 
     # If an invite comes at udp socket from a server, the client joins the server
-    def handle_server_invite_option(self, packet):
-        for option in packet["option"]:
-            if option["option_id"] == "SERVER_INVITE_OPTION":
-                log.debug("RECEIVED SERVER_INVITE_OPTION")
-                server_id = packet["id"]
-                channel_id = option["option_data"]["channel_id"]
-                client_ids = option["option_data"]["client_id"]
-                key = (server_id, channel_id)
-                # quick and dirty, probably not rfc conform
-                self.command_join(channel_id, server_id)
-                for client_id in client_ids:
-                    if key in self.membership:
-                        self.membership[key].add(client_id)
-                    else:
-                        self.membership[key] = set()
-                        self.membership[key].add(client_id)
-        
-           
-    def handle_client_nick_option(self, client_id, option):
+    def handle_server_invite_option(self, server_id, option_data):
+        log.debug("RECEIVED SERVER_INVITE_OPTION")
+        channel_id, client_ids = option_data
+        key = (server_id, channel_id)
+        # quick and dirty, probably not rfc conform
+        self.command_join(channel_id, server_id)
+        members = self.membership.setdefault(key, set())
+        for client_id in client_ids:
+            if client_id not in members:
+                members.add(client_id)
+                self.changes.add_membership(key, client_id)
+        self._changed()
+
+    def handle_client_nick_option(self, client_id, nickname):
+        self._set_user(client_id, nickname)
+
+        # the client is alive
+        self.client_liveness.touch(client_id)
+
+    def _set_user(self, client_id, nickname):
 
         # new client found or client nick was changed
         if client_id in self.users:
 
             # user already exists
-            if self.users[client_id] != option["option_data"]:
-                self.users[client_id] = option["option_data"]
+            if self.users[client_id] != nickname:
+                self.users[client_id] = nickname
 
                 # SIGNAL: client nick was changed
-                self.client_nick_change.emit()
+                self.changes.rename_user(client_id)
+                self._changed()
         else:
 
             # add new client
-            self.users[client_id] = option["option_data"]
-            self.users_timers[client_id] = QtCore.QTimer()
-            self.users_timers[client_id].timeout.connect(lambda:
-                self.remove_client(client_id))
+            self.users[client_id] = nickname
 
             # SIGNAL: new client
-            self.client_new.emit()
+            self.changes.add_user(client_id)
+            self._changed()
 
-        # restart the timer
-        self.users_timers[client_id].start(self.DEFAULT_TIMEOUT_TIME)
+    def handle_client_membership_option(self, client_id, servers):
 
-    def handle_client_membership_option(self, client_id, option):
-        servers = option["option_data"]
-        for server_container in servers:
-            server_id = server_container["server_id"]
-            channels = server_container["channels"]
-            for channel_id in channels:
-                key = (server_id, channel_id)
+        # we know our own membership best
+        if client_id == self.id:
+            return
 
-                if key in self.membership:
-                    self.membership[key].add(client_id)
-                else:
-                    self.membership[key] = set()
-                    self.membership[key].add(client_id)
+        # the full list replaces what the client announced before, but
+        # private channels are never announced, we know them from MEMBERS
+        keys = set((server_id, channel_id) for server_id, channels in servers
+                   for channel_id in channels)
+        known = self.client_memberships.get(client_id, set())
+        self._change_membership(client_id, keys - known,
+                                [key for key in known - keys
+                                 if not key[1].startswith("@")])
+
+    def handle_client_membership_delta_option(self, client_id, delta):
+        version, added, removed = delta
+
+        # ours, or older than what we have (the next snapshot fixes gaps)
+        if client_id == self.id or \
+           version <= self.membership_versions.get(client_id, -1):
+            return
+        self.membership_versions[client_id] = version
+
+        if added or removed:
+            self._change_membership(client_id,
+                [(server_id, channel_id) for server_id, channels in added
+                 for channel_id in channels],
+                [(server_id, channel_id) for server_id, channels in removed
+                 for channel_id in channels])
+
+    def _change_membership(self, client_id, added, removed):
+        known = self.client_memberships.setdefault(client_id, set())
+        for key in added:
+            members = self.membership.setdefault(key, set())
+            if client_id not in members:
+                members.add(client_id)
+                self.changes.add_membership(key, client_id)
+            known.add(key)
+        for key in removed:
+            members = self.membership.get(key, set())
+            if client_id in members:
+                members.discard(client_id)
+                self.changes.remove_membership(key, client_id)
+            if not members:
+                self.membership.pop(key, None)
+            known.discard(key)
+        if not known:
+            del self.client_memberships[client_id]
 
         # SIGNAL: memberships has changed
-        self.client_membership_changed.emit()
+        if added or removed:
+            self._changed()
 
-    def handle_server_option(self, server_id, option, address):
+    def handle_server_option(self, server_id, port, address):
         if (server_id, None) not in self.servers:
 
-            # get the port
-            port = option["option_data"]["port"]
-
             # create new socket
             socket = self.create_tcp_socket(address, port)
 
             # add the server itself to the server list
             self.servers[(server_id, None)] = socket
 
-            # start timer for server timeout
-            self.servers_timers[server_id] = QtCore.QTimer()
-            self.servers_timers[server_id].timeout.connect(lambda:
-                self.remove_server(server_id))
+        # the server is alive
+        self.server_liveness.touch(server_id)
 
-            # SIGNAL: we have a new server!
-            self.server_new.emit()
+    def handle_server_features_option(self, server_id, features):
+        if FEATURE_MULTIPLEX in features and server_id not in self.multiplexed:
+            self.multiplexed.add(server_id)
+            self._multiplex_channels(server_id)
 
-        # restart the timer
-        if server_id in self.servers_timers:
-            self.servers_timers[server_id].start(self.DEFAULT_TIMEOUT_TIME)
+    # channels connected before we knew that the server multiplexes, e.g.
+    # from a snapshot in an earlier datagram, move to its connection, unless
+    # we are in them
+    def _multiplex_channels(self, server_id):
+        socket = self.servers.get((server_id, None))
+        if socket is None:
+            return
+        for key in self.servers.server_keys(server_id):
+            channel_socket = self.servers[key]
+            if key[1] is None or channel_socket is socket or \
+               self.id in self.membership.get(key, ()):
+                continue
+            self.servers[key] = socket
+            if channel_socket not in self.servers.socket_keys:
+                if channel_socket in self.connecting:
+                    self._connect_finished(channel_socket)
+                try:
+                    channel_socket.abort()
+                    channel_socket.deleteLater()
+                except RuntimeError:
+                    log.debug("Socket deleted")
+
+            # SIGNAL: the channel is usable (else once connected)
+            if socket.state() == QtNetwork.QAbstractSocket.ConnectedState:
+                self.changes.add_server(key)
+                self._changed()
+
+    def handle_server_channels_option(self, server_id, channels):
+
+        # the full list replaces what the server announced before
+        known = self.server_channels.get(server_id, set())
+        channels = set(channels)
+        self._change_server_channels(server_id, channels - known,
+                                     known - channels)
+
+    def handle_server_channels_part_option(self, server_id, option_data):
+        version, part, parts, channels = option_data
+
+        # the parts of another version are dropped, once all parts of this
+        # version are there they replace the list like SERVER_CHANNELS_OPTION
+        received = self.channel_parts.get(server_id)
+        if received is None or received[0] != (version, parts):
+            received = self.channel_parts[server_id] = ((version, parts), {})
+        received[1][part] = channels
+        if len(received[1]) == parts:
+            del self.channel_parts[server_id]
+            self.handle_server_channels_option(
+                server_id, [channel for index in sorted(received[1])
+                            for channel in received[1][index]])
+
+    def handle_server_channels_delta_option(self, server_id, delta):
+        version, added, removed = delta
+
+        # older than what we have (the next snapshot fixes gaps)
+        if version <= self.channel_versions.get(server_id, -1):
+            return
+        self.channel_versions[server_id] = version
+        self._change_server_channels(server_id, added, removed)
+
+    def handle_server_channel_groups_option(self, server_id, groups):
+
+        # the full list replaces what the server announced before, a channel
+        # keeps its group as long as we read it
+        groups = dict(((server_id, channel_id), (address, port))
+                      for channel_id, address, port in groups)
+        for key in list(self.channel_groups):
+            if key[0] == server_id and key not in groups and \
+               key not in self.sequences:
+                del self.channel_groups[key]
+        self.channel_groups.update((key, group)
+                                   for key, group in groups.items()
+                                   if key not in self.sequences)
+
+        # switch the channels we are in
+        for key in groups:
+            if key not in self.sequences and \
+               self.id in self.membership.get(key, ()):
+                self._subscribe(key)
+
+    def _change_server_channels(self, server_id, added, removed):
+
+        # without the server's own connection we wait for the next snapshot
+        if (server_id, None) not in self.servers:
+            return
+        known = self.server_channels.setdefault(server_id, set())
 
-    def handle_server_channels_option(self, server_id, option):
-        channels = option["option_data"]["channels"]
-        for channel in channels:
+        for channel in added:
+            known.add(channel)
             key = (server_id, channel)
             if key not in self.servers:
+                socket = self._connect_channel(server_id, channel)
 
-                # get the socket of the server itself
-                socket = self.servers[(server_id, None)]
+                # SIGNAL: we have a new server! (else once connected)
+                if socket.state() == QtNetwork.QAbstractSocket.ConnectedState:
+                    self.changes.add_server(key)
+                    self._changed()
 
-                # get the server address and port
-                address = socket.peerAddress()
-                port = socket.peerPort()
+        # channels we are in stay until we leave them
+        for channel in removed:
+            known.discard(channel)
+            key = (server_id, channel)
+            if key in self.servers and \
+               self.id not in self.membership.get(key, ()):
+                socket = self.servers.pop(key)
+                try:
+                    if socket is not self.servers[(server_id, None)]:
+                        socket.disconnectFromHost()
+                except RuntimeError:
+                    log.debug("Socket deleted")
+
+                # SIGNAL: server removed (one of its channels)
+                self.changes.remove_server(key)
+                self._changed()
+
+    def _connect_channel(self, server_id, channel_id):
+
+        # a channel keeps its connection, e.g. the one of the auto-connect
+        channel_socket = self.servers.get((server_id, channel_id))
+        if channel_socket is not None:
+            try:
+                channel_socket.state()
+                return channel_socket
+            except RuntimeError:
+                log.debug("Socket deleted")
 
-                # create new socket (= tcp connection to server)
-                self.servers[key] = self.create_tcp_socket(address, port)
+        # get the socket of the server itself
+        socket = self.servers[(server_id, None)]
 
-                # SIGNAL: we have a new server!
-                self.server_new.emit()
+        # a multiplexing server takes the channel on its own connection
+        if server_id in self.multiplexed:
+            self.servers[(server_id, channel_id)] = socket
+            return socket
 
-    def remove_server(self, key):
-        self.servers_timers[key].stop()
-        del self.servers_timers[key]
-        keys = []
+        # create new socket (= tcp connection to server) to the same address
+        channel_socket = self.create_tcp_socket(*socket.destination)
+        self.servers[(server_id, channel_id)] = channel_socket
+        return channel_socket
 
-        # delete all server entries
-        for (server_id, channel_id) in self.servers:
-            if key == server_id:
-                keys.append((server_id, channel_id))
-                socket = self.servers[(server_id, channel_id)]
-                #del self.servers[(server_id, channel_id)]
-                #socket.close()
+    # remove clients and servers we didn't hear of for DEFAULT_TIMEOUT_TIME
+    def check_liveness(self):
 
-        for key in keys:
-            del self.servers[key]
+        # the larger the lobby, the longer the peers stay silent
+        timeout = self.schedule.timeout(self._peers(),
+                                        self.DEFAULT_WAITING_TIME)
+        self.client_liveness.timeout = self.server_liveness.timeout = timeout
 
-        # server removed
-        self.server_removed.emit()
+        for client_id in self.client_liveness.expire():
+            self._forget_client(client_id)
+        for server_id in self.server_liveness.expire():
+            self._forget_server(server_id)
 
-    def disconnect_from_all_channels(self):
+    def remove_server(self, key):
+        self.server_liveness.discard(key)
+        self._forget_server(key)
 
-        # get a independent list of the servers
-        servers = copy.copy(self.servers)
+    def _forget_server(self, key):
 
         # delete all server entries
-        for (server_id, channel_id) in servers:
-
-            # we cannot exit the server itself!
-            if channel_id is not None:
-                self.command_exit(channel_id, server_id)
+        for server_key in self.servers.server_keys(key):
+            self._unsubscribe(server_key)
+            del self.servers[server_key]
+
+            # SIGNAL: server removed
+            self.changes.remove_server(server_key)
+            self._changed()
+        self.multiplexed.discard(key)
+        self.server_channels.pop(key, None)
+        for group_key in [group_key for group_key in self.channel_groups
+                          if group_key[0] == key]:
+            del self.channel_groups[group_key]
+        self.channel_versions.pop(key, None)
+        self.channel_parts.pop(key, None)
+
+    def disconnect_from_all_channels(self, callback=None):
+
+        # we cannot exit the server itself!
+        keys = [key for key in self.servers if key[1] is not None]
+
+        # one EXIT per channel, but a single membership delta
+        self.send_command_to_channels("EXIT", keys, callback)
+        for key in keys:
+            self._left_channel(key)
+        self.send_client_membership_delta()
 
     def remove_client(self, key):
-        self.users_timers[key].stop()
-        del self.users_timers[key]
+        self.client_liveness.discard(key)
+        self._forget_client(key)
+
+    def _forget_client(self, key):
         del self.users[key]
 
-        # client removed
-        self.client_removed.emit()
+        # SIGNAL: client removed
+        self.changes.remove_user(key)
+        self._changed()
+
+        # the client is gone, so are its channel memberships
+        channels = list(self.client_memberships.get(key, ()))
+        self._change_membership(key, (), channels)
+        self.membership_versions.pop(key, None)
+
+    #
+    # CHANGE NOTIFICATION
+    #
+    # announce the changes once the timer runs out, so a burst of pdus makes
+    # one notification instead of one per pdu
+    def _changed(self):
+        if not self.change_timer.isActive():
+            self.change_timer.start(self.CHANGE_COALESCE_TIME)
+
+    def _emit_changes(self):
+        changes, self.changes = self.changes, ChangeSet()
+        if not changes:
+            return
+
+        # SIGNAL: everything at once, then once per kind of change
+        self.changed.emit(changes)
+        if changes.users_added:
+            self.client_new.emit()
+        if changes.users_removed:
+            self.client_removed.emit()
+        if changes.users_renamed:
+            self.client_nick_change.emit()
+        if changes.memberships_added or changes.memberships_removed:
+            self.client_membership_changed.emit()
+        if changes.servers_added:
+            self.server_new.emit()
+        if changes.servers_removed:
+            self.server_removed.emit()
 
     # Prints the Object
     def __repr__(self):
@@ -553,40 +1300,28 @@ class Client(QtCore.QObject):
             self.servers)
 
 
-class Server(QtCore.QObject):
-    DEFAULT_WAITING_TIME = 1000
+class Server(ServerProtocol, QtCore.QObject):
+    """the protocol of ServerProtocol on the Qt event loop"""
 
-    REGULAR_PDU_WAITING_TIME = 15000
+    # bytes handed to a socket at once, the rest waits for bytesWritten
+    SOCKET_WRITE_BUFFER = 1 << 16
 
-    DEFAULT_TIMEOUT_TIME = 2 * REGULAR_PDU_WAITING_TIME + DEFAULT_WAITING_TIME
-
-    MAXIMUM_DATAGRAM_LENGTH = 10000
+    # log the metrics every this many ms, 0 never
+    METRICS_LOG_TIME = DEFAULT_METRICS_LOG_TIME
 
     debug_output = QtCore.pyqtSignal(str)
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, codec=None, log_directory=None):
         global server_start_port
 
         QtCore.QObject.__init__(self, parent)
-
-        # Create a channel with a unique id
-        self.id = str(uuid.uuid1())
-        self.port = server_start_port
-        self.pdu_number = 0
+        ServerProtocol.__init__(self, server_start_port, codec,
+                                log_directory=log_directory)
         server_start_port += 1
 
         self.create_udp_socket()
         self.tcp_server = QtNetwork.QTcpServer(self)
 
-        # mapping from (channel_id) to a list of (client_id, tcp_socket)
-        self.channels = {}
-
-        # mapping from (QHostAddress -> address) to (str -> client_id)
-        self.users = {}
-
-        # mapping from (QHostAddress -> address) to (QTimer -> timer)
-        self.users_timers = {}
-
         if not self.tcp_server.listen(QtNetwork.QHostAddress.Any, self.port):
             log.error("Unable to start the server: %s." %
                 self.tcp_server.errorString())
@@ -600,33 +1335,24 @@ class Server(QtCore.QObject):
         # do something, when we are connected
         self.tcp_server.newConnection.connect(self.handle_connection)
 
-        # setup the regular_pdu_timer for the regular pdu
-        self.regular_pdu_timer = QtCore.QTimer()
-        self.regular_pdu_timer.timeout.connect(self.send_regular_pdu)
-        self.regular_pdu_timer.start(self.REGULAR_PDU_WAITING_TIME)
-
-        self.tcp_sockets = []
+        self.start_timers()
 
-    def _get_channel_from_user_list(self, tcp_socket):
-        for channel_id, client_sockets in self.channels.items():
-            for (client_id, t_socket) in copy.copy(client_sockets):
+        if self.METRICS_LOG_TIME:
+            self.metrics_timer = QtCore.QTimer()
+            self.metrics_timer.timeout.connect(
+                lambda: log.info(self.metrics.summary()))
+            self.metrics_timer.start(self.METRICS_LOG_TIME)
 
-                # compare sockets
-                if tcp_socket == t_socket:
-                    return channel_id, client_id
+    def call_later(self, delay, function):
+        QtCore.QTimer.singleShot(delay, function)
 
     #
     # SOCKET FUNCTIONS
     #
-    # create a socket for the PDUs
+    # the PDUs of the other peers come through the discovery bus
     def create_udp_socket(self):
-        self.udp_socket = QtNetwork.QUdpSocket()
-        self.udp_socket.bind(broadcast_port,
-                             QtNetwork.QUdpSocket.ReuseAddressHint)
-        self.udp_socket.joinMulticastGroup(group_address_ip4)
-
-        # connect the socket input with the processing function
-        self.udp_socket.readyRead.connect(self._process_pending_datagrams)
+        self.bus = get_discovery_bus()
+        self.bus.register(self.id, self.handle_pdu)
 
     # if server gets a new connection request create a socket
     def handle_connection(self):
@@ -636,11 +1362,24 @@ class Server(QtCore.QObject):
 
         print "incoming tcp connection"
 
-        self.tcp_sockets.append(tcp_socket)
+        self.connections.add(tcp_socket)
 
-        # if socket is disconnected, delete it later
+        # the pdus of the client come from this address
+        tcp_socket.address = tcp_socket.peerAddress()
+
+        # if socket is disconnected, forget it and delete it later
+        tcp_socket.disconnected.connect(lambda:
+            self.remove_connection(tcp_socket))
         tcp_socket.disconnected.connect(tcp_socket.deleteLater)
 
+        # a socket reassembles its own commands and queues its output
+        tcp_socket.framer = CommandFramer()
+        tcp_socket.outbound = OutboundQueue(self.OUTBOUND_HIGH_WATER_MARK,
+                                            self.OUTBOUND_POLICY)
+
+        # mapping from (channel_id) to (ChannelEndpoint), if multiplexed
+        tcp_socket.endpoints = {}
+
         if not tcp_socket.waitForConnected(self.DEFAULT_WAITING_TIME):
 
             # if there is no connection established, show error
@@ -650,257 +1389,91 @@ class Server(QtCore.QObject):
             # if the connection is ready, read from tcp_socket
             tcp_socket.readyRead.connect(lambda:
                 self.read_from_tcp_socket(tcp_socket))
-            tcp_socket.waitForReadyRead(self.DEFAULT_WAITING_TIME)
-
-    def read_from_tcp_socket(self, tcp_socket):
-        data = str(tcp_socket.readAll())
-        tcp_socket.flush()
-        self.handle_data(data, tcp_socket)
 
-    #
-    # PROCESSING FUNCTIONS (INCOMING PDUS)
-    #
-    def _process_pending_datagrams(self):
+            # refill the socket whenever it has written something
+            tcp_socket.bytesWritten.connect(lambda _:
+                self._flush_socket(tcp_socket))
+
+    # queue an encoded command for a client socket
+    def send_frame(self, tcp_socket, frame):
+        if not tcp_socket.outbound.put(frame):
+            log.error("client %s is too slow, disconnecting" %
+                      tcp_socket.address.toString())
+            tcp_socket.outbound.clear()
+            tcp_socket.abort()
+            return
+        self._flush_socket(tcp_socket)
 
-        # loop through all datagrams which are not send yet
-        while self.udp_socket.hasPendingDatagrams():
-            (datagram, address, _) = self.udp_socket.readDatagram(self.MAXIMUM_DATAGRAM_LENGTH)
+    # move queued frames into the socket, as far as its buffer allows
+    def _flush_socket(self, tcp_socket):
+        outbound = tcp_socket.outbound
+        budget = self.SOCKET_WRITE_BUFFER - tcp_socket.bytesToWrite()
+        if outbound and budget > 0:
             try:
-                packet = InstantSoupData.peer_pdu.parse(datagram)
-            except core.ArrayError:
-                #log.debug("Array Error %s" % address.toString())
-                #log.debug(repr(datagram))
-                #log.debug(self.id)
-                return
-            uid = packet['id']
-            if uid != self.id:
-                for option in packet["option"]:
-                    if option["option_id"] == "CLIENT_NICK_OPTION":
-                        self.handle_client_nick_option(address, uid)
-
-    def handle_client_nick_option(self, address, client_id):
-        do_update = False
+                tcp_socket.write(outbound.take(budget))
+            except RuntimeError:
+                log.debug("Socket deleted")
+                outbound.clear()
 
-        if address not in self.users:
-            do_update = True
+    def read_from_tcp_socket(self, tcp_socket):
+        data = str(tcp_socket.readAll())
+        tcp_socket.flush()
+        try:
+            with self.metrics.time("parse_seconds", kind="command"):
+                commands = tcp_socket.framer.feed(data)
+        except CodecError as error:
+            log.error("broken command stream: %s" % error)
+            self.metrics.count("parse_errors_total", kind="command")
+            tcp_socket.abort()
+            return
+        for command in commands:
+            self.handle_data(command, tcp_socket)
+
+    # our pdus go out with the client's ones of this process
+    def send_pdu(self, datagram, option_ids):
+        self.bus.announce(datagram, self.id, option_ids)
+
+    # the lobby's multicast group, or a single peer (an invite)
+    def send_datagram(self, datagram, address=None, port=None):
+        if address is None:
+            self.bus.send_datagram(datagram, group_address_ip4,
+                                   broadcast_port)
+            self.bus.send_datagram(datagram, group_address_ip6,
+                                   broadcast_port)
         else:
-            if self.users[address] != client_id:
-                do_update = True
-
-        if do_update:
-            self.users[address] = client_id
-
-            # start timer for server timeout
-            self.users_timers[address] = QtCore.QTimer()
-            self.users_timers[address].timeout.connect(lambda:
-                self.remove_client(address))
-
-            # if we detect this option, maybe a new client was started
-            # -> broadcast rapidly server data and channels
-            self.send_server_option()
-            timer = QtCore.QTimer()
-            timer.singleShot(1000, self.send_server_channel_option)
-
-        # restart the timer
-        self.users_timers[address].start(self.DEFAULT_TIMEOUT_TIME)
-
-    #
-    # PROCESSING FUNCTIONS (INCOMING SERVER COMMANDOS)
-    #
-    def handle_data(self, command, tcp_socket):
-        data = InstantSoupData.command.parse(command)
-
-        if data.startswith("SAY"):
-            self.handle_say_command(data, tcp_socket)
-        elif data.startswith("JOIN"):
-            self.handle_join_command(data, tcp_socket)
-        elif data.startswith("EXIT"):
-            self.handle_exit_command(data, tcp_socket)
-        elif data.startswith("INVITE"):
-            self.handle_invite_command(data, tcp_socket)
-
-    def handle_exit_command(self, data, tcp_socket):
-        address = tcp_socket.peerAddress()
-
-        # is user known?
-        if address in self.users:
-            client_id = self.users[tcp_socket.peerAddress()]
-            channel_id, _ = self._get_channel_from_user_list(tcp_socket)
-
-            # is channel known?
-            if channel_id in self.channels:
-                key = (client_id, tcp_socket)
-
-                # remove if set
-                if key in self.channels[channel_id]:
-                    self.channels[channel_id].remove(key)
-
-    def handle_say_command(self, data, tcp_socket):
-        address = tcp_socket.peerAddress()
-
-        # is user known?
-        if address in self.users:
-
-            # build the key to get the channel_id
-            client_id = self.users[address]
-            channel_id, _ = self._get_channel_from_user_list(tcp_socket)
-            message = " ".join(data.split("\x00")[1:])
-
-            # is channel known?
-            if channel_id in self.channels:
-
-                # send to all clients in channel
-                for (_, socket) in self.channels[channel_id]:
-                    command = "SAY\x00%s\x00%s\x00" % (client_id, message)
-                    data = InstantSoupData.command.build(command)
-                    socket.write(data)
-                    socket.waitForBytesWritten(self.DEFAULT_WAITING_TIME)
-
-    def handle_join_command(self, data, tcp_socket):
-        address = tcp_socket.peerAddress()
-
-        # is user known?
-        if address in self.users:
-            client_id = self.users[address]
-            channel_name = data.split("\x00")[1]
-
-            # is channel known?
-            if channel_name in self.channels:
-                self.channels[channel_name].add((client_id, tcp_socket))
-            else:
-                private = channel_name.startswith("@")
-
-                # create a new channel
-                self.channels[channel_name] = set()
-                self.channels[channel_name].add((client_id, tcp_socket))
-
-                if not private:
-                    self.send_server_channel_option()
-
-    def handle_invite_command(self, data, tcp_socket):
-        #client_id = self.users[tcp_socket.peerAddress()]
-        channel_id, _ = self._get_channel_from_user_list(tcp_socket)
-        invite_client_ids = data.split("\x00")[1:]
-        self.send_server_invite_option(invite_client_ids, channel_id)
-        #print client_id, "wants to invite", invite_client_ids, "into channel", channel_id
-        #print "raw data", repr(data)
-
-    def send_server_invite_option(self, invite_client_ids, channel_id):
-        # for each client_id find the socket on which to send the
-        # server_invite option
-        for invite_client_id in invite_client_ids:
-            for _, client_sockets in self.channels.items():
-                for (client_id, socket) in client_sockets:
-                    if invite_client_id == client_id:
-                        #Hier kann es auch sein, dass nur eine Id gebraucht 
-                        #wird und nicht eine Liste...
-                        option_data = Container(channel_id=channel_id,
-                                          client_id=invite_client_ids
-                                      )
-
-                        option = Container(option_id="SERVER_INVITE_OPTION",
-                                     option_data=option_data
-                                 )
-
-                        pdu = Container(id=self.id, option=[option])
-                    
-                        ip_to_invite = QtNetwork.QHostAddress(socket.peerAddress())
-                        udpSocket_for_invites =  QtNetwork.QUdpSocket(self)
-                        udpSocket_for_invites.bind(ip_to_invite, broadcast_port, QtNetwork.QUdpSocket.ShareAddress)
-                        udpSocket_for_invites.writeDatagram(InstantSoupData.peer_pdu.build(pdu), ip_to_invite, broadcast_port)
-                        
-        log.debug('PDU: SERVER_INVITE_OPTION - id: %i - SENT' %
-                  self.pdu_number)
-
-    def send_regular_pdu(self):
-
-        # simply send all data
-        self.send_server_option()
-
-        # sent the option with every fourth pdu (see rfc)
-        if self.pdu_number % 4 == 0:
-            self.send_server_channel_option()
-
-    def send_server_option(self):
-
-        # define the data to send & send
-        option_data = Container(port=self.port)
-
-        option = Container(option_id="SERVER_OPTION",
-                   option_data=option_data)
-
-        pdu = Container(id=self.id,
-                option=[option])
-
-        #print pdu
-        data = InstantSoupData.peer_pdu.build(pdu)
-        #print repr(data)
-        #test = InstantSoupData.peer_pdu.parse(data)
-        #print test
-        self.send_datagram(data)
-
-        log.debug('PDU: SERVER_OPTION - id: %i - SENT' % self.pdu_number)
-
-        # increment the number of sent packets
-        self.pdu_number += 1
-
-    def send_server_channel_option(self):
-        public_channels = [channel for channel in self.channels if not channel.startswith("@")]
-        if public_channels:
-
-            # define the data to send & send
-            option_data = Container(channels=public_channels)
-
-            option = Container(option_id="SERVER_CHANNELS_OPTION",
-                         option_data=option_data
-                     )
-
-            pdu = Container(id=self.id,
-                    option=[option])
+            self.bus.send_datagram(datagram, QtNetwork.QHostAddress(address),
+                                   port or broadcast_port)
 
-            data = InstantSoupData.peer_pdu.build(pdu)
-            self.send_datagram(data)
 
-            log.debug('PDU: SERVER_CHANNELS_OPTION - id: %i - SENT' %
-                      self.pdu_number)
-
-    def send_datagram(self, datagram):
-        self.udp_socket.writeDatagram(datagram, group_address_ip4,
-                                      broadcast_port)
-        self.udp_socket.writeDatagram(datagram, group_address_ip6,
-                                      broadcast_port)
-
-    def remove_client(self, key):
-        self.users_timers[key].stop()
-        del self.users_timers[key]
-        del self.users[key]
-
-# search a dictionary for key or value
-# using named functions or a class
-# tested with Python25   by Ene Uran    01/19/2008
-
-
-class Lookup(dict):
-    """
-    a dictionary which can lookup value by key, or keys by value
+class MetricsServer(QtCore.QObject):
     """
+    a local http endpoint for the metrics of registries, on the Qt loop
 
-    def __init__(self, items=[]):
-        """items can be a list of pair_lists or a dictionary"""
-        dict.__init__(self, items)
+    Like instantsoupmetrics.MetricsEndpoint: ``GET /metrics`` returns the
+    Prometheus text format, ``GET /profile`` the sampling profiler report.
+    """
 
-    def get_key(self, value):
-        """find the key(s) as a list given a value"""
-        return [item[0] for item in self.items() if item[1] == value]
+    def __init__(self, registries, port, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.registries = registries
 
-    def get_value(self, key):
-        """find the value given a key"""
-        return self[key]
+        self.tcp_server = QtNetwork.QTcpServer(self)
+        if not self.tcp_server.listen(QtNetwork.QHostAddress.LocalHost, port):
+            log.error("Unable to serve the metrics: %s." %
+                self.tcp_server.errorString())
+        self.tcp_server.newConnection.connect(self.handle_connection)
 
-    def find_key(self, val):
-        """return the key of dictionary dic given the value"""
-        return [k for k, v in self.iteritems() if v == val][0]
+    def handle_connection(self):
+        tcp_socket = self.tcp_server.nextPendingConnection()
+        tcp_socket.request = ""
+        tcp_socket.readyRead.connect(lambda:
+            self._read_request(tcp_socket))
+        tcp_socket.disconnected.connect(tcp_socket.deleteLater)
 
-    def find_value(self, key):
-        """return the value of dictionary dic given the key"""
-        return self[key]
+    def _read_request(self, tcp_socket):
+        tcp_socket.request += str(tcp_socket.readAll())
+        if "\n\n" in tcp_socket.request or \
+           "\r\n\r\n" in tcp_socket.request:
+            tcp_socket.write(http_response(self.registries,
+                                           tcp_socket.request))
+            tcp_socket.disconnectFromHost()
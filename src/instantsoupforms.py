@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Qt Designer forms of the client, compiled to Python.
+
+``uic.loadUi`` parses the XML of a form every time a widget is built from
+it. Instead, every ``gui/<name>.ui`` is compiled once with ``uic.compileUi``
+into ``gui/<name>_ui.py``, which is imported the first time the form is
+needed and compiled again whenever the ``.ui`` file is newer. Running this
+module compiles all forms ahead of time, e.g. after an install.
+
+:class:`WidgetPool` keeps a few widgets built while the event loop is idle
+and takes back the widgets that are not needed anymore, so opening a tab
+does not build a form at all.
+"""
+
+import glob
+import imp
+import logging
+import os
+import sys
+
+from cStringIO import StringIO
+from PyQt4 import QtGui, uic
+
+log = logging.getLogger("instantsoup")
+
+FORM_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "gui")
+
+# mapping from (form name) to the widget class built from it
+_form_classes = {}
+
+
+def _paths(name):
+    source = os.path.join(FORM_DIRECTORY, name + ".ui")
+    return source, os.path.join(FORM_DIRECTORY, name + "_ui.py")
+
+
+def compile_form(name):
+    """compile gui/<name>.ui unless it is up to date, return the module path"""
+    source, target = _paths(name)
+    if os.path.exists(target) and \
+       os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+    with open(target, "w") as output:
+        uic.compileUi(source, output)
+    log.debug("compiled %s" % target)
+    return target
+
+
+def form_class(name):
+    """return the widget class of gui/<name>.ui, compiled on first use"""
+    widget_class = _form_classes.get(name)
+    if widget_class is not None:
+        return widget_class
+
+    try:
+        namespace = vars(imp.load_source(name + "_ui", compile_form(name)))
+    except (IOError, OSError) as error:
+
+        # a read-only installation compiles the form in memory
+        log.debug("can't compile form %s: %s" % (name, error))
+        code = StringIO()
+        uic.compileUi(_paths(name)[0], code)
+        namespace = {}
+        exec code.getvalue() in namespace
+
+    ui_class = [value for key, value in namespace.items()
+                if key.startswith("Ui_")][0]
+
+    # the forms are plain QWidgets (see gui/*.ui)
+    class FormWidget(QtGui.QWidget, ui_class):
+        def __init__(self, parent=None):
+            QtGui.QWidget.__init__(self, parent)
+            self.setupUi(self)
+
+    FormWidget.__name__ = str(name)
+    _form_classes[name] = FormWidget
+    return FormWidget
+
+
+class WidgetPool(object):
+    """
+    widgets built ahead of time and reused once released
+
+    ``factory()`` builds a widget, ``reset(widget)`` makes a released one
+    look new again. At most ``size`` widgets wait in the pool, the others
+    are deleted when released.
+    """
+
+    def __init__(self, factory, reset, size):
+        self.factory = factory
+        self.reset = reset
+        self.size = size
+        self.widgets = []
+
+    def fill(self):
+        """build widgets until the pool is full"""
+        while len(self.widgets) < self.size:
+            self.widgets.append(self.factory())
+
+    def acquire(self):
+        if self.widgets:
+            return self.widgets.pop()
+        return self.factory()
+
+    def release(self, widget):
+        if len(self.widgets) < self.size:
+            self.reset(widget)
+            self.widgets.append(widget)
+        else:
+            widget.deleteLater()
+
+    def __len__(self):
+        return len(self.widgets)
+
+
+def main():
+    for source in sorted(glob.glob(os.path.join(FORM_DIRECTORY, "*.ui"))):
+        print compile_form(os.path.splitext(os.path.basename(source))[0])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
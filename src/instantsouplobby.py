@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lobby views of the Qt client.
+
+The channel tree and the user lists follow the Client item by item, indexed
+by server_id, channel_id and client_id: only the items that differ are
+added, removed or renamed. Unchanged items are left alone, so the selection
+and the expanded state survive an update. :meth:`ChannelTree.apply` looks
+only at the servers, channels and members a ChangeSet of the Client names,
+:meth:`ChannelTree.update` compares everything.
+
+Items carry the identifiers the MainWindow works with as attributes:
+``server_id``, ``channel_id`` and ``client_id``.
+"""
+
+from PyQt4 import QtGui, QtNetwork
+
+
+class UserList(object):
+    """keeps a QListWidget showing one item per client"""
+
+    def __init__(self, list_widget, **identifiers):
+        self.list_widget = list_widget
+
+        # attributes every item gets, e.g. server_id and channel_id
+        self.identifiers = identifiers
+
+        # mapping from (client_id) to (QListWidgetItem)
+        self.items = {}
+
+    def update(self, nicknames):
+        """show nicknames, a mapping from client_id to nickname"""
+        self.apply(nicknames, set(self.items) | set(nicknames))
+
+    def apply(self, nicknames, client_ids):
+        """show the client_ids of nicknames, remove those not in it"""
+        for client_id in client_ids:
+            nickname = nicknames.get(client_id)
+            item = self.items.get(client_id)
+            if nickname is None:
+                if item is not None:
+                    del self.items[client_id]
+                    self.list_widget.takeItem(self.list_widget.row(item))
+            elif item is None:
+                item = QtGui.QListWidgetItem()
+                item.setText(nickname)
+                item.client_id = client_id
+                for name, value in self.identifiers.items():
+                    setattr(item, name, value)
+                self.list_widget.addItem(item)
+                self.items[client_id] = item
+            elif item.text() != nickname:
+                item.setText(nickname)
+
+
+class ChannelTree(object):
+    """keeps a QTreeWidget showing servers, their channels and members"""
+
+    def __init__(self, tree_widget):
+        self.tree_widget = tree_widget
+
+        # mapping from (server_id) to (QTreeWidgetItem)
+        self.servers = {}
+
+        # mapping from (server_id, channel_id) to (QTreeWidgetItem)
+        self.channels = {}
+
+        # mapping from (server_id, channel_id, client_id) to (QTreeWidgetItem)
+        self.clients = {}
+
+        # mapping from (client_id) to a set of (server_id, channel_id) it is
+        # shown in, to find the items of a renamed user
+        self.client_channels = {}
+
+    def update(self, client):
+        """show everything the client knows"""
+        servers = set(self.servers)
+        servers.update(server_id for server_id, _ in client.servers)
+        channels = set(self.channels)
+        channels.update(key for key in client.servers if key[1])
+        clients = set(self.clients)
+        for key, client_ids in client.membership.items():
+            clients.update(key + (client_id,) for client_id in client_ids)
+        self._refresh(client, servers, channels, clients)
+
+    def apply(self, client, changes):
+        """show a ChangeSet of client, only the items it touches"""
+        keys = changes.servers_added | changes.servers_removed
+        servers = set(server_id for server_id, _ in keys)
+        channels = set(key for key in keys if key[1])
+        clients = changes.memberships_added | changes.memberships_removed
+
+        # a user's items follow its nickname
+        for client_id in (changes.users_added | changes.users_removed |
+                          changes.users_renamed):
+            for key in client.client_memberships.get(client_id, ()):
+                clients.add(key + (client_id,))
+            for key in self.client_channels.get(client_id, ()):
+                clients.add(key + (client_id,))
+
+        # a channel that shows up brings its members along
+        for key in channels:
+            for client_id in client.membership.get(key, ()):
+                clients.add(key + (client_id,))
+
+        self._refresh(client, servers, channels, clients)
+
+    def _refresh(self, client, servers, channels, clients):
+        """compare the given items with the client, add, rename or remove"""
+        server_texts = dict((server_id, self._server_text(client, server_id))
+                            for server_id in servers)
+        channel_texts = dict((key, self._channel_text(client, key))
+                             for key in channels)
+        client_texts = {}
+        for key in clients:
+            channel_key = key[:2]
+            if channel_key not in channel_texts:
+                channel_texts[channel_key] = self._channel_text(client,
+                                                                channel_key)
+            client_texts[key] = self._client_text(
+                client, key, channel_texts[channel_key])
+
+        # remove what is gone, children before their parents
+        for texts, items in ((client_texts, self.clients),
+                             (channel_texts, self.channels),
+                             (server_texts, self.servers)):
+            for key, text in texts.items():
+                if text is None and key in items:
+                    self._remove(items[key])
+
+        # add or rename the rest, parents before their children
+        for server_id, text in server_texts.items():
+            if text is not None:
+                self._show(self.servers, server_id, text, None,
+                           server_id=server_id)
+        for (server_id, channel_id), text in channel_texts.items():
+            if text is None:
+                continue
+
+            # the server shows with the first of its channels
+            if server_id not in self.servers:
+                self._show(self.servers, server_id,
+                           self._server_text(client, server_id), None,
+                           server_id=server_id)
+            self._show(self.channels, (server_id, channel_id), text,
+                       self.servers[server_id],
+                       server_id=server_id, channel_id=channel_id)
+        for (server_id, channel_id, client_id), text in client_texts.items():
+            if text is None:
+                continue
+            self._show(self.clients, (server_id, channel_id, client_id), text,
+                       self.channels[(server_id, channel_id)],
+                       server_id=server_id, channel_id=channel_id,
+                       client_id=client_id)
+            self.client_channels.setdefault(client_id, set()).add(
+                (server_id, channel_id))
+
+    def _show(self, items, key, text, parent, **identifiers):
+        item = items.get(key)
+        if item is None:
+            item = QtGui.QTreeWidgetItem([text])
+
+            # set known identifiers
+            for name, value in identifiers.items():
+                setattr(item, name, value)
+
+            if parent is None:
+                self.tree_widget.addTopLevelItem(item)
+            else:
+                parent.addChild(item)
+            item.setExpanded(True)
+            items[key] = item
+        elif item.text(0) != text:
+            item.setText(0, text)
+
+    def _remove(self, item):
+        """remove item and its children from the tree"""
+        self._forget(item)
+        parent = item.parent()
+        if parent is None:
+            self.tree_widget.takeTopLevelItem(
+                self.tree_widget.indexOfTopLevelItem(item))
+        else:
+            parent.removeChild(item)
+
+    def _forget(self, item):
+        for index in range(item.childCount()):
+            self._forget(item.child(index))
+
+        if hasattr(item, "client_id"):
+            key = (item.server_id, item.channel_id)
+            del self.clients[key + (item.client_id,)]
+            channels = self.client_channels[item.client_id]
+            channels.discard(key)
+            if not channels:
+                del self.client_channels[item.client_id]
+        elif hasattr(item, "channel_id"):
+            del self.channels[(item.server_id, item.channel_id)]
+        else:
+            del self.servers[item.server_id]
+
+    #
+    # TEXTS, None for items that are not shown
+    #
+    @staticmethod
+    def _connected(socket):
+        try:
+
+            # skip connections, that are not usable yet
+            return socket.state() == QtNetwork.QAbstractSocket.ConnectedState
+        except RuntimeError:
+            return False
+
+    def _server_text(self, client, server_id):
+
+        # the server's own connection first, else any of its channels
+        keys = sorted(client.servers.server_keys(server_id),
+                      key=lambda key: key[1] is not None)
+        for key in keys:
+            socket = client.servers[key]
+            if self._connected(socket):
+                return "Server %s" % socket.peerAddress().toString()
+        return None
+
+    def _channel_text(self, client, key):
+        socket = client.servers.get(key)
+        if not key[1] or socket is None or not self._connected(socket):
+            return None
+        return (key[1] + ' (' + socket.localAddress().toString() + ':' +
+                str(socket.localPort()) + ')')
+
+    @staticmethod
+    def _client_text(client, key, channel_text):
+
+        # show all known clients of a channel that is shown
+        (server_id, channel_id, client_id) = key
+        if channel_text is None or client_id not in client.users or \
+           client_id not in client.membership.get((server_id, channel_id), ()):
+            return None
+        return client.users[client_id]
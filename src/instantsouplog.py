@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+On-disk chat log of InstantSOUP.
+
+Every channel gets a directory of segments. A segment ``<first record>.log``
+holds the records one after the other, each of them
+
+    time (double) | nickname length (UBInt16) | message length (UBInt32) |
+    nickname | message | record length (UBInt32)
+
+The trailing length lets :meth:`ChannelLog.last` walk backwards from the end
+of the newest segment, so scrolling back costs the same however big the log
+is. Every ``INDEX_INTERVAL``-th record (and the first of each segment) also
+gets an entry ``(record number, time, offset)`` in the sparse index
+``<first record>.idx``, which :meth:`ChannelLog.between` uses to find a time
+range without reading the segments before it. Segments are only ever
+appended to, and read through ``mmap``.
+
+A segment is closed once it holds ``segment_size`` bytes, and the oldest
+segments are deleted while a channel has more than ``maximum_segments``, so
+the disk use of a channel stays bounded. The files of a segment are opened
+by the first append, and :class:`ChatLog` closes them again for all but the
+``maximum_open`` channels written last, so a server with many channels
+doesn't run out of file descriptors.
+
+The log is optional: :func:`get_chat_log` returns None unless a directory is
+given or set in the ``INSTANTSOUP_LOG_DIRECTORY`` environment variable.
+"""
+
+import bisect
+import collections
+import logging
+import mmap
+import os
+import struct
+import urllib
+
+log = logging.getLogger("instantsoup")
+
+_header = struct.Struct(">dHI")
+_trailer = struct.Struct(">I")
+_index_entry = struct.Struct(">QdQ")
+
+DEFAULT_LOG_DIRECTORY = os.environ.get("INSTANTSOUP_LOG_DIRECTORY")
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return str(value)
+
+
+def _truncate(data, length):
+    """cut utf8 data to at most length bytes, never inside a character"""
+    if len(data) <= length:
+        return data
+
+    # skip back over the continuation bytes of the character cut in two
+    end = length
+    while end > 0 and (ord(data[end]) & 0xc0) == 0x80:
+        end -= 1
+    return data[:end]
+
+
+class ChannelLog(object):
+    """the append-only log of one channel, see the module documentation"""
+
+    # every this many records get an entry in the sparse index
+    INDEX_INTERVAL = 64
+
+    def __init__(self, directory, segment_size=1 << 22, maximum_segments=16):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.maximum_segments = maximum_segments
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # numbers of the first record of every segment, oldest first
+        self.segments = sorted(int(name[:-4], 16)
+                               for name in os.listdir(directory)
+                               if name.endswith(".log"))
+
+        # mapping from (first record) to the index entries of the segment
+        self.indexes = {}
+
+        # number of the next record, size of the newest segment and
+        # the time of its last record
+        self.number = 0
+        self.size = 0
+        self.last_time = 0.0
+
+        if self.segments:
+            self._recover()
+        else:
+            self.segments.append(0)
+        self._open_segment()
+
+    def _path(self, first, extension):
+        return os.path.join(self.directory, "%016x.%s" % (first, extension))
+
+    def _recover(self):
+        """find the end of the newest segment, drop a partly written record"""
+        first = self.segments[-1]
+        index = self._index(first)
+        if index:
+            self.number, self.last_time, offset = index[-1]
+        else:
+            self.number, offset = first, 0
+
+        path = self._path(first, "log")
+        with open(path, "rb") as log_file:
+            log_file.seek(offset)
+            data = log_file.read()
+
+        position = 0
+        while position + _header.size <= len(data):
+            timestamp, nickname_length, message_length = \
+                _header.unpack_from(data, position)
+            length = (_header.size + nickname_length + message_length +
+                      _trailer.size)
+            if position + length > len(data) or \
+               _trailer.unpack_from(data, position + length -
+                                    _trailer.size)[0] != length:
+                break
+            position += length
+            self.number += 1
+            self.last_time = timestamp
+
+        self.size = offset + position
+        if offset + len(data) > self.size:
+            log.error("dropping %i bytes of a broken record in %s" %
+                      (offset + len(data) - self.size, path))
+            with open(path, "r+b") as log_file:
+                log_file.truncate(self.size)
+
+    def _open_segment(self):
+        self.log_file = None
+        self.index_file = None
+        self.indexes.setdefault(self.segments[-1], [])
+
+    def _open_files(self):
+        first = self.segments[-1]
+        self.log_file = open(self._path(first, "log"), "ab")
+        self.index_file = open(self._path(first, "idx"), "ab")
+
+    def _rotate(self):
+        self.close()
+        self.segments.append(self.number)
+        self.size = 0
+        self._open_segment()
+
+        # keep the disk use bounded, the oldest messages go first
+        while len(self.segments) > self.maximum_segments:
+            first = self.segments.pop(0)
+            self.indexes.pop(first, None)
+            for extension in ("log", "idx"):
+                os.remove(self._path(first, extension))
+
+    def _index(self, first):
+        """return the sparse index of segment first, read on first use"""
+        index = self.indexes.get(first)
+        if index is None:
+            path = self._path(first, "idx")
+            data = ""
+            if os.path.exists(path):
+                with open(path, "rb") as index_file:
+                    data = index_file.read()
+            index = [_index_entry.unpack_from(data, offset) for offset in
+                     xrange(0, len(data) - _index_entry.size + 1,
+                            _index_entry.size)]
+
+            # entries past the end of the log (a broken record) don't count
+            if first == self.segments[-1] and self.size:
+                index = [entry for entry in index if entry[2] < self.size]
+            self.indexes[first] = index
+        return index
+
+    def append(self, timestamp, nickname, message):
+        if self.size >= self.segment_size:
+            self._rotate()
+        if self.log_file is None:
+            self._open_files()
+
+        timestamp = max(timestamp, self.last_time)
+        nickname = _truncate(_bytes(nickname), 0xffff)
+        message = _bytes(message)
+        length = (_header.size + len(nickname) + len(message) +
+                  _trailer.size)
+        self.log_file.write("".join([
+            _header.pack(timestamp, len(nickname), len(message)),
+            nickname, message, _trailer.pack(length)]))
+        self.log_file.flush()
+
+        if self.size == 0 or self.number % self.INDEX_INTERVAL == 0:
+            entry = (self.number, timestamp, self.size)
+            self.index_file.write(_index_entry.pack(*entry))
+            self.index_file.flush()
+            self.indexes[self.segments[-1]].append(entry)
+
+        self.number += 1
+        self.size += length
+        self.last_time = timestamp
+
+    def _map(self, first):
+        """map segment first into memory, None if it is empty"""
+        with open(self._path(first, "log"), "rb") as log_file:
+            size = os.fstat(log_file.fileno()).st_size
+            if not size:
+                return None
+            return mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _record(data, offset):
+        """return ((time, nickname, message), offset of the next record)"""
+        timestamp, nickname_length, message_length = \
+            _header.unpack_from(data, offset)
+        start = offset + _header.size
+        middle = start + nickname_length
+        end = middle + message_length
+        # a damaged record shouldn't make the whole log unreadable
+        entry = (timestamp, data[start:middle].decode("utf8", "replace"),
+                 data[middle:end].decode("utf8", "replace"))
+        return entry, end + _trailer.size
+
+    def last(self, count):
+        """return the newest count messages, oldest first"""
+        entries = []
+        for first in reversed(self.segments):
+            if len(entries) >= count:
+                break
+            data = self._map(first)
+            if data is None:
+                continue
+            try:
+                offset = self.size if first == self.segments[-1] else len(data)
+                while offset > 0 and len(entries) < count:
+                    offset -= _trailer.unpack_from(data,
+                                                   offset - _trailer.size)[0]
+                    entries.append(self._record(data, offset)[0])
+            finally:
+                data.close()
+        entries.reverse()
+        return entries
+
+    def between(self, start, end):
+        """return the messages with start <= time < end, oldest first"""
+
+        # the last segment starting before start, the last index entry
+        # before start in it
+        position = 0
+        for number, first in enumerate(self.segments):
+            index = self._index(first)
+            if not index or index[0][1] >= start:
+                break
+            position = number
+        index = self._index(self.segments[position])
+        times = [entry[1] for entry in index]
+        entry_number = bisect.bisect_left(times, start) - 1
+        offset = index[entry_number][2] if entry_number >= 0 else 0
+
+        entries = []
+        for first in self.segments[position:]:
+            data = self._map(first)
+            if data is None:
+                continue
+            try:
+                size = self.size if first == self.segments[-1] else len(data)
+                while offset < size:
+                    entry, offset = self._record(data, offset)
+                    if entry[0] >= end:
+                        return entries
+                    if entry[0] >= start:
+                        entries.append(entry)
+            finally:
+                data.close()
+            offset = 0
+        return entries
+
+    def close(self):
+        """close the files, the next append opens them again"""
+        if self.log_file is not None:
+            self.log_file.close()
+            self.index_file.close()
+            self.log_file = None
+            self.index_file = None
+
+    def __len__(self):
+        return self.number - self.segments[0]
+
+
+class ChatLog(object):
+    """
+    mapping from a channel key to its :class:`ChannelLog`, below directory
+
+    A key is a channel_id or a tuple (server_id, channel_id), the logs are
+    opened on first use. Only the ``maximum_open`` logs appended to last keep
+    their files open.
+    """
+
+    def __init__(self, directory, segment_size=1 << 22, maximum_segments=16,
+                 maximum_open=64):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.maximum_segments = maximum_segments
+        self.maximum_open = maximum_open
+        self.channels = {}
+
+        # the logs with open files, least recently appended to first
+        self.open_channels = collections.OrderedDict()
+
+    def _directory(self, key):
+        if isinstance(key, tuple):
+            key = "/".join(_bytes(part) for part in key)
+        return os.path.join(self.directory, urllib.quote(_bytes(key), safe=""))
+
+    def append(self, key, timestamp, nickname, message):
+        channel_log = self[key]
+        channel_log.append(timestamp, nickname, message)
+
+        self.open_channels.pop(key, None)
+        self.open_channels[key] = channel_log
+        while len(self.open_channels) > self.maximum_open:
+            _, idle_log = self.open_channels.popitem(last=False)
+            idle_log.close()
+
+    def close(self):
+        for channel_log in self.channels.values():
+            channel_log.close()
+        self.channels.clear()
+        self.open_channels.clear()
+
+    def __getitem__(self, key):
+        channel_log = self.channels.get(key)
+        if channel_log is None:
+            channel_log = ChannelLog(self._directory(key), self.segment_size,
+                                     self.maximum_segments)
+            self.channels[key] = channel_log
+        return channel_log
+
+    def __contains__(self, key):
+        return key in self.channels or os.path.isdir(self._directory(key))
+
+
+def get_chat_log(directory=None):
+    """return a ChatLog below directory (or the default), else None"""
+    if directory is None:
+        directory = DEFAULT_LOG_DIRECTORY
+    if not directory:
+        return None
+    return ChatLog(directory)
@@ -17,10 +17,16 @@ import sys
 import logging
 import time
 
-from PyQt4 import QtCore, QtGui, uic
+# the time to the first window counts from here, Qt included
+STARTED = time.time()
+
+from PyQt4 import QtCore, QtGui
 from PyQt4.QtCore import Qt, QString, QRegExp
-from instantsoupdata import Client, Server
-from collections import defaultdict
+from instantsoupdata import Client, Server, MetricsServer
+from instantsoupmetrics import Metrics, DEFAULT_METRICS_PORT
+from instantsouplobby import ChannelTree, UserList
+from instantsoupforms import form_class, WidgetPool
+from collections import deque
 
 # Initialize logger & set logging level
 log = logging.getLogger("instantsoup")
@@ -32,12 +38,25 @@ try:
 except AttributeError:
     _fromUtf8 = lambda s: s
 
+# convert urls to hyperlinks, see
+# http://stackoverflow.com/questions/3321256/how-to-use-regex-to-replace-urls
+# -with-an-html-link-in-qt
+URL_PATTERN = QRegExp("((?:https?|ftp)://\\S+)")
+URL_LINK = QString("<a href=\"\\1\">\\1</a>")
+
 
 class MainWindow(QtGui.QMainWindow):
 
+    # channel tabs built while idle, and kept for reuse once closed
+    CHANNEL_TAB_POOL_SIZE = 4
+
     def __init__(self):
         super(MainWindow, self).__init__()
 
+        # startup and tab opening times (see instantsoupmetrics)
+        self.metrics = Metrics("instantsoup_ui")
+        self.startup_seconds = None
+
         #self.init_server()
         self.init_client()
         self.init_ui()
@@ -45,12 +64,34 @@ class MainWindow(QtGui.QMainWindow):
         # mapping from (server_id, channel_id) to (QWidget)
         self.tabs = {}
 
+        # mapping from (server_id, channel_id) to a tuple containing the
+        # number of messages rendered and the html of the newest of them
+        self.rendered = {}
+
+        # channels with messages that are not shown yet
+        self.pending_output = set()
+
+        self.channel_tabs = WidgetPool(self._build_channel_tab,
+                                       self._reset_channel_tab,
+                                       self.CHANNEL_TAB_POOL_SIZE)
+        self.metrics.gauge("pooled_channel_tabs",
+                           lambda: len(self.channel_tabs))
+
+        # the first window is up once the event loop runs
+        QtCore.QTimer.singleShot(0, self._started)
+
     def init_server(self):
         self.server = Server(parent=self)
 
     def init_client(self):
         self.client = Client(parent=self)
 
+        # serve the counters and timings, if asked to (see instantsoupmetrics)
+        if DEFAULT_METRICS_PORT:
+            self.metrics_server = MetricsServer(
+                [self.client.metrics, self.client.bus.metrics, self.metrics],
+                int(DEFAULT_METRICS_PORT), self)
+
     def init_ui(self):
         self.resize(800, 600)
         self.setWindowTitle('InstantSoup - Group 1')
@@ -60,8 +101,12 @@ class MainWindow(QtGui.QMainWindow):
         self.tab_widget.setMovable(False)
         self.tab_widget.setObjectName(_fromUtf8("tab_widget"))
 
-        self.lobby = uic.loadUi("gui/lobbyWidget.ui")
+        self.lobby = form_class("lobbyWidget")()
         self.lobby.setObjectName(_fromUtf8("lobby"))
+
+        # the lobby lists follow the client item by item
+        self.channel_tree = ChannelTree(self.lobby.channelsList)
+        self.user_list = UserList(self.lobby.usersList)
         self.tab_widget.addTab(self.lobby, _fromUtf8("Lobby"))
 
         grid_layout = QtGui.QGridLayout()
@@ -87,56 +132,59 @@ class MainWindow(QtGui.QMainWindow):
         # if we click on an item in the channel list
         self.lobby.channelsList.itemClicked.connect(self._handle_channel_list_click)
 
-        # if we have a new client, show it
-        self.client.client_new.connect(self._update_user_list)
-
-        # if we have lost a client, show it
-        self.client.client_removed.connect(self._update_user_list)
-        self.client.client_removed.connect(self._update_channel_user_list)
-
-        # if we have an updated nickname, show it in user and channel list
-        self.client.client_nick_change.connect(self._update_user_list)
-        self.client.client_nick_change.connect(self._update_channel_list)
-        self.client.client_nick_change.connect(self._update_channel_user_list)
-
-        # if we have a new membership, show it
-        self.client.client_membership_changed.connect(self._update_channel_list)
-        self.client.client_membership_changed.connect(self._update_channel_user_list)
-
-        # if we have a new server, show it
-        self.client.server_new.connect(self._update_channel_list)
-
-        # if we have lost a server
-        self.client.server_removed.connect(self._update_channel_list)
+        # if clients, servers or memberships changed, show it
+        self.client.changed.connect(self._apply_changes)
 
         # if we have a new message
         self.client.client_message_received[str, str].connect(self.output)
 
-    def output(self, server_id, channel_id):
-        key = (str(server_id), str(channel_id))
-        if key in self.client.channel_history:
-            if key in self.tabs:
-                tab = self.tabs[key]
-
-                tab.chatHistory.clear()
-                tab.chatHistory.setOpenExternalLinks(True)
-
-                for current_message in self.client.channel_history[key]:
-                    (time, nickname, message) = current_message
+    def _started(self):
+        self.startup_seconds = time.time() - STARTED
+        self.metrics.gauge("startup_seconds", lambda: self.startup_seconds)
+        log.debug("first window after %.3fs" % self.startup_seconds)
 
-                    # see   http://stackoverflow.com/questions/3321256/how-to
-                    #       -use-regex-to-replace-urls-with-an-html-link-in-qt
-                    qmessage = QtCore.QString(message)
+        # build the channel tabs before they are asked for
+        self.channel_tabs.fill()
 
-                    # convert urls to hyperlinks
-                    search = QRegExp("((?:https?|ftp)://\\S+)")
-                    replace = QString("<a href=\"\\1\">\\1</a>")
-                    qmessage.replace(search, replace)
-
-                    line = ("<p><b>%s</b> <em>%s</em></p><p>%s</p>" %
-                            (nickname, time.toString(), qmessage))
+    def output(self, server_id, channel_id):
 
-                    tab.chatHistory.append(line)
+        # show all messages of one event loop pass at once
+        if not self.pending_output:
+            QtCore.QTimer.singleShot(0, self._flush_output)
+        self.pending_output.add((str(server_id), str(channel_id)))
+
+    def _flush_output(self):
+        keys = self.pending_output
+        self.pending_output = set()
+        for key in keys:
+            if key in self.client.channel_history and key in self.tabs:
+                self._show_new_messages(key, self.tabs[key])
+
+    def _show_new_messages(self, key, tab):
+        history = self.client.channel_history[key]
+
+        # render only what came in since the last time
+        total, lines = self.rendered.get(key, (0, None))
+        if lines is None:
+            lines = deque(maxlen=Client.HISTORY_MAXIMUM_ENTRIES)
+        new_lines = [self._render_message(*entry)
+                     for entry in history.since(total)]
+        lines.extend(new_lines)
+        self.rendered[key] = (history.total, lines)
+
+        # a new tab gets everything we have rendered
+        if not tab.shown:
+            new_lines = list(lines)
+            tab.shown = True
+        if new_lines:
+            tab.chatHistory.append("".join(new_lines))
+
+    def _render_message(self, timestamp, nickname, message):
+        time = QtCore.QDateTime.fromTime_t(int(timestamp))
+        qmessage = QtCore.QString(message)
+        qmessage.replace(URL_PATTERN, URL_LINK)
+        return ("<p><b>%s</b> <em>%s</em></p><p>%s</p>" %
+                (nickname, time.toString(), qmessage))
 
     def get_invite_client_ids(self, tree_items):
         client_ids = set()
@@ -234,6 +282,7 @@ class MainWindow(QtGui.QMainWindow):
                 self.client.command_join(channel_id, server_id)
                 tab = self._add_channel_to_tab(channel_id, server_id, channel_id)
                 self.tabs[(server_id, channel_id)] = tab
+                self.output(server_id, channel_id)
             else:
                 msg_box = QtGui.QMessageBox()
                 msg_box.setText('Please enter a channel_id name!')
@@ -254,6 +303,9 @@ class MainWindow(QtGui.QMainWindow):
             tab = self._add_channel_to_tab(channel_name, server_id, channel_id)
             self.tabs[(server_id, channel_id)] = tab
 
+            # show what the log remembers of the channel
+            self.output(server_id, channel_id)
+
     def _leave_channel(self, tree_item):
         if hasattr(tree_item, 'channel_id'):
             server_id = tree_item.server_id
@@ -266,25 +318,45 @@ class MainWindow(QtGui.QMainWindow):
             del self.tabs[(server_id, channel_id)]
 
     def _remove_channel_from_tab(self, tab):
-        number_of_tabs = len(self.tab_widget)
-        i = 0
-        while(i < number_of_tabs):
-            if tab == self.tab_widget.widget(i):
-                self.tab_widget.removeTab(i)
-            i += 1
+        index = self.tab_widget.indexOf(tab)
+        if index >= 0:
+            self.tab_widget.removeTab(index)
 
-    def _add_channel_to_tab(self, channel_name, server_id, channel_id):
-        tab_channel = uic.loadUi("gui/ChannelWidget.ui")
-        tab_channel.setObjectName(_fromUtf8(channel_name))
+        # the widget serves the next channel
+        self.channel_tabs.release(tab)
+
+    def _build_channel_tab(self):
+        tab_channel = form_class("channelWidget")()
         tab_channel.messageEdit.editingFinished.connect(lambda:
             self._send_message(tab_channel))
         tab_channel.chatHistory.setOpenExternalLinks(True)
 
-        # a tab knows his server and channel
-        tab_channel.server_id = server_id
-        tab_channel.channel_id = channel_id
+        # two paragraphs per message, drop what the history dropped
+        tab_channel.chatHistory.document().setMaximumBlockCount(
+            2 * Client.HISTORY_MAXIMUM_ENTRIES)
+        tab_channel.shown = False
+        return tab_channel
+
+    def _reset_channel_tab(self, tab_channel):
+        tab_channel.chatHistory.clear()
+        tab_channel.messageEdit.clear()
+        tab_channel.usersList.clear()
+        tab_channel.shown = False
+
+    def _add_channel_to_tab(self, channel_name, server_id, channel_id):
+        source = "pool" if self.channel_tabs.widgets else "new"
+        with self.metrics.time("tab_open_seconds", source=source):
+            tab_channel = self.channel_tabs.acquire()
+            tab_channel.setObjectName(_fromUtf8(channel_name))
+
+            # a tab knows his server and channel
+            tab_channel.server_id = server_id
+            tab_channel.channel_id = channel_id
+            tab_channel.users = UserList(tab_channel.usersList,
+                                         server_id=server_id,
+                                         channel_id=channel_id)
 
-        self.tab_widget.addTab(tab_channel, _fromUtf8(channel_name))
+            self.tab_widget.addTab(tab_channel, _fromUtf8(channel_name))
 
         return tab_channel
 
@@ -296,80 +368,27 @@ class MainWindow(QtGui.QMainWindow):
 
         self.client.command_say(message, channel_id, server_id)
 
-    def _add_user_to_list(self, user):
-        self.lobby.usersList.addItem(user)
-
-    def _update_channel_list(self):
-        self.lobby.channelsList.clear()
-        server_channels = defaultdict(list)
-        server_list = self.client.servers.items()
-
-        for (server_id, channel_id), socket in server_list:
-            try:
-                key = (server_id, socket.peerAddress())
-                server_channels[key].append((channel_id, socket))
-            except RuntimeError:
-                pass
-
-        # show all servers in network
-        for (server_id, address), channel_list in server_channels.items():
-
-            # create root server and add to channels list
-            root = QtGui.QTreeWidgetItem(["Server %s" %
-                                          address.toString()])
+    # a client notification, only the items it touches are updated
+    def _apply_changes(self, changes):
+        client_ids = (changes.users_added | changes.users_removed |
+                      changes.users_renamed)
+        if client_ids:
+            self.user_list.apply(self.client.users, client_ids)
 
-            # set known identifiers
-            root.server_id = server_id
+        self.channel_tree.apply(self.client, changes)
 
-            # add to root
-            self.lobby.channelsList.addTopLevelItem(root)
+        # a membership shows in its channel, a nickname in the channels of
+        # the user (a removed user left them, see memberships_removed)
+        keys = set(membership[:2] for membership in
+                   changes.memberships_added | changes.memberships_removed)
+        for client_id in client_ids:
+            keys.update(self.client.client_memberships.get(client_id, ()))
 
-            # show all channels of server
-            for (channel_id, socket) in channel_list:
-                if channel_id:
-                    channel_text = (channel_id + ' (' +
-                                    socket.localAddress().toString() + ':' +
-                                    str(socket.localPort()) + ')')
-                    channel = QtGui.QTreeWidgetItem([channel_text])
-
-                    # set known identifiers
-                    channel.server_id = server_id
-                    channel.channel_id = channel_id
-
-                    # add to root
-                    root.addChild(channel)
-
-                    # show all clients in channel
-                    key = (server_id, channel_id)
-                    if key in self.client.membership:
-                        client_list = self.client.membership[key]
-                        for client_id in client_list:
-                            if client_id in self.client.users:
-                                client_text = self.client.users[client_id]
-                                client = QtGui.QTreeWidgetItem([client_text])
-
-                                # set known identifiers
-                                client.server_id = server_id
-                                client.channel_id = channel_id
-                                client.client_id = client_id
-
-                                # add to root
-                                channel.addChild(client)
-
-        # show all
-        self.lobby.channelsList.expandAll()
-
-    def _update_user_list(self):
-        self.lobby.usersList.clear()
-
-        # create a list entry for every user
-        for key in self.client.users:
-            value = self.client.users[key]
-
-            item = QtGui.QListWidgetItem()
-            item.setText(value)
-
-            self._add_user_to_list(item)
+        # we are in the channels of our tabs
+        if self.client.id in client_ids:
+            keys.update(self.tabs)
+        if keys:
+            self._update_channel_user_list(keys)
 
     def closeEvent(self, event):
         reply = QtGui.QMessageBox.question(self, 'Message',
@@ -378,31 +397,24 @@ class MainWindow(QtGui.QMainWindow):
 
         if reply == QtGui.QMessageBox.Yes:
             self.client.disconnect_from_all_channels()
+
+            # the event loop ends with the window, write the EXITs now
+            self.client.flush_commands()
             event.accept()
         else:
             event.ignore()
 
-    def _update_channel_user_list(self):
-        number_of_tabs = len(self.tab_widget)
-        i = 0
-        while(i < number_of_tabs):
-            if self.lobby != self.tab_widget.widget(i):         
-                self.tab_widget.widget(i).usersList.clear()
-                server_id = self.tab_widget.widget(i).server_id
-                channel_id = self.tab_widget.widget(i).channel_id
-                key = (server_id, channel_id)
-                if key in self.client.membership:
-                    client_list = self.client.membership[key]
-                    for client_id in client_list:
-                        if client_id in self.client.users:
-                            client_text = self.client.users[client_id]
-                            client = QtGui.QListWidgetItem()
-                            client.setText(client_text)                          
-                            client.server_id = server_id
-                            client.channel_id = channel_id
-                            client.client_id = client_id                           
-                            self.tab_widget.widget(i).usersList.addItem(client)
-            i += 1
+    def _update_channel_user_list(self, keys=None):
+        if keys is None:
+            keys = self.tabs.keys()
+        for key in keys:
+            tab = self.tabs.get(key)
+            if tab is None:
+                continue
+            tab.users.update(dict(
+                (client_id, self.client.users[client_id])
+                for client_id in self.client.membership.get(key, ())
+                if client_id in self.client.users))
 
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
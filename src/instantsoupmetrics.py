@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Counters, timing histograms and gauges of the InstantSOUP peers.
+
+Every Client and Server keeps a :class:`Metrics` with, among others:
+
+* ``datagrams_received_total``, ``datagrams_sent_total`` and the options in
+  them, ``options_received_total{option=...}``, ``options_sent_total``
+* ``commands_received_total{command=...}``, ``commands_sent_total``
+* ``parse_seconds{kind=...}``, ``build_seconds`` and ``parse_errors_total``
+* ``handler_seconds{handler=...}``, the time spent in every entry point of
+  the event loop, e.g. ``handle_data`` for a command
+* ``fanout``, the number of members a message is sent to
+* gauges like connected sockets, queued bytes and pending timers
+
+Recording is a dictionary update (or a list append for histograms), cheap
+enough to leave on. :meth:`Metrics.render` returns the Prometheus text
+format, served by :class:`MetricsEndpoint` (or its Qt counterpart), and
+:meth:`Metrics.summary` a single line for the log.
+
+The sampling profiler is opt-in: with a sample rate above zero, that
+fraction of the handler calls runs under ``cProfile``, see
+:meth:`Metrics.profile_report`. The defaults come from the environment
+variables ``INSTANTSOUP_METRICS_PORT``, ``INSTANTSOUP_METRICS_LOG_TIME``
+(milliseconds) and ``INSTANTSOUP_PROFILE_SAMPLE_RATE``.
+"""
+
+import asyncore
+import bisect
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import random
+import socket
+import time
+
+from cStringIO import StringIO
+
+log = logging.getLogger("instantsoup")
+
+DEFAULT_METRICS_PORT = os.environ.get("INSTANTSOUP_METRICS_PORT")
+DEFAULT_METRICS_LOG_TIME = int(os.environ.get("INSTANTSOUP_METRICS_LOG_TIME",
+                                              0))
+DEFAULT_PROFILE_SAMPLE_RATE = float(
+    os.environ.get("INSTANTSOUP_PROFILE_SAMPLE_RATE", 0))
+
+# upper bounds of the histogram buckets, in seconds and in members
+TIME_BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03,
+                0.1, 0.3, 1.0)
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_clock = time.time
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', "'"))
+                             for key, value in labels)
+
+
+def measured(function):
+    """
+    record the time of every call of the method in self.metrics
+
+    Meant for the entry points of the event loop (handle_data, handle_pdu,
+    ...), not for the handlers they call, so a call is timed only once.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics.profile is not None:
+            return metrics.call(name, function, self, *args, **kwargs)
+
+        # the common case inline, it runs for every command and datagram
+        histogram = metrics.handlers.get(name) or \
+            metrics.handler_histogram(name)
+        started = _clock()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            histogram.observe(_clock() - started)
+    return wrapper
+
+
+class Histogram(object):
+    """
+    number of observed values per bucket, with their count and sum
+
+    :meth:`observe` only appends the value, the values are sorted into the
+    buckets in one go when the histogram is read or FOLD_SIZE of them wait.
+    """
+
+    FOLD_SIZE = 1024
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self.pending = []
+
+    def observe(self, value):
+        pending = self.pending
+        pending.append(value)
+        if len(pending) >= self.FOLD_SIZE:
+            self.fold()
+
+    def fold(self):
+        pending = self.pending
+        self.pending = []
+        counts = self._counts
+        buckets = self.buckets
+        bisect_left = bisect.bisect_left
+        for value in pending:
+            counts[bisect_left(buckets, value)] += 1
+        self._count += len(pending)
+        self._sum += sum(pending)
+
+    @property
+    def counts(self):
+        self.fold()
+        return self._counts
+
+    @property
+    def count(self):
+        self.fold()
+        return self._count
+
+    @property
+    def sum(self):
+        self.fold()
+        return self._sum
+
+
+class Stopwatch(object):
+    """context manager observing its duration in a histogram of metrics"""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exception):
+        self.metrics.observe(self.name, time.time() - self.started,
+                             **self.labels)
+        return False
+
+
+class Metrics(object):
+    """the counters, histograms and gauges of one peer"""
+
+    def __init__(self, namespace="instantsoup",
+                 sample_rate=DEFAULT_PROFILE_SAMPLE_RATE):
+        self.namespace = namespace
+        self.started = time.time()
+
+        # mapping from (name) to a mapping from (labels) to (value)
+        self.counters = {}
+
+        # mapping from (name) to a mapping from (labels) to (Histogram)
+        self.histograms = {}
+
+        # mapping from (name) to a function returning the current value
+        self.gauges = {}
+
+        # mapping from (handler name) to its Histogram in handler_seconds
+        self.handlers = {}
+
+        # the sampling profiler, see enable_profiling
+        self.profile = None
+        self.sample_rate = 0.0
+        self.profiling = False
+        if sample_rate > 0:
+            self.enable_profiling(sample_rate)
+
+    def count(self, name, value=1, **labels):
+        values = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        self.histogram(name, buckets, **labels).observe(value)
+
+    def histogram(self, name, buckets=TIME_BUCKETS, **labels):
+        """return the Histogram of name and labels, to observe it directly"""
+        histograms = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    def time(self, name, **labels):
+        """return a context manager observing its duration in name"""
+        return Stopwatch(self, name, labels)
+
+    def gauge(self, name, function):
+        """report the value of function() as name"""
+        self.gauges[name] = function
+
+    #
+    # SAMPLING PROFILER
+    #
+    def enable_profiling(self, sample_rate):
+        """profile this fraction of the handler calls"""
+        self.profile = cProfile.Profile()
+        self.sample_rate = sample_rate
+
+    def call(self, name, function, *args, **kwargs):
+        """call function, record its time as handler name"""
+        histogram = self.handlers.get(name) or self.handler_histogram(name)
+
+        # never profile a handler called by a profiled one
+        if self.profile is not None and not self.profiling and \
+           random.random() < self.sample_rate:
+            return self._profiled_call(histogram, function, *args, **kwargs)
+
+        started = _clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(_clock() - started)
+
+    def handler_histogram(self, name):
+        histogram = self.handlers[name] = self.histogram("handler_seconds",
+                                                         handler=name)
+        return histogram
+
+    def _profiled_call(self, histogram, function, *args, **kwargs):
+        started = _clock()
+        self.profiling = True
+        try:
+            return self.profile.runcall(function, *args, **kwargs)
+        finally:
+            self.profiling = False
+            histogram.observe(_clock() - started)
+
+    def profile_report(self, limit=30):
+        """return the profiled functions, by cumulative time"""
+        if self.profile is None:
+            return "%s: profiling is off\n" % self.namespace
+        stream = StringIO()
+        try:
+            stats = pstats.Stats(self.profile, stream=stream)
+        except TypeError:
+            return "%s: nothing profiled yet\n" % self.namespace
+        stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    #
+    # EXPORT
+    #
+    def render(self):
+        """return the metrics in the Prometheus text format"""
+        lines = []
+        for name in sorted(self.counters):
+            full_name = "%s_%s" % (self.namespace, name)
+            lines.append("# TYPE %s counter" % full_name)
+            for labels, value in sorted(self.counters[name].items()):
+                lines.append("%s%s %s" % (full_name, _labels(labels), value))
+
+        gauges = dict(self.gauges,
+                      uptime_seconds=lambda: time.time() - self.started)
+        for name in sorted(gauges):
+            full_name = "%s_%s" % (self.namespace, name)
+            try:
+                value = gauges[name]()
+            except Exception:
+                log.exception("gauge %s failed" % full_name)
+                continue
+            lines.append("# TYPE %s gauge" % full_name)
+            lines.append("%s %s" % (full_name, value))
+
+        for name in sorted(self.histograms):
+            full_name = "%s_%s" % (self.namespace, name)
+            lines.append("# TYPE %s histogram" % full_name)
+            for labels, histogram in sorted(self.histograms[name].items()):
+                total = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",),
+                                        histogram.counts):
+                    total += count
+                    lines.append("%s_bucket%s %i" % (
+                        full_name, _labels(labels, [("le", bound)]), total))
+                lines.append("%s_sum%s %s" % (full_name, _labels(labels),
+                                              histogram.sum))
+                lines.append("%s_count%s %i" % (full_name, _labels(labels),
+                                                histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """return the counters (summed over their labels) and gauges"""
+        parts = ["%s=%s" % (name, sum(values.values()))
+                 for name, values in sorted(self.counters.items())]
+        for name, function in sorted(self.gauges.items()):
+            try:
+                parts.append("%s=%s" % (name, function()))
+            except Exception:
+                log.exception("gauge %s failed" % name)
+        return "%s: %s" % (self.namespace, " ".join(parts))
+
+
+def http_response(registries, request):
+    """return the http response to request for the metrics of registries"""
+    try:
+        path = request.split(" ")[1]
+    except IndexError:
+        path = "/"
+    if path.startswith("/profile"):
+        body = "".join(metrics.profile_report() for metrics in registries)
+    else:
+        body = "".join(metrics.render() for metrics in registries)
+    return ("HTTP/1.0 200 OK\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            "Content-Length: %i\r\n\r\n%s" % (len(body), body))
+
+
+class MetricsRequest(asyncore.dispatcher):
+    """one http request to a MetricsEndpoint"""
+
+    def __init__(self, endpoint, tcp_socket):
+        asyncore.dispatcher.__init__(self, tcp_socket, map=endpoint.map)
+        self.endpoint = endpoint
+        self.request = ""
+        self.response = None
+
+    def handle_read(self):
+        self.request += self.recv(4096)
+        if self.response is None and ("\n\n" in self.request or
+                                      "\r\n\r\n" in self.request):
+            self.response = http_response(self.endpoint.registries,
+                                          self.request)
+
+    def writable(self):
+        return bool(self.response)
+
+    def handle_write(self):
+        sent = self.send(self.response)
+        self.response = self.response[sent:]
+        if not self.response:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+
+class MetricsEndpoint(asyncore.dispatcher):
+    """
+    a local http endpoint for the metrics of registries, on an asyncore map
+
+    ``GET /metrics`` (or any other path) returns the Prometheus text format,
+    ``GET /profile`` the report of the sampling profiler.
+    """
+
+    def __init__(self, registries, port, map, address="127.0.0.1"):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.registries = registries
+        self.map = map
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((address, port))
+        self.listen(5)
+        log.debug("metrics are served on %s:%i" % (address, port))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            MetricsRequest(self, pair[0])
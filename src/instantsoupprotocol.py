@@ -0,0 +1,603 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Server side of the InstantSOUP protocol, without sockets or an event loop.
+
+:class:`ServerProtocol` keeps the users, channels, backlogs and
+announcements of a server and handles its pdus and commands. The Qt
+:class:`instantsoupdata.Server` and the asyncore
+:class:`instantsoupserver.HeadlessServer` connect it to the network, they
+provide
+
+* ``send_frame(connection, frame)``, queue an encoded command for a client
+* ``send_datagram(datagram, address=None, port=None)``, send to the lobby's
+  multicast group, or to address (and port) if given
+* ``call_later(delay, function)``, call function after delay ms
+
+(they may override :meth:`~ServerProtocol.send_pdu` to send announcements
+differently from other datagrams) and feed it with
+:meth:`~ServerProtocol.handle_pdu`, :meth:`~ServerProtocol.handle_data` and
+:meth:`~ServerProtocol.remove_connection`. A connection is whatever the
+transport uses, with the ``address`` its client's pdus come from, an
+``outbound`` queue (see instantsouputil.OutboundQueue) and ``endpoints``.
+
+Public channels with ``MULTICAST_MEMBERS`` or more members get a multicast
+group, announced with SERVER_CHANNEL_GROUPS_OPTION, and their messages go
+to the group instead of to every connection. A client switches a channel
+over with "MULTICAST" and the server answers "MULTICAST\x00<number>", the
+number of the first message the connection won't get anymore. Messages
+carry their number, a client that misses some asks for them with
+"RESEND\x00<first>\x00<last>" and gets them as they were sent to the group.
+Clients that never ask keep getting every message over tcp.
+"""
+
+import itertools
+import logging
+import time
+import uuid
+
+from instantsoupcodec import CodecError, get_codec, command_name
+from instantsoupcodec import MAXIMUM_ENTRIES
+from instantsoupcodec import FEATURE_MULTIPLEX, PduAssembler
+from instantsoupcodec import split_entries, option_name, option_order
+from instantsouputil import OutboundQueue, ChannelMembership, ChannelEndpoint
+from instantsouputil import LivenessTracker, AnnouncementSchedule
+from instantsouputil import HistoryStore, channel_group
+from instantsouplog import get_chat_log
+from instantsoupmetrics import Metrics, measured, FANOUT_BUCKETS
+
+log = logging.getLogger("instantsoup")
+
+channel_group_port = 55556
+
+
+class ServerProtocol(object):
+    DEFAULT_WAITING_TIME = 1000
+
+    REGULAR_PDU_WAITING_TIME = 15000
+
+    DEFAULT_TIMEOUT_TIME = 2 * REGULAR_PDU_WAITING_TIME + DEFAULT_WAITING_TIME
+
+    # beyond this many peers the announcement interval (and the timeout)
+    # grows with the lobby, see AnnouncementSchedule
+    ANNOUNCEMENT_PEERS = 50
+    ANNOUNCEMENT_JITTER = 0.2
+
+    MAXIMUM_DATAGRAM_LENGTH = 10000
+
+    # bytes queued per client before the slow consumer policy kicks in
+    OUTBOUND_HIGH_WATER_MARK = 1 << 20
+
+    # what to do with a slow client: OutboundQueue.DROP_OLDEST or DISCONNECT
+    OUTBOUND_POLICY = OutboundQueue.DROP_OLDEST
+
+    # bytes handed to a socket at once
+    SOCKET_WRITE_BUFFER = 1 << 16
+
+    # messages kept per channel for the clients that join later
+    BACKLOG_MAXIMUM_ENTRIES = 50
+    BACKLOG_MAXIMUM_BYTES = 1 << 16
+
+    # public channels with this many members get a multicast group, 0 never
+    MULTICAST_MEMBERS = 0
+
+    # protocol extensions announced with SERVER_FEATURES_OPTION
+    FEATURES = [FEATURE_MULTIPLEX]
+
+    def __init__(self, port, codec=None, policy=None, log_directory=None):
+
+        # Create a server with a unique id
+        self.id = str(uuid.uuid1())
+        self.port = port
+        self.pdu_number = 0
+
+        # counters and timings (see instantsoupmetrics)
+        self.metrics = Metrics("instantsoup_server")
+
+        # encoder/decoder for pdus and commands (see instantsoupcodec)
+        self.codec = get_codec(codec)
+
+        # our options, encoded once and packed into few datagrams
+        self.announcement = PduAssembler(self.codec, self.id)
+
+        # our public channels as we announced them last, their version, and
+        # the options that list them (parts, if there are too many)
+        self.announced_channels = set()
+        self.channels_version = 0
+        self.channels_options = ["SERVER_CHANNELS_OPTION"]
+
+        if policy is not None:
+            self.OUTBOUND_POLICY = policy
+
+        self.open_history(log_directory)
+
+        # channel members, indexed by channel, connection and client_id
+        self.members = ChannelMembership()
+
+        # mapping from (channel_id) to a set of (client_id, connection)
+        self.channels = self.members.channels
+
+        # mapping from (channel_id) to its multicast group (address), and
+        # from (channel_id) to the connections that read the group
+        self.channel_groups = {}
+        self.subscribers = {}
+
+        # mapping from (address) to (client_id)
+        self.users = {}
+
+        # when was a client heard of last, expired by check_timeouts
+        self.user_liveness = LivenessTracker(self.DEFAULT_TIMEOUT_TIME)
+
+        # the peers (clients and servers) we hear, they set our interval
+        self.peers = LivenessTracker(self.DEFAULT_TIMEOUT_TIME)
+        self.schedule = AnnouncementSchedule(self.REGULAR_PDU_WAITING_TIME,
+                                             self.ANNOUNCEMENT_PEERS,
+                                             self.DEFAULT_WAITING_TIME,
+                                             self.ANNOUNCEMENT_JITTER)
+
+        self.connections = set()
+
+        self.metrics.gauge("connections", lambda: len(self.connections))
+        self.metrics.gauge("users", lambda: len(self.users))
+        self.metrics.gauge("channels", lambda: len(self.channels))
+        self.metrics.gauge("queued_bytes", lambda: sum(
+            connection.outbound.queued_bytes
+            for connection in self.connections))
+        self.metrics.gauge("dropped_frames", lambda: sum(
+            connection.outbound.dropped for connection in self.connections))
+
+    def open_history(self, log_directory):
+
+        # mapping from (channel_id) to its log on disk, or None
+        self.chat_log = get_chat_log(log_directory)
+
+        # mapping from (channel_id) to its last messages, sent to the
+        # clients that join (written to the chat log too, if we have one)
+        self.backlog = HistoryStore(self.BACKLOG_MAXIMUM_ENTRIES,
+                                    self.BACKLOG_MAXIMUM_BYTES, self.chat_log)
+
+    def start_timers(self):
+
+        # setup the regular pdu and the client timeouts
+        self.call_later(self.schedule.next_interval(1), self.send_regular_pdu)
+        self.call_later(self.DEFAULT_WAITING_TIME, self.check_timeouts)
+
+    def close(self):
+        if self.chat_log is not None:
+            self.chat_log.close()
+
+    #
+    # CONNECTIONS
+    #
+    def remove_connection(self, connection):
+        self.connections.discard(connection)
+        self.leave_channel(connection)
+        for endpoint in connection.endpoints.values():
+            self.leave_channel(endpoint)
+
+    # returns the channel_id the connection left, or None
+    def leave_channel(self, connection):
+        channel_id, _ = self.members.leave(connection)
+        if channel_id in self.subscribers:
+            self.subscribers[channel_id].discard(connection)
+        return channel_id
+
+    def send_command(self, connection, channel_id, command):
+
+        # multiplexed clients need to know the channel
+        if isinstance(connection, ChannelEndpoint):
+            command = "CHANNEL\x00%s\x00%s" % (channel_id, command)
+        self.send_frame(connection, self.codec.build_command(command))
+
+    #
+    # PROCESSING FUNCTIONS (INCOMING PDUS)
+    #
+    @measured
+    def handle_pdu(self, uid, options, address):
+        self.metrics.count("datagrams_received_total")
+        self.peers.touch(uid)
+        for option_id, _ in options:
+            self.metrics.count("options_received_total", option=option_id)
+            if option_id == "CLIENT_NICK_OPTION":
+                self.handle_client_nick_option(address, uid)
+
+    def handle_client_nick_option(self, address, client_id):
+        if self.users.get(address) != client_id:
+            self.users[address] = client_id
+
+            # if we detect this option, maybe a new client was started
+            # -> broadcast rapidly server data and channels
+            self.answer_new_client()
+
+        # restart the timeout
+        self.user_liveness.touch(address)
+
+    # one answer for all clients that show up within a window
+    def answer_new_client(self):
+        delay = self.schedule.reserve("new client")
+        if delay is not None:
+            self.call_later(delay, self.send_server_option)
+            self.call_later(delay + self.DEFAULT_WAITING_TIME,
+                            self.send_server_channel_option)
+
+    # remove the clients we didn't hear of for the timeout
+    def check_timeouts(self):
+        self.call_later(self.DEFAULT_WAITING_TIME, self.check_timeouts)
+
+        # the larger the lobby, the longer the peers stay silent
+        timeout = self.schedule.timeout(len(self.peers) + 1,
+                                        self.DEFAULT_WAITING_TIME)
+        self.user_liveness.timeout = self.peers.timeout = timeout
+        self.peers.expire()
+
+        for address in self.user_liveness.expire():
+            self.remove_client(address)
+
+    def remove_client(self, address):
+        self.user_liveness.discard(address)
+        client_id = self.users.pop(address)
+
+        # the client is gone, so are its channel memberships (through
+        # leave_channel, which also ends subscriptions and empty channels)
+        for connection in list(self.members.client_sockets(client_id)):
+            self.leave_channel(connection)
+
+    #
+    # PROCESSING FUNCTIONS (INCOMING SERVER COMMANDOS)
+    #
+    @measured
+    def handle_data(self, data, connection):
+        self.metrics.count("commands_received_total",
+                           command=command_name(data))
+        self._dispatch(data, connection)
+
+    def _dispatch(self, data, connection):
+        if data.startswith("SAY"):
+            self.handle_say_command(data, connection)
+        elif data.startswith("JOIN"):
+            self.handle_join_command(data, connection)
+        elif data.startswith("EXIT"):
+            self.handle_exit_command(data, connection)
+        elif data.startswith("INVITE"):
+            self.handle_invite_command(data, connection)
+        elif data.startswith("CHANNEL"):
+            self.handle_channel_command(data, connection)
+        elif data.startswith("MULTICAST"):
+            self.handle_multicast_command(data, connection)
+        elif data.startswith("RESEND"):
+            self.handle_resend_command(data, connection)
+
+    # a command of a multiplexed connection, tagged with its channel
+    def handle_channel_command(self, data, connection):
+        parts = data.split("\x00", 2)
+        if len(parts) == 3 and not isinstance(connection, ChannelEndpoint):
+            _, channel_id, command = parts
+
+            # the endpoint stands in for the connection in this channel
+            endpoint = connection.endpoints.get(channel_id)
+            if endpoint is None:
+                endpoint = ChannelEndpoint(connection, channel_id)
+                connection.endpoints[channel_id] = endpoint
+            self.metrics.count("commands_received_total",
+                               command=command_name(command))
+            self._dispatch(command, endpoint)
+
+    def handle_exit_command(self, data, connection):
+
+        # is user known?
+        if connection.address in self.users:
+
+            # remove the connection from its channel
+            self.leave_channel(connection)
+            if isinstance(connection, ChannelEndpoint):
+                del connection.endpoints[connection.channel_id]
+
+    def handle_say_command(self, data, connection):
+
+        # is user known?
+        if connection.address in self.users:
+            client_id = self.users[connection.address]
+            channel_id, _ = self.members.lookup(connection)
+            message = " ".join(data.split("\x00")[1:])
+
+            # is channel known?
+            if channel_id in self.channels:
+                self.backlog.append(channel_id, time.time(), client_id,
+                                    message)
+
+                # encode once, queue for all clients in channel
+                command = "SAY\x00%s\x00%s\x00" % (client_id, message)
+                frame = self.codec.build_command(command)
+                tagged_frame = None
+                members = list(self.channels[channel_id])
+
+                # one datagram for the clients reading the group
+                if channel_id in self.channel_groups:
+                    self.send_to_group(channel_id,
+                                       self.backlog[channel_id].total, command)
+                    subscribers = self.subscribers.get(channel_id, ())
+                    members = [(member_id, member)
+                               for member_id, member in members
+                               if member not in subscribers]
+                self.metrics.observe("fanout", len(members), FANOUT_BUCKETS)
+                self.metrics.count("commands_sent_total", len(members),
+                                   command="SAY")
+                for (_, member) in members:
+                    if isinstance(member, ChannelEndpoint):
+
+                        # multiplexed clients need to know the channel
+                        if tagged_frame is None:
+                            tagged_frame = self.codec.build_command(
+                                "CHANNEL\x00%s\x00%s" % (channel_id, command))
+                        self.send_frame(member, tagged_frame)
+                    else:
+                        self.send_frame(member, frame)
+
+    def handle_join_command(self, data, connection):
+
+        # is user known?
+        if connection.address in self.users:
+            client_id = self.users[connection.address]
+            channel_name = data.split("\x00")[1]
+
+            # join the channel, create it if it is unknown
+            self.leave_channel(connection)
+            if self.members.join(channel_name, client_id, connection):
+                self.handle_new_channel(channel_name)
+
+            # tell the client right away who is there and what was said
+            self.send_join_snapshot(channel_name, connection)
+
+            # big public channels get a multicast group
+            if self.MULTICAST_MEMBERS and \
+               channel_name not in self.channel_groups and \
+               not channel_name.startswith("@") and \
+               len(self.channels[channel_name]) >= self.MULTICAST_MEMBERS:
+                self.channel_groups[channel_name] = channel_group(self.id,
+                                                                  channel_name)
+                self.send_server_channel_groups_option()
+
+    def send_join_snapshot(self, channel_id, connection):
+        members = set(member_id for member_id, _ in self.channels[channel_id])
+        commands = ["MEMBERS\x00%s" % "\x00".join(sorted(members))]
+        if channel_id in self.backlog:
+
+            # numbered like the SEQ of the group, so clients that join again
+            # know which messages they got already
+            history = self.backlog[channel_id]
+            for number, timestamp, client_id, message in history.numbered(
+                    history.total - self.BACKLOG_MAXIMUM_ENTRIES + 1,
+                    history.total):
+                commands.append("BACKLOG\x00%i\x00%.6f\x00%s\x00%s\x00" % (
+                    number, timestamp, client_id, message))
+        self.metrics.count("commands_sent_total", command="MEMBERS")
+        self.metrics.count("commands_sent_total", len(commands) - 1,
+                           command="BACKLOG")
+
+        for command in commands:
+            self.send_command(connection, channel_id, command)
+
+    # the client reads the group of its channel from now on
+    def handle_multicast_command(self, data, connection):
+        channel_id, _ = self.members.lookup(connection)
+        if channel_id in self.channel_groups:
+            self.subscribers.setdefault(channel_id, set()).add(connection)
+
+            # the messages up to here were sent over tcp
+            number = 1
+            if channel_id in self.backlog:
+                number = self.backlog[channel_id].total + 1
+            self.send_command(connection, channel_id,
+                              "MULTICAST\x00%i" % number)
+
+    # the client missed messages of the group
+    def handle_resend_command(self, data, connection):
+        channel_id, _ = self.members.lookup(connection)
+        parts = data.split("\x00")
+        if channel_id not in self.backlog or len(parts) < 3:
+            return
+        try:
+            first, last = int(parts[1]), int(parts[2])
+        except ValueError:
+            return
+        last = min(last, first + self.BACKLOG_MAXIMUM_ENTRIES - 1)
+        messages = self.backlog[channel_id].numbered(first, last)
+        for number, _, client_id, message in messages:
+            command = "SEQ\x00%s\x00%s\x00%i\x00SAY\x00%s\x00%s\x00" % (
+                self.id, channel_id, number, client_id, message)
+            self.send_frame(connection, self.codec.build_command(command))
+        self.metrics.count("commands_sent_total", len(messages),
+                           command="SEQ")
+
+    def handle_new_channel(self, channel_id):
+
+        # announce public channels right away
+        if not channel_id.startswith("@"):
+            self.send_server_channel_delta()
+
+    def handle_invite_command(self, data, connection):
+        channel_id, _ = self.members.lookup(connection)
+        invite_client_ids = data.split("\x00")[1:]
+        self.send_server_invite_option(invite_client_ids, channel_id)
+
+    #
+    # DATAGRAMS
+    #
+    def send_to_group(self, channel_id, number, command):
+        command = "SEQ\x00%s\x00%s\x00%i\x00%s" % (self.id, channel_id,
+                                                   number, command)
+        self.send_datagram(self.codec.build_command(command),
+                           self.channel_groups[channel_id], channel_group_port)
+        self.metrics.count("datagrams_sent_total")
+        self.metrics.count("group_messages_total")
+
+    def send_server_invite_option(self, invite_client_ids, channel_id):
+
+        # an option lists at most MAXIMUM_ENTRIES clients
+        for start in range(0, len(invite_client_ids), MAXIMUM_ENTRIES):
+            client_ids = invite_client_ids[start:start + MAXIMUM_ENTRIES]
+            option = ("SERVER_INVITE_OPTION", (channel_id, client_ids))
+            data = self.codec.build_pdu(self.id, [option])
+
+            # one invite per client, whatever channels it is in
+            for invite_client_id in client_ids:
+                address = self.client_address(invite_client_id)
+                if address is not None:
+                    self.send_datagram(data, address)
+                    self.metrics.count("datagrams_sent_total")
+                    self.metrics.count("options_sent_total",
+                                       option="SERVER_INVITE_OPTION")
+
+        log.debug('PDU: SERVER_INVITE_OPTION - id: %i - SENT' %
+                  self.pdu_number)
+
+    # the address the pdus of client_id come from, or None
+    def client_address(self, client_id):
+        connections = self.members.client_sockets(client_id)
+        if connections:
+            return next(iter(connections)).address
+        return None
+
+    def send_regular_pdu(self):
+
+        # the more peers, the longer the interval (scheduled first, so an
+        # error below doesn't stop the announcements)
+        self.call_later(self.schedule.next_interval(len(self.peers) + 1),
+                        self.send_regular_pdu)
+
+        # simply send all data, the channels with every fourth pdu (see rfc)
+        option_ids = ["SERVER_OPTION"]
+        if (self.pdu_number + 1) % 4 == 0:
+            option_ids.extend(self._channels_snapshot())
+        self.send_options(option_ids)
+
+    def send_server_option(self):
+        self.send_options(["SERVER_OPTION"])
+
+    # all public channels, for peers that came late or missed a delta
+    def send_server_channel_option(self):
+        self.send_options(self._channels_snapshot())
+
+    # only the channels that changed since the last announcement
+    def send_server_channel_delta(self):
+        added, removed = self._update_channels_announcement()
+        if not added and not removed:
+            return
+
+        # a longer change than an option can hold is sent as several deltas
+        # with consecutive versions, the last one is the current version
+        deltas = list(itertools.izip_longest(split_entries(sorted(added)),
+                                             split_entries(sorted(removed)),
+                                             fillvalue=[]))
+        self.channels_version += len(deltas) - 1
+        version = self.channels_version - len(deltas)
+        option_ids = []
+        for index, (added_part, removed_part) in enumerate(deltas):
+            option_id = "SERVER_CHANNELS_DELTA_OPTION"
+            if index > 0:
+                option_id = (option_id, index)
+            if self._announce(option_id, (version + index + 1, added_part,
+                                          removed_part)):
+                option_ids.append(option_id)
+        self.send_options(option_ids)
+
+        # the extra deltas are only sent once, the next change builds its own
+        for option_id in option_ids[1:]:
+            self.announcement.discard(option_id)
+
+    # send option_ids with as few datagrams as possible
+    @measured
+    def send_options(self, option_ids):
+        self._announce("SERVER_OPTION", self.port)
+        if self.FEATURES:
+            self._announce("SERVER_FEATURES_OPTION", self.FEATURES)
+
+        # option ids grew with the protocol, sorted by id older peers read
+        # all options they know before they stop at the first unknown one
+        if "SERVER_OPTION" in option_ids:
+            option_ids = sorted(option_ids + ["SERVER_FEATURES_OPTION"],
+                                key=option_order)
+
+            # increment the number of sent packets
+            self.pdu_number += 1
+
+        with self.metrics.time("build_seconds", kind="pdu"):
+            pdus = self.announcement.pdus(option_ids)
+        for pdu_option_ids, datagram in pdus:
+            self.send_pdu(datagram, pdu_option_ids)
+        self.metrics.count("datagrams_sent_total", len(pdus))
+        names = [option_name(option_id) for option_id in option_ids]
+        for name in names:
+            self.metrics.count("options_sent_total", option=name)
+
+        log.debug('PDU: %s - id: %i - SENT' % (", ".join(names),
+                                                self.pdu_number))
+
+    # send one of our pdus to the lobby, option_ids are the options in it
+    def send_pdu(self, datagram, option_ids):
+        self.send_datagram(datagram)
+
+    # store an option for the next pdus, returns False if it can't be built
+    # (it keeps its last data then)
+    def _announce(self, option_id, option_data):
+        try:
+            self.announcement.set(option_id, option_data)
+        except CodecError as error:
+            name = option_name(option_id)
+            log.error("unable to build %s: %s" % (name, error))
+            self.metrics.count("build_errors_total", option=name)
+            return False
+        return True
+
+    def send_server_channel_groups_option(self):
+        self.send_options(self._channel_groups())
+
+    def _channels_snapshot(self):
+        self._update_channels_announcement()
+
+        # an empty delta next to the full option tells its version
+        marker = (self.channels_version, [], [])
+        self._announce("SERVER_CHANNELS_DELTA_OPTION", marker)
+        return self.channels_options + ["SERVER_CHANNELS_DELTA_OPTION"] + \
+               self._channel_groups()
+
+    def _channel_groups(self):
+        if not self.channel_groups:
+            return []
+        groups = [(channel_id, address, channel_group_port)
+                  for channel_id, address in sorted(
+                      self.channel_groups.items())]
+        self._announce("SERVER_CHANNEL_GROUPS_OPTION",
+                       groups[:MAXIMUM_ENTRIES])
+        return ["SERVER_CHANNEL_GROUPS_OPTION"]
+
+    # compare the public channels with the last announcement, a change
+    # makes a new version, returns the (added, removed) channels
+    def _update_channels_announcement(self):
+        public_channels = set(channel for channel in self.channels
+                              if not channel.startswith("@"))
+        added = public_channels - self.announced_channels
+        removed = self.announced_channels - public_channels
+        if added or removed:
+            self.channels_version += 1
+            self.announced_channels = public_channels
+
+        # older peers only know SERVER_CHANNELS_OPTION, it's used as long as
+        # the channels fit, else the version's parts make the full list
+        channels = sorted(public_channels)
+        if len(channels) <= MAXIMUM_ENTRIES:
+            self._announce("SERVER_CHANNELS_OPTION", channels)
+            option_ids = ["SERVER_CHANNELS_OPTION"]
+        else:
+            parts = split_entries(channels)
+            option_ids = []
+            for part, part_channels in enumerate(parts):
+                option_id = ("SERVER_CHANNELS_PART_OPTION", part)
+                if self._announce(option_id, (self.channels_version, part,
+                                              len(parts), part_channels)):
+                    option_ids.append(option_id)
+        for option_id in self.channels_options:
+            if option_id not in option_ids:
+                self.announcement.discard(option_id)
+        self.channels_options = option_ids
+        return added, removed
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless InstantSOUP server.
+
+Runs the protocol of :class:`instantsoupprotocol.ServerProtocol`, like
+:class:`instantsoupdata.Server`, but on the ``asyncore`` event loop of the
+standard library instead of Qt, so it needs neither a QApplication nor
+PyQt4. Start it with::
+
+    python instantsoupserver.py --port 49190
+
+``--workers N`` spreads the channels over N processes, with a connection
+per channel, see :mod:`instantsoupsharded`. ``--metrics-port`` serves the
+counters and timings of :mod:`instantsoupmetrics` on a local http port.
+
+``--multicast-members N`` sends the messages of public channels with N or
+more members to a multicast group of the channel, see
+:mod:`instantsoupprotocol`.
+"""
+
+import argparse
+import asyncore
+import heapq
+import logging
+import socket
+import struct
+import sys
+import time
+
+from instantsoupcodec import CodecError, CommandFramer
+from instantsouputil import OutboundQueue
+from instantsoupmetrics import MetricsEndpoint
+from instantsoupprotocol import ServerProtocol
+
+log = logging.getLogger("instantsoup")
+
+group_address_ip4 = "239.255.99.63"
+broadcast_port = 55555
+server_start_port = 49190
+
+
+class Discovery(asyncore.dispatcher):
+    """the multicast socket of a server"""
+
+    def __init__(self, server):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.set_reuse_addr()
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.bind(("", broadcast_port))
+
+        membership = struct.pack("4sl", socket.inet_aton(group_address_ip4),
+                                 socket.INADDR_ANY)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                               membership)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def handle_read(self):
+        datagram, (address, _) = self.recvfrom(
+            self.server.MAXIMUM_DATAGRAM_LENGTH)
+        self.server.process_datagram(datagram, address)
+
+    def writable(self):
+        return False
+
+    def send_datagram(self, datagram, address=group_address_ip4,
+                      port=broadcast_port):
+        try:
+            self.socket.sendto(datagram, (address, port))
+        except socket.error as error:
+            log.error("unable to send datagram to %s: %s" % (address, error))
+
+
+class Listener(asyncore.dispatcher):
+    """the tcp listener of a server"""
+
+    def __init__(self, server, port):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(("", port))
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            tcp_socket, (address, _) = pair
+            self.server.handle_connection(tcp_socket, address)
+
+
+class Connection(asyncore.dispatcher):
+    """a tcp connection from a client to a server"""
+
+    def __init__(self, server, tcp_socket, address):
+        asyncore.dispatcher.__init__(self, tcp_socket, map=server.map)
+        self.server = server
+        self.address = address
+
+        # a connection reassembles its own commands and queues its output
+        self.framer = CommandFramer()
+        self.outbound = OutboundQueue(server.OUTBOUND_HIGH_WATER_MARK,
+                                      server.OUTBOUND_POLICY)
+
+        # bytes taken from the queue, but not yet accepted by the socket
+        self.pending = ""
+
+        # mapping from (channel_id) to (ChannelEndpoint), if multiplexed
+        self.endpoints = {}
+
+    def handle_read(self):
+        data = self.recv(self.server.SOCKET_WRITE_BUFFER)
+        if not data:
+            return
+        try:
+            with self.server.metrics.time("parse_seconds", kind="command"):
+                commands = self.framer.feed(data)
+        except CodecError as error:
+            log.error("broken command stream: %s" % error)
+            self.server.metrics.count("parse_errors_total", kind="command")
+            self.handle_close()
+            return
+        for command in commands:
+            self.server.handle_data(command, self)
+
+    def send_frame(self, frame):
+        if not self.outbound.put(frame):
+            log.error("client %s is too slow, disconnecting" % self.address)
+            self.handle_close()
+
+    def writable(self):
+        return bool(self.pending) or bool(self.outbound)
+
+    def handle_write(self):
+        if not self.pending:
+            self.pending = self.outbound.take(self.server.SOCKET_WRITE_BUFFER)
+        sent = self.send(self.pending)
+        self.pending = self.pending[sent:]
+
+    def handle_close(self):
+        self.server.remove_connection(self)
+        self.outbound.clear()
+        self.close()
+
+    def handle_error(self):
+        log.exception("error on connection from %s" % self.address)
+        self.handle_close()
+
+
+class HeadlessServer(ServerProtocol):
+    """the protocol of ServerProtocol on the asyncore event loop"""
+
+    def __init__(self, port=server_start_port, codec=None, policy=None,
+                 log_directory=None, metrics_port=None, metrics_interval=0):
+        ServerProtocol.__init__(self, port, codec, policy, log_directory)
+
+        # counters and timings are served on metrics_port and logged every
+        # metrics_interval ms, if given
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+
+        # the sockets of this server, for asyncore
+        self.map = {}
+
+        # heap of (due time, sequence number, function) of scheduled calls
+        self.timers = []
+        self.timer_number = 0
+
+        self.metrics.gauge("timers", lambda: len(self.timers))
+
+        self.start()
+
+    def start(self):
+        self.discovery = Discovery(self)
+        self.listener = Listener(self, self.port)
+        log.debug("Server is running with port %s" % self.port)
+
+        self.start_timers()
+
+        if self.metrics_port:
+            self.metrics_endpoint = MetricsEndpoint([self.metrics],
+                                                    self.metrics_port,
+                                                    self.map)
+        if self.metrics_interval:
+            self.call_later(self.metrics_interval, self.log_metrics)
+
+    #
+    # EVENT LOOP
+    #
+    def call_later(self, delay, function):
+        """call function after delay milliseconds"""
+        self.timer_number += 1
+        heapq.heappush(self.timers, (time.time() + delay / 1000.0,
+                                     self.timer_number, function))
+
+    def run_once(self, timeout=1.0):
+        if self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+        asyncore.loop(timeout, map=self.map, count=1)
+
+        # a failing call must not stop the server, like a failing socket
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, function = heapq.heappop(self.timers)
+            try:
+                function()
+            except Exception:
+                log.exception("error in scheduled call %r" % (function,))
+
+    def run(self):
+        while self.map:
+            self.run_once()
+
+    def log_metrics(self):
+        log.info(self.metrics.summary())
+        self.call_later(self.metrics_interval, self.log_metrics)
+
+    def close(self):
+        for dispatcher in self.map.values():
+            dispatcher.close()
+        self.timers = []
+        ServerProtocol.close(self)
+
+    #
+    # SOCKET FUNCTIONS
+    #
+    def handle_connection(self, tcp_socket, address):
+        self.connections.add(Connection(self, tcp_socket, address))
+
+    def send_frame(self, connection, frame):
+        connection.send_frame(frame)
+
+    def send_datagram(self, datagram, address=None, port=None):
+        self.discovery.send_datagram(datagram, address or group_address_ip4,
+                                     port or broadcast_port)
+
+    def process_datagram(self, datagram, address):
+        try:
+            with self.metrics.time("parse_seconds", kind="pdu"):
+                uid, options = self.codec.parse_pdu(datagram)
+        except CodecError:
+            self.metrics.count("datagrams_received_total")
+            self.metrics.count("parse_errors_total", kind="pdu")
+            return
+        if uid != self.id:
+            self.handle_pdu(uid, options, address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="headless InstantSOUP server")
+    parser.add_argument("--port", type=int, default=server_start_port,
+                        help="tcp port for the clients (default: %(default)s)")
+    parser.add_argument("--codec", default=None,
+                        help="wire codec, 'fast' or 'construct'")
+    parser.add_argument("--slow-clients", default=OutboundQueue.DROP_OLDEST,
+                        choices=[OutboundQueue.DROP_OLDEST,
+                                 OutboundQueue.DISCONNECT],
+                        help="policy for clients that can't keep up")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="spread the channels over this many worker "
+                             "processes, without multiplexed connections, 0 "
+                             "serves everything in one process")
+    parser.add_argument("--log-directory", default=None,
+                        help="keep the messages of every channel on disk "
+                             "below this directory")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve the metrics on this local http port")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="log the metrics every this many seconds")
+    parser.add_argument("--multicast-members", type=int, default=0,
+                        help="send the messages of public channels with this "
+                             "many members to a multicast group, 0 never "
+                             "(not with --workers)")
+    parser.add_argument("--profile-sample-rate", type=float, default=0,
+                        help="profile this fraction of the handler calls, "
+                             "see /profile of the metrics port")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log every pdu")
+    args = parser.parse_args(argv)
+
+    log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.workers > 0:
+        from instantsoupsharded import ShardedServer
+        server = ShardedServer(args.port, args.codec, args.slow_clients,
+                               args.workers, args.log_directory,
+                               args.metrics_port,
+                               int(args.metrics_interval * 1000))
+    else:
+        server = HeadlessServer(args.port, args.codec, args.slow_clients,
+                                args.log_directory, args.metrics_port,
+                                int(args.metrics_interval * 1000))
+    if args.profile_sample_rate > 0:
+        server.metrics.enable_profiling(args.profile_sample_rate)
+    if args.multicast_members > 0:
+        server.MULTICAST_MEMBERS = args.multicast_members
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless InstantSOUP server spread over several processes.
+
+The front process owns the tcp listener and the multicast socket. It tracks
+the clients (CLIENT_NICK_OPTION), announces SERVER_OPTION and the public
+channels, and reads each new connection up to its JOIN command. The
+connection is then passed to the worker that owns the channel, chosen by a
+crc32 of the channel id. From then on the worker alone handles SAY, EXIT and
+the fan-out for the connection, so the channels spread over the cores.
+A worker forgets a channel when its last member leaves, and so does the
+front process.
+
+A connection lives in the worker of the channel it joined first, so it
+can't carry several channels: a sharded server does not announce
+FEATURE_MULTIPLEX, and its clients open a connection per channel.
+The front process keeps no messages, the worker of a channel keeps its
+backlog and writes its log.
+
+Front and workers talk over a pipe per worker:
+
+* front -> worker: ``("user", address, client_id)``,
+  ``("user_removed", address)``, ``("connection", address, commands,
+  buffered)`` followed by the socket itself, ``("stop",)``
+* worker -> front: ``("channel", channel_id)``,
+  ``("channel_removed", channel_id)``, ``("invite", client_ids,
+  channel_id)``
+"""
+
+import asyncore
+import logging
+import multiprocessing
+import os
+import socket
+import zlib
+
+from multiprocessing.reduction import send_handle, recv_handle
+
+from instantsoupcodec import CodecError
+from instantsoupserver import HeadlessServer, Connection, server_start_port
+
+log = logging.getLogger("instantsoup")
+
+
+class ControlChannel(asyncore.dispatcher):
+    """the pipe between the front process and one worker"""
+
+    def __init__(self, owner, pipe, process=None):
+        asyncore.dispatcher.__init__(self, map=owner.map)
+        self.owner = owner
+        self.pipe = pipe
+        self.process = process
+
+        # let asyncore wait on the pipe like on a socket
+        self._fileno = pipe.fileno()
+        self.connected = True
+        self.add_channel()
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            message = self.pipe.recv()
+        except EOFError:
+            self.handle_close()
+            return
+        self.owner.handle_control(message, self)
+
+    def send_message(self, *message):
+        if not self.pipe.closed:
+            self.pipe.send(message)
+
+    def send_socket(self, tcp_socket):
+        send_handle(self.pipe, tcp_socket.fileno(), self.process.pid)
+
+    def receive_socket(self):
+        fd = recv_handle(self.pipe)
+        tcp_socket = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        return tcp_socket
+
+    def handle_close(self):
+        self.close()
+        self.owner.handle_control(("stop",), self)
+
+    def close(self):
+        self.del_channel()
+        self.pipe.close()
+
+
+class PendingConnection(Connection):
+    """a connection in the front process, that has not joined a channel"""
+
+    def handle_read(self):
+        data = self.recv(self.server.SOCKET_WRITE_BUFFER)
+        if not data:
+            return
+        try:
+            commands = self.framer.feed(data)
+        except CodecError as error:
+            log.error("broken command stream: %s" % error)
+            self.handle_close()
+            return
+
+        # everything from the JOIN on is the worker's business,
+        # commands without a channel are ignored like in Server
+        for index, command in enumerate(commands):
+            if command.startswith("JOIN"):
+                if self.server.hand_over(self, commands[index:]):
+                    return
+
+
+class ShardWorker(HeadlessServer):
+    """serves the channels the front process assigns to it"""
+
+    def __init__(self, pipe, codec=None, policy=None, log_directory=None):
+        self.pipe = pipe
+        HeadlessServer.__init__(self, None, codec, policy, log_directory)
+
+    def start(self):
+
+        # no listener, no multicast: the front process does that
+        self.control = ControlChannel(self, self.pipe)
+
+    def handle_control(self, message, control):
+        kind = message[0]
+        if kind == "user":
+            _, address, client_id = message
+            self.users[address] = client_id
+
+        elif kind == "user_removed":
+            if message[1] in self.users:
+                self.remove_client(message[1])
+
+        elif kind == "connection":
+            _, address, commands, buffered = message
+            connection = Connection(self, control.receive_socket(), address)
+            self.connections.add(connection)
+
+            # continue where the front process stopped reading
+            commands.extend(connection.framer.feed(buffered))
+            for command in commands:
+                self.handle_data(command, connection)
+
+        elif kind == "stop":
+            self.close()
+
+    def handle_new_channel(self, channel_id):
+        self.control.send_message("channel", channel_id)
+
+    def leave_channel(self, connection):
+        channel_id = HeadlessServer.leave_channel(self, connection)
+
+        # forget empty channels, the front process stops announcing them
+        if channel_id is not None and not self.channels[channel_id]:
+            del self.channels[channel_id]
+            self.subscribers.pop(channel_id, None)
+            self.channel_groups.pop(channel_id, None)
+            self.control.send_message("channel_removed", channel_id)
+        return channel_id
+
+    def handle_invite_command(self, data, connection):
+
+        # only the front process knows the addresses of all clients
+        channel_id, _ = self.members.lookup(connection)
+        invite_client_ids = data.split("\x00")[1:]
+        self.control.send_message("invite", invite_client_ids, channel_id)
+
+
+def run_worker(pipe, inherited_pipes, codec, policy, log_directory):
+    # the pipes of the other workers belong to the front process
+    for inherited in inherited_pipes:
+        inherited.close()
+
+    # a channel lives in one worker, so every log has a single writer
+    worker = ShardWorker(pipe, codec, policy, log_directory)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.close()
+
+
+class ShardedServer(HeadlessServer):
+    """front process of a server whose channels live in worker processes"""
+
+    # a connection lives in one worker, so it can't carry several channels,
+    # the clients fall back to a connection per channel
+    FEATURES = []
+
+    def __init__(self, port=server_start_port, codec=None, policy=None,
+                 workers=None, log_directory=None, metrics_port=None,
+                 metrics_interval=0):
+        self.codec_name = codec
+        self.policy = policy
+        self.log_directory = log_directory
+        self.worker_count = workers or multiprocessing.cpu_count()
+
+        # mapping from (channel_id) to the index of its worker
+        self.shards = {}
+
+        # mapping from (client_id) to (address)
+        self.addresses = {}
+
+        # the metrics are those of the front process, not of the workers
+        HeadlessServer.__init__(self, port, codec, policy, log_directory,
+                                metrics_port, metrics_interval)
+
+        # the channels are kept by the workers, we know their names
+        self.channels = self.shards
+
+    def start(self):
+
+        # fork the workers before we open any socket they could inherit
+        self.workers = []
+        for _ in range(self.worker_count):
+            pipe, worker_pipe = multiprocessing.Pipe()
+            inherited = [worker.pipe for worker in self.workers]
+            process = multiprocessing.Process(target=run_worker,
+                args=(worker_pipe, inherited, self.codec_name, self.policy,
+                      self.log_directory))
+            process.daemon = True
+            process.start()
+            worker_pipe.close()
+            self.workers.append(ControlChannel(self, pipe, process))
+
+        HeadlessServer.start(self)
+        log.info("Server uses %i worker processes, without multiplexed "
+                 "connections" % self.worker_count)
+
+    def open_history(self, log_directory):
+
+        # the workers keep the messages of their channels
+        self.chat_log = None
+        self.backlog = None
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.send_message("stop")
+            except (IOError, EOFError):
+                pass
+        HeadlessServer.close(self)
+        for worker in self.workers:
+            worker.process.join(self.DEFAULT_WAITING_TIME / 1000.0)
+
+    def shard_of(self, channel_id):
+        checksum = zlib.crc32(channel_id.encode("utf8")) & 0xffffffff
+        return checksum % self.worker_count
+
+    def handle_connection(self, tcp_socket, address):
+        self.connections.add(PendingConnection(self, tcp_socket, address))
+
+    def hand_over(self, connection, commands):
+        """pass connection to the worker of the channel it joins"""
+        client_id = self.users.get(connection.address)
+        parts = commands[0].split("\x00")
+
+        # is user known?
+        if client_id is None or len(parts) < 2:
+            return False
+
+        channel_id = parts[1]
+        shard = self.shard_of(channel_id)
+        worker = self.workers[shard]
+
+        # the socket leaves our event loop, but stays open until sent
+        self.connections.discard(connection)
+        connection.del_channel()
+        worker.send_message("connection", connection.address, commands,
+                            str(connection.framer.buffer))
+        worker.send_socket(connection.socket)
+        connection.socket.close()
+
+        self.add_channel(channel_id, shard)
+        return True
+
+    def add_channel(self, channel_id, shard):
+        if channel_id not in self.shards:
+            self.shards[channel_id] = shard
+            self.handle_new_channel(channel_id)
+
+    def remove_channel(self, channel_id, shard):
+        if self.shards.get(channel_id) == shard:
+            del self.shards[channel_id]
+            self.send_server_channel_delta()
+
+    def handle_control(self, message, worker):
+        kind = message[0]
+        if kind == "channel":
+            self.add_channel(message[1], self.workers.index(worker))
+        elif kind == "channel_removed":
+            self.remove_channel(message[1], self.workers.index(worker))
+        elif kind == "invite":
+            _, invite_client_ids, channel_id = message
+            self.send_server_invite_option(invite_client_ids, channel_id)
+        elif kind == "stop":
+            log.error("worker %i stopped" % self.workers.index(worker))
+
+    def broadcast_control(self, *message):
+        for worker in self.workers:
+            worker.send_message(*message)
+
+    def handle_client_nick_option(self, address, client_id):
+        previous = self.users.get(address)
+        HeadlessServer.handle_client_nick_option(self, address, client_id)
+
+        # keep the workers' users in sync
+        if previous != client_id:
+            self.addresses[client_id] = address
+            self.broadcast_control("user", address, client_id)
+
+    def remove_client(self, address):
+        client_id = self.users[address]
+        HeadlessServer.remove_client(self, address)
+
+        if self.addresses.get(client_id) == address:
+            del self.addresses[client_id]
+        self.broadcast_control("user_removed", address)
+
+    # the connections are in the workers, we know the addresses
+    def client_address(self, client_id):
+        return self.addresses.get(client_id)
@@ -0,0 +1,763 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Data structures shared by the Qt and the headless peers.
+
+Nothing in here depends on Qt, the sockets are driven by the caller.
+"""
+
+import random
+import time
+import zlib
+
+from array import array
+from collections import deque, MutableMapping
+
+
+class OutboundQueue(object):
+    """
+    frames waiting to be written to one connection
+
+    The queue holds whole frames only, so dropping from it never breaks the
+    byte stream. If more than ``high_water_mark`` bytes are waiting, the
+    ``policy`` decides: DROP_OLDEST discards the oldest frames until the
+    queue fits again, DISCONNECT makes :meth:`put` return False and the
+    caller closes the connection.
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    DISCONNECT = "disconnect"
+
+    def __init__(self, high_water_mark=1 << 20, policy=DROP_OLDEST):
+        if policy not in (self.DROP_OLDEST, self.DISCONNECT):
+            raise ValueError("unknown policy %r" % (policy,))
+        self.high_water_mark = high_water_mark
+        self.policy = policy
+        self.frames = deque()
+        self.queued_bytes = 0
+
+        # number of frames that were thrown away (DROP_OLDEST)
+        self.dropped = 0
+
+    def put(self, frame):
+        """queue frame, returns False if the connection should be closed"""
+        self.frames.append(frame)
+        self.queued_bytes += len(frame)
+
+        if self.queued_bytes > self.high_water_mark:
+            if self.policy == self.DISCONNECT:
+                return False
+
+            # always keep the newest frame
+            while self.queued_bytes > self.high_water_mark and \
+                  len(self.frames) > 1:
+                self.queued_bytes -= len(self.frames.popleft())
+                self.dropped += 1
+        return True
+
+    def take(self, budget):
+        """
+        remove and return the oldest frames as one string, at most budget
+        bytes unless the first frame alone is bigger
+        """
+        frames = self.frames
+        parts = []
+        size = 0
+        while frames and (not parts or size + len(frames[0]) <= budget):
+            frame = frames.popleft()
+            parts.append(frame)
+            size += len(frame)
+        self.queued_bytes -= size
+        return "".join(parts)
+
+    def clear(self):
+        self.frames.clear()
+        self.queued_bytes = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class CommandQueue(object):
+    """
+    commands waiting to be written to one connection of a client
+
+    :meth:`take` returns every queued frame as one write. The callback of a
+    frame is called with True once the socket reports all of its bytes
+    written (:meth:`written`), or with False if the connection fails first
+    (:meth:`fail`).
+    """
+
+    def __init__(self):
+        self.frames = []
+
+        # bytes ever put and ever written, the callbacks wait in between
+        self.put_bytes = 0
+        self.written_bytes = 0
+
+        # (end offset, callback) of frames not completely written yet
+        self.callbacks = deque()
+
+    def put(self, frame, callback=None):
+        self.frames.append(frame)
+        self.put_bytes += len(frame)
+        if callback is not None:
+            self.callbacks.append((self.put_bytes, callback))
+
+    def take(self):
+        """remove and return all queued frames as one string"""
+        data = "".join(self.frames)
+        self.frames = []
+        return data
+
+    def written(self, count):
+        """count bytes left the socket, complete the frames they finish"""
+        self.written_bytes += count
+        callbacks = self.callbacks
+        while callbacks and callbacks[0][0] <= self.written_bytes:
+            callbacks.popleft()[1](True)
+
+    def fail(self):
+        """drop the queued frames, the pending callbacks get False"""
+        self.frames = []
+        callbacks = self.callbacks
+        self.callbacks = deque()
+        for _, callback in callbacks:
+            callback(False)
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class ChannelEndpoint(object):
+    """
+    one channel of a multiplexed connection
+
+    Stands in for the socket in :class:`ChannelMembership`, so a connection
+    can be a member of several channels. Everything else is delegated to the
+    socket.
+    """
+
+    __slots__ = ["socket", "channel_id"]
+
+    def __init__(self, socket, channel_id):
+        self.socket = socket
+        self.channel_id = channel_id
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class ChannelMembership(object):
+    """
+    channel members of a server, indexed by channel, by socket and by client
+
+    All three mappings are updated together, so routing a command from a
+    socket or finding the sockets of a client never scans the channels.
+    """
+
+    def __init__(self):
+
+        # mapping from (channel_id) to a set of (client_id, socket)
+        self.channels = {}
+
+        # mapping from (socket) to (channel_id, client_id)
+        self.sockets = {}
+
+        # mapping from (client_id) to a set of (socket)
+        self.clients = {}
+
+    def join(self, channel_id, client_id, socket):
+        """add socket to channel, returns True if the channel is new"""
+        self.leave(socket)
+
+        created = channel_id not in self.channels
+        if created:
+            self.channels[channel_id] = set()
+        self.channels[channel_id].add((client_id, socket))
+        self.sockets[socket] = (channel_id, client_id)
+        self.clients.setdefault(client_id, set()).add(socket)
+        return created
+
+    def leave(self, socket):
+        """remove socket from its channel, returns (channel_id, client_id)"""
+        entry = self.sockets.pop(socket, None)
+        if entry is None:
+            return None, None
+
+        channel_id, client_id = entry
+        self.channels[channel_id].discard((client_id, socket))
+        sockets = self.clients[client_id]
+        sockets.discard(socket)
+        if not sockets:
+            del self.clients[client_id]
+        return entry
+
+    def lookup(self, socket):
+        """return (channel_id, client_id) of socket or (None, None)"""
+        return self.sockets.get(socket, (None, None))
+
+    def client_sockets(self, client_id):
+        return self.clients.get(client_id, ())
+
+
+class LivenessTracker(object):
+    """
+    last-seen times of peers, expired in batches
+
+    A hashed timing wheel of ``slots`` buckets, each ``resolution`` ms wide.
+    :meth:`touch` only records the time, so a heartbeat costs a dict
+    assignment. A peer sits in the bucket of the expiry it had when it was
+    put there; once :meth:`expire` reaches that bucket the peer is either
+    expired or moved to the bucket of its current expiry. A shorter
+    ``timeout`` puts all peers in the buckets of their new expiry. Times are
+    in ms.
+    """
+
+    def __init__(self, timeout, resolution=1000, slots=64, clock=None):
+        self._timeout = timeout
+        self.resolution = resolution
+        self.clock = clock or (lambda: time.time() * 1000)
+
+        # mapping from (key) to (time it was seen last)
+        self.last_seen = {}
+
+        # the buckets, a key is in exactly one of them
+        self.wheel = [set() for _ in xrange(slots)]
+
+        # the next tick to process
+        self.tick = int(self.clock() // resolution)
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+
+        # a later expiry is found once the bucket is reached, an earlier one
+        # would be missed
+        shorter = timeout < self._timeout
+        self._timeout = timeout
+        if shorter:
+            self.wheel = [set() for _ in self.wheel]
+            for key, last_seen in self.last_seen.items():
+                self._schedule(key, last_seen + timeout)
+
+    def touch(self, key, now=None):
+        """key was seen now, returns True if it is new"""
+        if now is None:
+            now = self.clock()
+        new = key not in self.last_seen
+        self.last_seen[key] = now
+        if new:
+            self._schedule(key, now + self.timeout)
+        return new
+
+    def _schedule(self, key, due):
+        tick = max(-int(-due // self.resolution), self.tick)
+        self.wheel[tick % len(self.wheel)].add(key)
+
+    def discard(self, key):
+        if self.last_seen.pop(key, None) is not None:
+            for bucket in self.wheel:
+                bucket.discard(key)
+
+    def expire(self, now=None):
+        """remove and return all keys not seen for timeout ms"""
+        if now is None:
+            now = self.clock()
+        current = int(now // self.resolution)
+        slots = len(self.wheel)
+
+        # after a stall, one round over the wheel catches up
+        self.tick = max(self.tick, current - slots + 1)
+
+        expired = []
+        while self.tick <= current:
+            index = self.tick % slots
+            bucket = self.wheel[index]
+            self.wheel[index] = set()
+            self.tick += 1
+            for key in bucket:
+                due = self.last_seen[key] + self.timeout
+                if due <= now:
+                    del self.last_seen[key]
+                    expired.append(key)
+                else:
+                    self._schedule(key, due)
+        return expired
+
+    def __contains__(self, key):
+        return key in self.last_seen
+
+    def __len__(self):
+        return len(self.last_seen)
+
+
+
+class AnnouncementSchedule(object):
+    """
+    when to send the regular announcement, given the size of the lobby
+
+    Every peer multicasts its announcement once per interval and parses
+    everybody else's, so with a fixed interval the traffic grows with the
+    square of the peers. Up to ``peers`` peers the interval stays at
+    ``interval`` ms, beyond it grows with the number of peers seen, which
+    keeps the announcements on the LAN at about ``peers / interval``. Each
+    interval is shortened by a random part of up to ``jitter``, so peers
+    that started together drift apart, while no gap gets longer than the
+    nominal interval older peers expect. :meth:`timeout` follows the
+    interval, so a large lobby doesn't expire peers between two of their
+    announcements.
+
+    :meth:`reserve` suppresses duplicates: an announcement is sent at most
+    once per ``window`` ms, the ones asked for meanwhile are merged into a
+    single one at the end of the window. Times are in ms.
+    """
+
+    def __init__(self, interval=15000, peers=50, window=1000, jitter=0.2,
+                 clock=None):
+        self.interval = interval
+        self.peers = peers
+        self.window = window
+        self.jitter = jitter
+        self.clock = clock or (lambda: time.time() * 1000)
+
+        # mapping from (announcement) to the time it is sent (or was sent)
+        self.sent = {}
+
+    def nominal_interval(self, peers):
+        return self.interval * max(1.0, float(peers) / self.peers)
+
+    def next_interval(self, peers):
+        """return the ms until the next announcement"""
+        return int(self.nominal_interval(peers) *
+                   (1 - self.jitter * random.random()))
+
+    def timeout(self, peers, grace):
+        """return the ms after which a silent peer is gone"""
+
+        # one announcement may get lost, like with the fixed interval
+        return int(2 * self.nominal_interval(peers) + grace)
+
+    def reserve(self, announcement, now=None):
+        """
+        plan to send announcement, return the ms to wait before sending it,
+        or None if it is planned already
+        """
+        if now is None:
+            now = self.clock()
+        last = self.sent.get(announcement)
+        if last is not None and last > now:
+            return None
+        if last is None:
+            due = now
+        else:
+            due = max(now, last + self.window)
+        self.sent[announcement] = due
+        return int(due - now)
+
+
+class ChannelHistory(object):
+    """
+    the last messages of one channel, in a ring buffer
+
+    Messages are kept in columns: the times (seconds since the epoch) in an
+    array of doubles, the nicknames interned in ``nicknames`` and the texts
+    utf8-encoded. Once ``maximum_entries`` messages or ``maximum_bytes`` of
+    text are stored, the oldest messages are dropped. Reading returns
+    ``(time, nickname, message)`` tuples, built only for the requested
+    messages. Times are assumed not to go backwards; an earlier time is
+    stored as the time of the previous message.
+    """
+
+    def __init__(self, maximum_entries=1000, maximum_bytes=1 << 20,
+                 nicknames=None):
+        self.maximum_entries = maximum_entries
+        self.maximum_bytes = maximum_bytes
+        self.times = array("d", [0.0]) * maximum_entries
+        self.nicknames = [None] * maximum_entries
+        self.messages = [None] * maximum_entries
+
+        # mapping from (nickname) to the one copy of it we keep
+        self.nickname_table = {} if nicknames is None else nicknames
+
+        # index of the oldest message and number of messages
+        self.start = 0
+        self.count = 0
+
+        # number of messages ever appended
+        self.total = 0
+
+        # bytes of message text stored
+        self.size = 0
+
+    def append(self, timestamp, nickname, message):
+        if self.count:
+            timestamp = max(timestamp, self.times[self._index(self.count - 1)])
+        if isinstance(message, unicode):
+            message = message.encode("utf8")
+        nickname = self.nickname_table.setdefault(nickname, nickname)
+
+        # make room: a full ring overwrites its oldest message
+        if self.count == self.maximum_entries:
+            self._drop_oldest()
+        while self.count and self.size + len(message) > self.maximum_bytes:
+            self._drop_oldest()
+
+        index = self._index(self.count)
+        self.times[index] = timestamp
+        self.nicknames[index] = nickname
+        self.messages[index] = message
+        self.count += 1
+        self.total += 1
+        self.size += len(message)
+
+    def _drop_oldest(self):
+        self.size -= len(self.messages[self.start])
+        self.nicknames[self.start] = None
+        self.messages[self.start] = None
+        self.start = (self.start + 1) % self.maximum_entries
+        self.count -= 1
+
+    def _index(self, position):
+        return (self.start + position) % self.maximum_entries
+
+    def _entry(self, position):
+        index = self._index(position)
+        return (self.times[index], self.nicknames[index],
+                self.messages[index].decode("utf8", "replace"))
+
+    def _bisect(self, timestamp):
+        """position of the first message not older than timestamp"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self._index(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def last(self, count):
+        """return the newest count messages, oldest first"""
+        first = max(0, self.count - count)
+        return [self._entry(position) for position in xrange(first, self.count)]
+
+    def between(self, start, end):
+        """return the messages with start <= time < end, oldest first"""
+        return [self._entry(position) for position in
+                xrange(self._bisect(start), self._bisect(end))]
+
+    def since(self, total):
+        """
+        return the messages appended after the first total ones (as far as
+        they are still kept), oldest first
+        """
+        first = max(0, self.count - (self.total - total))
+        return [self._entry(position) for position in xrange(first, self.count)]
+
+    def numbered(self, first, last):
+        """
+        return ``(number, time, nickname, message)`` of the messages first to
+        last, numbered from 1 in the order they were appended (as far as
+        they are still kept)
+        """
+        oldest = self.total - self.count + 1
+        first = max(first, oldest)
+        last = min(last, self.total)
+        return [(number,) + self._entry(number - oldest)
+                for number in xrange(first, last + 1)]
+
+    def __iter__(self):
+        for position in xrange(self.count):
+            yield self._entry(position)
+
+    def __len__(self):
+        return self.count
+
+
+class HistoryStore(object):
+    """
+    mapping from (server_id, channel_id) to a :class:`ChannelHistory`
+
+    All channels share one table of interned nicknames and the same limits.
+    With a ``log`` (an :class:`instantsouplog.ChatLog`) every message is
+    also written to disk, and the history of a channel starts with the
+    newest messages of its log.
+    """
+
+    def __init__(self, maximum_entries=1000, maximum_bytes=1 << 20, log=None):
+        self.maximum_entries = maximum_entries
+        self.maximum_bytes = maximum_bytes
+        self.log = log
+        self.channels = {}
+        self.nicknames = {}
+
+    def _history(self, key):
+        history = self.channels.get(key)
+        if history is None:
+            history = ChannelHistory(self.maximum_entries, self.maximum_bytes,
+                                     self.nicknames)
+            self.channels[key] = history
+
+            # page in what the log remembers of the channel
+            if self.log is not None and key in self.log:
+                for entry in self.log[key].last(self.maximum_entries):
+                    history.append(*entry)
+        return history
+
+    def append(self, key, timestamp, nickname, message):
+        self._history(key).append(timestamp, nickname, message)
+        if self.log is not None:
+            self.log.append(key, timestamp, nickname, message)
+
+    def discard(self, key):
+        self.channels.pop(key, None)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self._history(key)
+
+    def __contains__(self, key):
+        return key in self.channels or \
+               (self.log is not None and key in self.log)
+
+    def __len__(self):
+        return len(self.channels)
+
+
+def channel_group(server_id, channel_id, prefix="239.255"):
+    """return the multicast address of a channel, within prefix/16"""
+    key = u"%s\x00%s" % (server_id, channel_id)
+    checksum = zlib.crc32(key.encode("utf8")) & 0xffff
+
+    # keep clear of the network and the broadcast address of the range
+    checksum = min(max(checksum, 1), 0xfffe)
+    return "%s.%i.%i" % (prefix, checksum >> 8, checksum & 0xff)
+
+
+class SequenceBuffer(object):
+    """
+    puts the numbered messages of one channel back in order
+
+    Until :meth:`start` tells the first number we want, messages are only
+    held. From then on :meth:`receive` returns the messages that are next in
+    line, oldest first, and drops the ones we had. A missing number holds
+    back the messages after it until it arrives or :meth:`skip` gives up on
+    it; :meth:`missing` tells the numbers to ask for. At most
+    ``maximum_held`` messages are held, beyond that the gap is skipped.
+    """
+
+    def __init__(self, maximum_held=1000):
+        self.maximum_held = maximum_held
+
+        # the number of the next message, None until start
+        self.next = None
+
+        # mapping from (number) to (message) of the messages held back
+        self.held = {}
+
+        # the gap (first, last) we asked for last, see missing
+        self.requested = None
+
+    def start(self, number):
+        """messages before number came another way, returns the ready ones"""
+        self.next = number
+        return self._ready()
+
+    def receive(self, number, message):
+        """returns the messages that are ready now, oldest first"""
+        if self.next is not None and number < self.next:
+            return []
+        if self.next is None:
+            if len(self.held) < self.maximum_held:
+                self.held[number] = message
+            return []
+
+        # too much held back, give up on the gap
+        ready = []
+        if len(self.held) >= self.maximum_held:
+            ready = self.skip()
+        self.held[number] = message
+        return ready + self._ready()
+
+    def _ready(self):
+        for number in [number for number in self.held if number < self.next]:
+            del self.held[number]
+        ready = []
+        while self.next in self.held:
+            ready.append(self.held.pop(self.next))
+            self.next += 1
+        return ready
+
+    def missing(self):
+        """return (first, last) of the gap messages wait for, or None"""
+        if self.next is None or not self.held:
+            return None
+        return self.next, min(self.held) - 1
+
+    def skip(self):
+        """give up on the gap, returns the messages that were behind it"""
+        if self.next is None or not self.held:
+            return []
+        self.next = min(self.held)
+        return self._ready()
+
+
+class ServerLookup(MutableMapping):
+    """
+    mapping from (server_id, channel_id) to a socket
+
+    Keeps the reverse mapping from socket to key and the keys of every
+    server up to date, so both lookups are constant-time.
+    """
+
+    def __init__(self, items=()):
+
+        # mapping from (server_id, channel_id) to (socket)
+        self.sockets = {}
+
+        # mapping from (socket) to a set of (server_id, channel_id)
+        self.socket_keys = {}
+
+        # mapping from (server_id) to a set of (server_id, channel_id)
+        self.servers = {}
+
+        self.update(items)
+
+    def __getitem__(self, key):
+        return self.sockets[key]
+
+    def __setitem__(self, key, socket):
+        if key in self.sockets:
+            del self[key]
+
+        self.sockets[key] = socket
+
+        # a multiplexed socket serves several keys
+        if socket is not None:
+            self.socket_keys.setdefault(socket, set()).add(key)
+        self.servers.setdefault(key[0], set()).add(key)
+
+    def __delitem__(self, key):
+        socket = self.sockets.pop(key)
+        if socket is not None:
+            keys = self.socket_keys[socket]
+            keys.discard(key)
+            if not keys:
+                del self.socket_keys[socket]
+
+        keys = self.servers[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.servers[key[0]]
+
+    def __contains__(self, key):
+        return key in self.sockets
+
+    def __iter__(self):
+        return iter(self.sockets)
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def __repr__(self):
+        return "ServerLookup(%r)" % self.sockets
+
+    def find_key(self, socket):
+        """
+        return (server_id, channel_id) of socket or (None, None), the
+        server's own key for a multiplexed socket
+        """
+        keys = self.socket_keys.get(socket)
+        if not keys:
+            return (None, None)
+        key = next(iter(keys))
+        if (key[0], None) in keys:
+            return (key[0], None)
+        return key
+
+    def server_keys(self, server_id):
+        """return a list of all (server_id, channel_id) of server_id"""
+        return list(self.servers.get(server_id, ()))
+
+
+class ChangeSet(object):
+    """
+    what changed in a Client since its last notification
+
+    Users are client_ids, servers are (server_id, channel_id) keys that became
+    usable or went away, memberships are (server_id, channel_id, client_id).
+    Changes that cancel out, like a user found and lost again before the
+    notification, are dropped.
+    """
+
+    def __init__(self):
+        self.users_added = set()
+        self.users_removed = set()
+        self.users_renamed = set()
+        self.servers_added = set()
+        self.servers_removed = set()
+        self.memberships_added = set()
+        self.memberships_removed = set()
+
+    @staticmethod
+    def _add(added, removed, key):
+        if key in removed:
+            removed.discard(key)
+            return False
+        added.add(key)
+        return True
+
+    @staticmethod
+    def _remove(added, removed, key):
+        if key in added:
+            added.discard(key)
+            return False
+        removed.add(key)
+        return True
+
+    def add_user(self, client_id):
+
+        # back again, maybe with another nickname
+        if not self._add(self.users_added, self.users_removed, client_id):
+            self.users_renamed.add(client_id)
+
+    def remove_user(self, client_id):
+        self.users_renamed.discard(client_id)
+        self._remove(self.users_added, self.users_removed, client_id)
+
+    def rename_user(self, client_id):
+        if client_id not in self.users_added:
+            self.users_renamed.add(client_id)
+
+    def add_server(self, key):
+        self._add(self.servers_added, self.servers_removed, key)
+
+    def remove_server(self, key):
+        self._remove(self.servers_added, self.servers_removed, key)
+
+    def add_membership(self, key, client_id):
+        self._add(self.memberships_added, self.memberships_removed,
+                  key + (client_id,))
+
+    def remove_membership(self, key, client_id):
+        self._remove(self.memberships_added, self.memberships_removed,
+                     key + (client_id,))
+
+    def __nonzero__(self):
+        return bool(self.users_added or self.users_removed or
+                    self.users_renamed or self.servers_added or
+                    self.servers_removed or self.memberships_added or
+                    self.memberships_removed)
+
+    def __repr__(self):
+        return ("ChangeSet(users: +%i -%i ~%i, servers: +%i -%i, "
+                "memberships: +%i -%i)" % (
+                    len(self.users_added), len(self.users_removed),
+                    len(self.users_renamed), len(self.servers_added),
+                    len(self.servers_removed), len(self.memberships_added),
+                    len(self.memberships_removed)))
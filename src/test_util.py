@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the data structures in instantsouputil, run with::
+
+    python test_util.py
+"""
+
+import unittest
+
+from instantsouputil import LivenessTracker, ChannelHistory, ChangeSet
+from instantsouputil import SequenceBuffer
+
+
+class LivenessTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = LivenessTracker(5000, resolution=1000, slots=8,
+                                       clock=lambda: 0)
+
+    def test_expire_after_timeout(self):
+        self.assertTrue(self.tracker.touch("a", 0))
+        self.assertFalse(self.tracker.touch("a", 0))
+        self.assertEqual(self.tracker.expire(4999), [])
+        self.assertEqual(self.tracker.expire(5000), ["a"])
+        self.assertNotIn("a", self.tracker)
+
+    def test_touch_postpones_expiry(self):
+        self.tracker.touch("a", 0)
+        self.tracker.touch("a", 4000)
+        self.assertEqual(self.tracker.expire(5000), [])
+        self.assertIn("a", self.tracker)
+        self.assertEqual(self.tracker.expire(9000), ["a"])
+
+    def test_expiry_beyond_one_round(self):
+        self.tracker.timeout = 20000
+        self.tracker.touch("a", 0)
+        for now in xrange(0, 20000, 500):
+            self.assertEqual(self.tracker.expire(now), [])
+        self.assertEqual(self.tracker.expire(20000), ["a"])
+
+    def test_stall_catches_up(self):
+        self.tracker.touch("a", 0)
+        self.tracker.touch("b", 3000)
+        self.assertEqual(sorted(self.tracker.expire(100000)), ["a", "b"])
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_longer_timeout(self):
+        self.tracker.touch("a", 0)
+        self.tracker.timeout = 10000
+        self.assertEqual(self.tracker.expire(5000), [])
+        self.assertEqual(self.tracker.expire(9999), [])
+        self.assertEqual(self.tracker.expire(10000), ["a"])
+
+    def test_shorter_timeout(self):
+        self.tracker.timeout = 20000
+        self.tracker.touch("a", 0)
+        self.tracker.touch("b", 1000)
+        self.tracker.timeout = 2000
+        self.assertEqual(self.tracker.expire(2000), ["a"])
+        self.assertEqual(self.tracker.expire(3000), ["b"])
+
+    def test_discard(self):
+        self.tracker.touch("a", 0)
+        self.tracker.discard("a")
+        self.tracker.discard("a")
+        self.assertEqual(self.tracker.expire(10000), [])
+        self.assertTrue(self.tracker.touch("a", 10000))
+
+
+class ChannelHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history = ChannelHistory(maximum_entries=4, maximum_bytes=100)
+        for number in xrange(6):
+            self.history.append(float(number), u"nick", u"m%i" % number)
+
+    def messages(self, entries):
+        return [entry[-1] for entry in entries]
+
+    def test_ring_wraps_around(self):
+        self.assertEqual(len(self.history), 4)
+        self.assertEqual(self.history.total, 6)
+        self.assertEqual(self.messages(self.history),
+                         [u"m2", u"m3", u"m4", u"m5"])
+        self.assertEqual(self.messages(self.history.last(2)), [u"m4", u"m5"])
+        self.assertEqual(self.messages(self.history.last(10)),
+                         [u"m2", u"m3", u"m4", u"m5"])
+
+    def test_byte_limit(self):
+        self.history.append(6.0, u"nick", u"x" * 99)
+        self.assertEqual(self.messages(self.history), [u"x" * 99])
+        self.assertEqual(self.history.size, 99)
+
+    def test_between(self):
+        self.assertEqual(self.messages(self.history.between(3.0, 5.0)),
+                         [u"m3", u"m4"])
+        self.assertEqual(self.messages(self.history.between(0.0, 3.5)),
+                         [u"m2", u"m3"])
+        self.assertEqual(self.history.between(6.0, 10.0), [])
+
+    def test_since(self):
+        self.assertEqual(self.messages(self.history.since(4)), [u"m4", u"m5"])
+        self.assertEqual(self.messages(self.history.since(0)),
+                         [u"m2", u"m3", u"m4", u"m5"])
+        self.assertEqual(self.history.since(6), [])
+
+    def test_numbered(self):
+        self.assertEqual(self.history.numbered(1, 4),
+                         [(3, 2.0, u"nick", u"m2"), (4, 3.0, u"nick", u"m3")])
+        self.assertEqual([entry[0] for entry in self.history.numbered(5, 9)],
+                         [5, 6])
+
+    def test_time_never_goes_backwards(self):
+        self.history.append(1.0, u"nick", u"late")
+        self.assertEqual(self.history.last(1), [(5.0, u"nick", u"late")])
+        self.assertEqual(self.messages(self.history.between(5.0, 6.0)),
+                         [u"m5", u"late"])
+
+    def test_unicode(self):
+        self.history.append(6.0, u"nick", u"gr\xfc\xdfe")
+        self.assertEqual(self.history.last(1)[0][2], u"gr\xfc\xdfe")
+
+
+class ChangeSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.changes = ChangeSet()
+
+    def test_empty(self):
+        self.assertFalse(self.changes)
+
+    def test_user_found_and_lost(self):
+        self.changes.add_user("a")
+        self.changes.rename_user("a")
+        self.changes.remove_user("a")
+        self.assertFalse(self.changes)
+
+    def test_user_lost_and_found_again(self):
+        self.changes.remove_user("a")
+        self.changes.add_user("a")
+        self.assertEqual(self.changes.users_removed, set())
+        self.assertEqual(self.changes.users_added, set())
+        self.assertEqual(self.changes.users_renamed, set(["a"]))
+
+    def test_rename(self):
+        self.changes.rename_user("a")
+        self.assertEqual(self.changes.users_renamed, set(["a"]))
+
+        # a new user is shown with its nickname anyway
+        self.changes.add_user("b")
+        self.changes.rename_user("b")
+        self.assertEqual(self.changes.users_renamed, set(["a"]))
+        self.assertEqual(self.changes.users_added, set(["b"]))
+
+        self.changes.remove_user("a")
+        self.assertEqual(self.changes.users_renamed, set())
+        self.assertEqual(self.changes.users_removed, set(["a"]))
+
+    def test_servers(self):
+        self.changes.add_server(("s", "c"))
+        self.changes.remove_server(("s", "c"))
+        self.assertFalse(self.changes)
+        self.changes.remove_server(("s", "d"))
+        self.assertEqual(self.changes.servers_removed, set([("s", "d")]))
+
+    def test_memberships(self):
+        self.changes.add_membership(("s", "c"), "a")
+        self.changes.add_membership(("s", "c"), "b")
+        self.changes.remove_membership(("s", "c"), "a")
+        self.assertEqual(self.changes.memberships_added,
+                         set([("s", "c", "b")]))
+        self.assertEqual(self.changes.memberships_removed, set())
+        self.assertEqual(repr(self.changes),
+                         "ChangeSet(users: +0 -0 ~0, servers: +0 -0, "
+                         "memberships: +1 -0)")
+
+
+class SequenceBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = SequenceBuffer(maximum_held=4)
+
+    def test_held_until_start(self):
+        self.assertEqual(self.buffer.receive(6, "f"), [])
+        self.assertEqual(self.buffer.receive(5, "e"), [])
+        self.assertEqual(self.buffer.missing(), None)
+
+        # the messages before 5 came over tcp
+        self.assertEqual(self.buffer.start(5), ["e", "f"])
+        self.assertEqual(self.buffer.receive(4, "d"), [])
+        self.assertEqual(self.buffer.receive(7, "g"), ["g"])
+
+    def test_gap(self):
+        self.buffer.start(1)
+        self.assertEqual(self.buffer.receive(1, "a"), ["a"])
+        self.assertEqual(self.buffer.receive(4, "d"), [])
+        self.assertEqual(self.buffer.receive(5, "e"), [])
+        self.assertEqual(self.buffer.missing(), (2, 3))
+
+    def test_resend_fills_gap(self):
+        self.buffer.start(1)
+        self.buffer.receive(3, "c")
+        self.buffer.receive(4, "d")
+
+        # the server sends the missing messages again, as asked with
+        # RESEND <first> <last>
+        first, last = self.buffer.missing()
+        resent = []
+        for number, message in [(1, "a"), (2, "b"), (3, "c")]:
+            if first <= number <= last:
+                resent.extend(self.buffer.receive(number, message))
+        self.assertEqual((first, last), (1, 2))
+        self.assertEqual(resent, ["a", "b", "c", "d"])
+        self.assertEqual(self.buffer.missing(), None)
+
+        # a duplicate of what was delivered is dropped
+        self.assertEqual(self.buffer.receive(3, "c"), [])
+
+    def test_skip_gap(self):
+        self.buffer.start(1)
+        self.buffer.receive(3, "c")
+        self.buffer.receive(5, "e")
+        self.assertEqual(self.buffer.skip(), ["c"])
+        self.assertEqual(self.buffer.missing(), (4, 4))
+        self.assertEqual(self.buffer.skip(), ["e"])
+        self.assertEqual(self.buffer.skip(), [])
+        self.assertEqual(self.buffer.receive(2, "b"), [])
+
+    def test_too_much_held(self):
+        self.buffer.start(1)
+        for number in xrange(2, 6):
+            self.assertEqual(self.buffer.receive(number, str(number)), [])
+        self.assertEqual(self.buffer.receive(6, "6"),
+                         ["2", "3", "4", "5", "6"])
+        self.assertEqual(self.buffer.missing(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()